@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""Performance benchmarks for heroku-tools.
+
+These are not part of the installed package - run them from the root
+of the repo, e.g.:
+
+    $ python -m benchmarks.bench_git --help
+
+"""
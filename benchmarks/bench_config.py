@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Time loading a fleet of app conf files.
+
+    $ python -m benchmarks.bench_config --envs 150 --settings 40
+
+Each environment's conf file extends a shared base file (with most of
+the settings), and adds its own overrides. The conf directory is loaded
+as the original AppConfiguration.load did (pure Python yaml.load, once
+per file, no extends), then with the C loader, and then from the warm
+compiled config cache.
+
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import click
+import yaml
+from mock import patch
+
+from heroku_tools import cache, config
+
+
+def make_confs(path, envs, settings):
+    """Write a base file and envs conf files, and return the conf paths."""
+    with open(os.path.join(path, 'common.yaml'), 'w') as f:
+        yaml.dump({
+            'application': {'branch': 'master', 'add_tag': True, 'post_deploy': ['python manage.py migrate']},  # noqa
+            'settings': dict(('SETTING_%i' % i, 'value-%i' % i) for i in range(settings)),  # noqa
+        }, f, default_flow_style=False)
+    filenames = []
+    for i in range(envs):
+        filename = os.path.join(path, 'env-%03i.conf' % i)
+        with open(filename, 'w') as f:
+            yaml.dump({
+                'extends': 'common.yaml',
+                'application': {'name': 'app-%03i' % i},
+                'settings': {'SETTING_0': 'override-%i' % i, 'REGION': 'eu'},
+            }, f, default_flow_style=False)
+        filenames.append(filename)
+    return filenames
+
+
+def _time(func, filenames):
+    start = time.time()
+    for filename in filenames:
+        func(filename)
+    return time.time() - start
+
+
+def _pure_python(filename):
+    with open(filename, 'r') as f:
+        return yaml.load(f, Loader=yaml.Loader)
+
+
+@click.command()
+@click.option('--envs', default=150, help="Number of environment conf files")
+@click.option('--settings', default=40, help="Number of settings in the base file")  # noqa
+def main(envs, settings):
+    """Time loading of conf files - pure Python, C loader, and cached."""
+    path = tempfile.mkdtemp()
+    try:
+        filenames = make_confs(path, envs, settings)
+        config_cache = cache.DiskCache(os.path.join(path, 'cache'), 64 * 1024 * 1024)  # noqa
+        results = [('yaml.load (pure Python, no extends)', _time(_pure_python, filenames))]  # noqa
+        with patch.object(config, 'YAML_LOADER', yaml.Loader):
+            results.append(('load_config (pure Python)', _time(lambda f: config.load_config(f, use_cache=False), filenames)))  # noqa
+        results.append(('load_config (%s)' % config.YAML_LOADER.__name__, _time(lambda f: config.load_config(f, use_cache=False), filenames)))  # noqa
+        with patch.object(config, 'get_config_cache', return_value=config_cache):  # noqa
+            results.append(('load_config (cold cache)', _time(config.load_config, filenames)))  # noqa
+            results.append(('load_config (warm cache)', _time(config.load_config, filenames)))  # noqa
+    finally:
+        shutil.rmtree(path)
+    click.echo("%i conf files, each extending a base of %i settings:" % (envs, settings))  # noqa
+    for label, elapsed in results:
+        click.echo("  %-36s %8.1fms  %6.3fms/file" % (label, 1000 * elapsed, 1000 * elapsed / envs))  # noqa
+
+
+if __name__ == '__main__':
+    main()
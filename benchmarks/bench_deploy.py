@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""End-to-end benchmarks of the deploy and config commands.
+
+    $ python -m benchmarks.bench_deploy --commits 2000 --output results.json
+    $ python -m benchmarks.bench_deploy --baseline results.json
+
+Each scenario runs a heroku-tools command, exactly as from the command
+line (but without prompts), against:
+
+- a local fake Heroku Platform API (see fake_api), with a configurable
+  latency per request and number of releases per app;
+- a fake `heroku` CLI on the PATH (see shim), used by post_deploy tasks;
+- a generated git repo, with a local bare repo as the push remote.
+
+The scenarios are:
+
+    deploy      git push, with maintenance page and post_deploy tasks
+    pipeline    pipeline promotion, with maintenance page
+    config      diff and apply of the settings block
+
+For each, the wall time of each phase of the workflow, the number of
+subprocesses started and API calls made, and the peak RSS are recorded.
+The results (the median over --repeat runs) are printed, and written as
+JSON to --output, and compared with a --baseline results file if given.
+
+"""
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import click
+import yaml
+from mock import patch
+
+from heroku_tools import config, deploy, entry_point, git, heroku, settings
+
+from .fake_api import FakeHerokuAPI
+from .repo import make_repo
+from .shim import install_heroku_shim
+
+# the functions timed as phases of each workflow
+PHASES = {
+    'deploy': [
+        ('plan', deploy.Deployment, 'plan'),
+        ('heroku release', heroku.HerokuRelease, 'get_latest_deployment'),
+        ('git range', git, 'get_range'),
+        ('maintenance', heroku, 'toggle_maintenance'),
+        ('push', git, 'push'),
+        ('post_deploy', deploy, 'run_post_deployment_tasks'),
+        ('tag', git, 'apply_tag'),
+    ],
+    'pipeline': [
+        ('plan', deploy.Deployment, 'plan'),
+        ('heroku release', heroku.HerokuRelease, 'get_latest_deployment'),
+        ('git range', git, 'get_range'),
+        ('maintenance', heroku, 'toggle_maintenance'),
+        ('promote', heroku, 'promote_app'),
+        ('tag', git, 'apply_tag'),
+    ],
+    'config': [
+        ('load', config.AppConfiguration, 'load'),
+        ('config vars', heroku, 'get_config_vars'),
+        ('apply', config, 'set_vars'),
+    ],
+}
+
+
+class PhaseTimer(object):
+
+    """Accumulate the wall time spent in a set of functions.
+
+    The functions are patched for the duration of the `with` block, and
+    the total time spent in each (across all threads) is in `elapsed`.
+
+    """
+
+    def __init__(self, phases):
+        """Initialise with a list of (name, owner, attribute) 3-tuples."""
+        self.phases = phases
+        self.elapsed = dict((name, 0.0) for name, _, _ in phases)
+        self._lock = threading.Lock()
+        self._patchers = []
+
+    def _wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.elapsed[name] += time.time() - start
+        return timed
+
+    def __enter__(self):
+        for name, owner, attribute in self.phases:
+            func = getattr(owner, attribute)
+            if isinstance(owner, type):
+                # classmethods must be re-wrapped as such
+                wrapped = classmethod(self._wrap(name, func.__func__))
+            else:
+                wrapped = self._wrap(name, func)
+            patcher = patch.object(owner, attribute, wrapped)
+            patcher.start()
+            self._patchers.append(patcher)
+        return self
+
+    def __exit__(self, *args):
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+
+
+@contextlib.contextmanager
+def count_subprocesses():
+    """Count the subprocesses started (via subprocess.Popen) in the block.
+
+    Yields a list, to which one entry is appended per subprocess.
+
+    """
+    started = []
+    original = subprocess.Popen.__init__
+
+    def init(self, args, *a, **kw):
+        started.append(args)
+        original(self, args, *a, **kw)
+
+    with patch.object(subprocess.Popen, '__init__', init):
+        yield started
+
+
+def peak_rss():
+    """Return the peak RSS (in KB) of this process, and of its children."""
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+class Environment(object):
+
+    """The fake API, CLI, repos and settings used by the benchmarks."""
+
+    def __init__(self, path, api, commits, files, range_size, releases, config_vars, tasks):  # noqa
+        self.path = path
+        self.api = api
+        self.repo = os.path.join(path, 'repo')
+        self.remote = os.path.join(path, 'remote.git')
+        self.conf_dir = os.path.join(path, 'conf')
+        self.config_vars = config_vars
+        os.makedirs(self.conf_dir)
+        self.hashes = make_repo(self.repo, commits=commits, files=files)
+        self.head = self.hashes[-1]
+        self.base = self.hashes[max(len(self.hashes) - range_size - 1, 0)]
+
+        # apps, each with a release history ending at the base commit
+        api.add_app('live-app', config_vars=self.remote_config_vars(), pipeline='p', stage='production')  # noqa
+        api.add_app('staging-app', pipeline='p', stage='staging')
+        for i in range(releases):
+            for app in ('live-app', 'staging-app'):
+                api.deploy(app, self.hashes[i % len(self.hashes)])
+        api.deploy('staging-app', self.head)
+
+        post_deploy = [
+            {
+                'name': 'task-%i' % i,
+                'command': 'heroku run python manage.py task_%i -a live-app' % i,  # noqa
+            }
+            for i in range(tasks)
+        ]
+        self.write_conf('live', {
+            'application': {
+                'name': 'live-app',
+                'branch': 'master',
+                'add_tag': True,
+                'post_deploy': post_deploy,
+            },
+            'settings': self.local_config_vars(),
+        })
+        self.write_conf('pipeline', {
+            'application': {
+                'name': 'live-app',
+                'branch': 'master',
+                'pipeline': True,
+                'upstream': 'staging-app',
+                'add_tag': True,
+            },
+        })
+        settings_file = os.path.join(path, '.herokutoolsconf')
+        with open(settings_file, 'w') as f:
+            yaml.dump({'settings': {
+                'app_conf_dir': self.conf_dir,
+                'git_work_dir': self.repo,
+                'cache_dir': '',
+                'heroku_api_token': 'bench',
+                'history_db': os.path.join(path, 'history.db'),
+            }}, f)
+        self.settings = settings.Settings(settings_file)
+
+    def local_config_vars(self):
+        return dict(('SETTING_%04i' % i, 'value %i' % i) for i in range(self.config_vars))  # noqa
+
+    def remote_config_vars(self):
+        """Remote vars - 10% differ from local, 10% are remote only."""
+        remote = self.local_config_vars()
+        for i in range(0, self.config_vars, 10):
+            remote['SETTING_%04i' % i] = 'old value'
+            remote['ADDON_%04i_URL' % i] = 'postgres://addon/%i' % i
+        return remote
+
+    def write_conf(self, environment, data):
+        with open(os.path.join(self.conf_dir, '%s.conf' % environment), 'w') as f:  # noqa
+            yaml.dump(data, f, default_flow_style=False)
+
+    def reset(self, scenario):
+        """Reset the remote and API state before a run (not timed)."""
+        if scenario == 'config':
+            self.api.apps['live-app']['config_vars'] = self.remote_config_vars()  # noqa
+            return
+        # a fresh remote containing the base commit, as deployed
+        if os.path.exists(self.remote):
+            shutil.rmtree(self.remote)
+        subprocess.check_call(['git', 'init', '-q', '--bare', self.remote])
+        subprocess.check_call(
+            ['git', '-C', self.repo, 'push', '-q', self.remote, '%s:refs/heads/master' % self.base],  # noqa
+            stderr=open(os.devnull, 'w')
+        )
+        self.api.deploy('live-app', self.base)
+
+
+def run_scenario(env, scenario):
+    """Run a single scenario once, and return the measurements."""
+    env.reset(scenario)
+    api = env.api
+    original_push = git.push
+
+    def push(remote, local_branch, remote_branch='master', force=False):
+        # as Heroku does, record a new release for the pushed commit
+        stats = original_push(env.remote, local_branch, remote_branch, force)
+        api.deploy('live-app', env.head)
+        return stats
+
+    args = ['config', 'live'] if scenario == 'config' else ['deploy', 'pipeline' if scenario == 'pipeline' else 'live']  # noqa
+    requests_before = len(api.requests)
+    with patch.object(settings, 'context', env.settings), \
+            patch.object(heroku, '_client', heroku.HerokuClient('bench', base_url=api.url)), \
+            patch.object(git, '_worker', None), \
+            patch.object(git, 'push', push), \
+            patch('heroku_tools.utils.prompt_for_pin', return_value=True), \
+            patch('heroku_tools.utils.prompt_for_action', return_value=True), \
+            patch('heroku_tools.utils.click.echo'), \
+            patch.object(sys, 'stdout', open(os.devnull, 'w')), \
+            count_subprocesses() as subprocesses, \
+            PhaseTimer(PHASES[scenario]) as timer:  # noqa
+        start = time.time()
+        try:
+            entry_point.main(args, standalone_mode=False)
+        finally:
+            if git._worker is not None:
+                git._worker.close()
+        elapsed = time.time() - start
+    rss, children_rss = peak_rss()
+    return {
+        'wall': elapsed,
+        'phases': timer.elapsed,
+        'subprocesses': len(subprocesses),
+        'api_calls': len(api.requests) - requests_before,
+        'peak_rss_kb': rss,
+        'peak_child_rss_kb': children_rss,
+    }
+
+
+def summarise(runs):
+    """Return the median of each measurement over a list of runs."""
+    return {
+        'wall': median([r['wall'] for r in runs]),
+        'phases': dict(
+            (name, median([r['phases'][name] for r in runs]))
+            for name in runs[0]['phases']
+        ),
+        'subprocesses': median([r['subprocesses'] for r in runs]),
+        'api_calls': median([r['api_calls'] for r in runs]),
+        'peak_rss_kb': max(r['peak_rss_kb'] for r in runs),
+        'peak_child_rss_kb': max(r['peak_child_rss_kb'] for r in runs),
+        'runs': runs,
+    }
+
+
+def print_results(results, baseline=None):
+    """Print the results table, with the change since baseline if given."""
+    for scenario, result in sorted(results.items()):
+        base = (baseline or {}).get(scenario)
+
+        def change(value, old):
+            if not old:
+                return ""
+            return "  (%+.0f%%)" % (100.0 * (value - old) / old)
+
+        click.echo("%s: %.3fs%s, %i subprocesses, %i API calls, peak RSS %i KB" % (  # noqa
+            scenario,
+            result['wall'],
+            change(result['wall'], base and base['wall']),
+            result['subprocesses'],
+            result['api_calls'],
+            result['peak_rss_kb'],
+        ))
+        width = max(len(name) for name in result['phases'])
+        for name, elapsed in sorted(result['phases'].items(), key=lambda p: -p[1]):  # noqa
+            click.echo("  %s %7.3fs%s" % (
+                name.ljust(width),
+                elapsed,
+                change(elapsed, base and base['phases'].get(name))
+            ))
+
+
+@click.command()
+@click.option('--scenario', '-s', 'scenarios', multiple=True, type=click.Choice(sorted(PHASES)), help="Scenario to run (default: all)")  # noqa
+@click.option('--commits', default=1000, help="Number of commits in the repo")
+@click.option('--files', default=200, help="Number of files in the repo")
+@click.option('--range', 'range_size', default=50, help="Number of commits to deploy")  # noqa
+@click.option('--releases', default=100, help="Number of existing releases per app")  # noqa
+@click.option('--config-vars', default=100, help="Number of settings per app")
+@click.option('--tasks', default=2, help="Number of post_deploy 'heroku run' tasks")  # noqa
+@click.option('--latency', default=0.05, help="Fake API latency per request, in seconds")  # noqa
+@click.option('--cli-startup', default=0.5, help="Fake heroku CLI start-up time, in seconds")  # noqa
+@click.option('--repeat', default=3, help="Number of runs of each scenario")
+@click.option('--output', '-o', type=click.Path(), help="Write results to this JSON file")  # noqa
+@click.option('--baseline', type=click.Path(exists=True), help="Compare with a previous results file")  # noqa
+@click.option('--label', default='', help="Label recorded in the results (e.g. version)")  # noqa
+def main(scenarios, commits, files, range_size, releases, config_vars, tasks, latency, cli_startup, repeat, output, baseline, label):  # noqa
+    """Benchmark the deploy and config commands end to end."""
+    path = tempfile.mkdtemp()
+    bin_dir = os.path.join(path, 'bin')
+    os.makedirs(bin_dir)
+    install_heroku_shim(bin_dir, startup=cli_startup)
+    results = {}
+    try:
+        with patch.dict(os.environ, {
+            'PATH': bin_dir + os.pathsep + os.environ['PATH'],
+            # for the release tags
+            'GIT_COMMITTER_NAME': 'Bench',
+            'GIT_COMMITTER_EMAIL': 'bench@example.com',
+        }):
+            with FakeHerokuAPI(latency=latency) as api:
+                env = Environment(path, api, commits, files, range_size, releases, config_vars, tasks)  # noqa
+                for scenario in scenarios or sorted(PHASES):
+                    runs = [run_scenario(env, scenario) for _ in range(repeat)]
+                    results[scenario] = summarise(runs)
+    finally:
+        shutil.rmtree(path)
+
+    report = {
+        'label': label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'parameters': {
+            'commits': commits,
+            'files': files,
+            'range': range_size,
+            'releases': releases,
+            'config_vars': config_vars,
+            'tasks': tasks,
+            'latency': latency,
+            'cli_startup': cli_startup,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+    if baseline:
+        with open(baseline, 'r') as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        click.echo("Results written to %s" % output)
+
+
+if __name__ == '__main__':
+    main()
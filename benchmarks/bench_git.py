@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Compare the persistent git worker with forking git for each lookup.
+
+    $ python -m benchmarks.bench_git --commits 1000 --lookups 200
+
+"""
+import shutil
+import tempfile
+import time
+
+import click
+
+from heroku_tools import git
+
+from .repo import make_repo, work_dir_settings
+
+
+def _time(func, refs):
+    start = time.time()
+    for ref in refs:
+        func(ref)
+    return time.time() - start
+
+
+@click.command()
+@click.option('--commits', default=1000, help="Number of commits in the repo")
+@click.option('--lookups', default=200, help="Number of ref lookups to time")
+def main(commits, lookups):
+    """Time ref lookups using per-call forks vs. the GitWorker."""
+    path = tempfile.mkdtemp()
+    try:
+        hashes = make_repo(path, commits=commits)
+        refs = [hashes[i % len(hashes)][:10] for i in range(lookups)]
+        with work_dir_settings(path):
+            forked = _time(lambda r: git.run_git_cmd("rev-parse %s" % r), refs)  # noqa
+            worker = git.GitWorker()
+            try:
+                pooled = _time(worker.resolve, refs)
+            finally:
+                worker.close()
+    finally:
+        shutil.rmtree(path)
+    click.echo("%i lookups in a repo of %i commits:" % (lookups, commits))
+    click.echo("  git rev-parse (fork per call)  %7.3fs  %7.3fms/lookup" % (forked, 1000 * forked / lookups))  # noqa
+    click.echo("  GitWorker (cat-file --batch)   %7.3fs  %7.3fms/lookup" % (pooled, 1000 * pooled / lookups))  # noqa
+    click.echo("  speedup                        %7.1fx" % (forked / pooled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Compare the Heroku CLI with the Platform API for maintenance / promotion.
+
+    $ python -m benchmarks.bench_heroku --app my-staging-app --repeat 3
+
+This runs against a real application, so it requires a valid API token
+and the heroku CLI. The maintenance page is toggled on and off, and the
+app is only promoted if --promote is passed.
+
+"""
+import time
+
+import click
+
+from heroku_tools import heroku
+
+
+def _time(func, repeat):
+    """Return the mean time taken to call func."""
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+@click.command()
+@click.option('--app', required=True, help="Heroku application to use")
+@click.option('--repeat', default=3, help="Number of times to run each call")
+@click.option('--promote', is_flag=True, help="Also time pipeline promotion of the app")  # noqa
+def main(app, repeat, promote):
+    """Time the CLI and API implementations of maintenance and promote."""
+    calls = [
+        (
+            'maintenance on/off',
+            lambda: (
+                heroku.run_cmd(app, "maintenance:on"),
+                heroku.run_cmd(app, "maintenance:off")
+            ),
+            lambda: (
+                heroku.toggle_maintenance(app, True),
+                heroku.toggle_maintenance(app, False)
+            ),
+        ),
+    ]
+    if promote:
+        calls.append((
+            'pipeline promote',
+            lambda: heroku.run_cmd(app, "pipelines:promote"),
+            lambda: heroku.promote_app(app),
+        ))
+    click.echo("Mean of %i runs against %s:" % (repeat, app))
+    for name, cli, api in calls:
+        cli_time = _time(cli, repeat)
+        api_time = _time(api, repeat)
+        click.echo("  %-20s CLI %7.3fs  API %7.3fs  speedup %5.1fx" % (name, cli_time, api_time, cli_time / api_time))  # noqa
+
+
+if __name__ == '__main__':
+    main()
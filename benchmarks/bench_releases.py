@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Compare the parse-once HerokuRelease with the original lazy version.
+
+    $ python -m benchmarks.bench_releases --releases 10000
+
+The original HerokuRelease (reproduced here as LazyRelease) kept the raw
+JSON of each release, and re-parsed fields on every access. A history
+walk, like `sync`, reads each field of every release once or twice -
+the benchmark times building the releases from JSON and reading all of
+their fields (twice), and measures the memory retained per release.
+
+"""
+import datetime
+import json
+import sys
+import time
+
+import click
+from dateutil import parser
+
+from heroku_tools.heroku import HerokuRelease
+
+
+class LazyRelease(object):
+
+    """The original HerokuRelease - raw JSON, parsed on access."""
+
+    def __init__(self, raw):
+        self._json = raw
+
+    @property
+    def application(self):
+        return self._json['app']['name']
+
+    @property
+    def commit(self):
+        if self.description.startswith('Promote'):
+            return self.description.split(' ')[3]
+        elif self.description.startswith('Deploy'):
+            return self.description.split(' ')[1]
+        else:
+            return "invalid"
+
+    @property
+    def deployed_at(self):
+        return parser.parse(self._json['updated_at'])
+
+    @property
+    def description(self):
+        return str(self._json['description'])
+
+    @property
+    def version(self):
+        return self._json['version']
+
+    @property
+    def deployed_by(self):
+        return str(self._json['user']['email'])
+
+
+def make_releases(count):
+    """Return the API JSON for count releases, as decoded from a response."""
+    start = datetime.datetime(2014, 1, 1)
+    releases = []
+    for version in range(1, count + 1):
+        if version % 3:
+            description = "Deploy %07x" % version
+        else:
+            description = "Set FOO_%i config vars" % version
+        timestamp = (start + datetime.timedelta(hours=version)).strftime('%Y-%m-%dT%H:%M:%SZ')  # noqa
+        releases.append({
+            'addon_plan_names': ['heroku-postgresql:standard-0'],
+            'app': {'id': '01234567-89ab-cdef-0123-456789abcdef', 'name': 'bench-app'},  # noqa
+            'created_at': timestamp,
+            'current': False,
+            'description': description,
+            'id': '%08x-89ab-cdef-0123-456789abcdef' % version,
+            'slug': {'id': 'fedcba98-7654-3210-fedc-ba9876543210'},
+            'status': 'succeeded',
+            'updated_at': timestamp,
+            'user': {'email': 'bench@example.com', 'id': 'abcdef01-2345-6789-abcd-ef0123456789'},  # noqa
+            'version': version,
+        })
+    # round-trip through JSON, so that strings are unicode, as from the API
+    return json.loads(json.dumps(releases))
+
+
+def deep_size(obj, seen=None):
+    """Return the approximate memory used by obj and everything it holds."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())  # noqa
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(v, seen) for v in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        size += deep_size(getattr(obj, slot, None), seen)
+    return size
+
+
+def walk(cls, raw, passes):
+    """Create releases from raw JSON, read every field, and return them."""
+    releases = [cls(r) for r in raw]
+    for _ in range(passes):
+        for r in releases:
+            (r.application, r.version, r.commit, r.description, r.deployed_by, r.deployed_at)  # noqa
+    return releases
+
+
+def _time(cls, raw, passes, repeat):
+    """Return the best time taken to walk the releases."""
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        walk(cls, raw, passes)
+        times.append(time.time() - start)
+    return min(times)
+
+
+@click.command()
+@click.option('--releases', default=10000, help="Number of releases")
+@click.option('--passes', default=2, help="Number of reads of each field")
+@click.option('--repeat', default=3, help="Number of runs (best is reported)")
+def main(releases, passes, repeat):
+    """Time and size the lazy and parse-once release representations."""
+    raw = make_releases(releases)
+    click.echo("%i releases, each field read %i times:" % (releases, passes))
+    click.echo("  %-22s %9s %11s %14s" % ("", "total", "us/release", "bytes/release"))  # noqa
+    results = []
+    for label, cls in (
+        ('lazy (raw JSON)', LazyRelease),
+        ('parse-once (__slots__)', HerokuRelease),
+    ):
+        elapsed = _time(cls, raw, passes, repeat)
+        # the lazy release keeps the raw JSON alive, so it is counted
+        sample = walk(cls, raw[:100], 0)
+        size = sum(deep_size(r) for r in sample) / len(sample)
+        results.append((elapsed, size))
+        click.echo("  %-22s %8.3fs %11.1f %14i" % (label, elapsed, 1e6 * elapsed / releases, size))  # noqa
+    (lazy_time, lazy_size), (slots_time, slots_size) = results
+    click.echo("  speedup %.1fx, memory %.1fx smaller" % (lazy_time / slots_time, float(lazy_size) / slots_size))  # noqa
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Heroku Platform API, for benchmarking.
+
+Unlike the route table used in tests.py, this keeps state - apps have
+releases, config vars, maintenance mode and pipeline couplings, which
+are updated by the API calls made during a deployment, so that the same
+workflow can be run repeatedly against it.
+
+Supported endpoints (those used by heroku-tools):
+
+    GET   /apps/{app}                      PATCH /apps/{app} (maintenance)
+    GET   /apps/{app}/releases             (with Range pagination)
+    GET   /apps/{app}/config-vars          PATCH /apps/{app}/config-vars
+    GET   /apps/{app}/pipeline-couplings
+    GET   /pipelines/{id}/pipeline-couplings
+    POST  /pipeline-promotions
+    GET   /pipeline-promotions/{id}[/promotion-targets]
+
+"""
+import BaseHTTPServer
+import SocketServer
+import collections
+import datetime
+import json
+import re
+import socket
+import sys
+import threading
+import time
+import uuid
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):  # noqa
+
+    """HTTP server with a thread per connection, which can be closed cleanly.
+
+    Clients keep connections alive, so handler threads are still blocked
+    reading them when the server is shut down - close() shuts down each
+    open connection, and waits for its thread to finish, so that nothing
+    is left to fail (noisily) during interpreter shutdown.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = {}
+        self._connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(
+            target=self.process_request_thread,
+            args=(request, client_address)
+        )
+        thread.daemon = True
+        with self._connections_lock:
+            self.connections[request] = thread
+        thread.start()
+
+    def shutdown_request(self, request):
+        with self._connections_lock:
+            self.connections.pop(request, None)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def handle_error(self, request, client_address):
+        # clients dropping or resetting connections are expected
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)  # noqa
+
+    def close(self):
+        """Stop serving, and close all open connections."""
+        self.shutdown()
+        with self._connections_lock:
+            connections = self.connections.items()
+        for request, thread in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1.0)
+        self.server_close()
+
+
+def parse_range(header, default_max=200):
+    """Return (start, exclusive, max, order) from a releases Range header.
+
+    Accepts the formats sent by heroku-tools ('version;max=10,order=desc')
+    and returned in our Next-Range headers ('version ]12..; max=10,
+    order=desc').
+
+    """
+    match = re.match(r'version\s*(\]?)(\d*)(?:\.\.\d*)?\s*;?\s*(.*)$', header or 'version')  # noqa
+    exclusive, start, rest = match.groups()
+    options = dict(
+        option.strip().split('=', 1)
+        for option in re.split(r'[;,]', rest) if '=' in option
+    )
+    return (
+        int(start) if start else None,
+        bool(exclusive),
+        int(options.get('max', default_max)),
+        options.get('order', 'asc').strip()
+    )
+
+
+class FakeHerokuAPI(object):
+
+    """Threaded HTTP server that emulates the Heroku Platform API."""
+
+    def __init__(self, latency=0.0):
+        """Initialise API - the server is started on __enter__.
+
+        Kwargs:
+            latency: seconds to wait before responding to each request,
+                to approximate the round trip to the real API.
+
+        """
+        self.latency = latency
+        self.apps = {}
+        self.pipelines = collections.defaultdict(list)
+        self.promotions = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        self._clock = datetime.datetime(2016, 1, 1)
+        api = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                if api.latency:
+                    time.sleep(api.latency)
+                status, data, headers = api.handle(
+                    self.command, self.path, self.headers, body
+                )
+                content = json.dumps(data)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_PATCH = do_POST = do_DELETE = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%i' % self.server.server_port
+
+    def __enter__(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={'poll_interval': 0.01}
+        )
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.close()
+
+    # ---------- state ----------
+
+    def add_app(self, name, config_vars=None, pipeline=None, stage=None):
+        """Add an application, optionally coupled to a pipeline stage."""
+        self.apps[name] = {
+            'id': str(uuid.uuid4()),
+            'name': name,
+            'maintenance': False,
+            'releases': [],
+            'config_vars': dict(config_vars or {}),
+        }
+        if pipeline is not None:
+            self.pipelines[pipeline].append((name, stage))
+
+    def add_release(self, name, description, email='bench@example.com'):
+        """Add a release to an app, and return its version."""
+        with self._lock:
+            app = self.apps[name]
+            self._clock += datetime.timedelta(minutes=1)
+            version = len(app['releases']) + 1
+            app['releases'].append({
+                'version': version,
+                'description': description,
+                'app': {'id': app['id'], 'name': name},
+                'user': {'email': email},
+                'created_at': self._clock.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'updated_at': self._clock.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            })
+            return version
+
+    def deploy(self, name, commit):
+        """Record a deployment of commit (as by a git push) to an app."""
+        return self.add_release(name, 'Deploy %s' % commit[:7])
+
+    def _app_by_id(self, app_id):
+        for app in self.apps.values():
+            if app['id'] == app_id:
+                return app
+
+    # ---------- request handling ----------
+
+    def handle(self, method, path, headers, body):
+        """Return the (status, data, headers) response to a request."""
+        with self._lock:
+            self.requests.append((method, path))
+        for pattern, handler in (
+            (r'^/apps/([^/]+)$', self.app),
+            (r'^/apps/([^/]+)/releases$', self.releases),
+            (r'^/apps/([^/]+)/config-vars$', self.config_vars),
+            (r'^/apps/([^/]+)/pipeline-couplings$', self.app_coupling),
+            (r'^/pipelines/([^/]+)/pipeline-couplings$', self.couplings),
+            (r'^/pipeline-promotions$', self.promote),
+            (r'^/pipeline-promotions/([^/]+)$', self.promotion),
+            (r'^/pipeline-promotions/([^/]+)/promotion-targets$', self.targets),  # noqa
+        ):
+            match = re.match(pattern, path)
+            if match:
+                try:
+                    return handler(method, headers, body, *match.groups())
+                except KeyError:
+                    break
+        return 404, {'id': 'not_found', 'message': 'Not found'}, {}
+
+    def app(self, method, headers, body, name):
+        app = self.apps[name]
+        if method == 'PATCH':
+            app['maintenance'] = bool(body.get('maintenance'))
+        return 200, {'id': app['id'], 'name': name, 'maintenance': app['maintenance']}, {}  # noqa
+
+    def releases(self, method, headers, body, name):
+        start, exclusive, page_size, order = parse_range(headers.get('Range'))
+        releases = sorted(
+            self.apps[name]['releases'],
+            key=lambda r: r['version'],
+            reverse=(order == 'desc')
+        )
+        if start is not None:
+            if order == 'desc':
+                releases = [r for r in releases if r['version'] < start or (r['version'] == start and not exclusive)]  # noqa
+            else:
+                releases = [r for r in releases if r['version'] > start or (r['version'] == start and not exclusive)]  # noqa
+        page = releases[:page_size]
+        if len(releases) > page_size:
+            return 206, page, {
+                'Next-Range': 'version ]%i..; max=%i, order=%s' % (
+                    page[-1]['version'], page_size, order
+                )
+            }
+        return 200, page, {}
+
+    def config_vars(self, method, headers, body, name):
+        app = self.apps[name]
+        if method == 'PATCH':
+            for key, value in body.items():
+                if value is None:
+                    app['config_vars'].pop(key, None)
+                else:
+                    app['config_vars'][key] = value
+            self.add_release(name, 'Set %s config vars' % ', '.join(sorted(body)))  # noqa
+        return 200, app['config_vars'], {}
+
+    def app_coupling(self, method, headers, body, name):
+        for pipeline, apps in self.pipelines.items():
+            for app_name, stage in apps:
+                if app_name == name:
+                    return 200, {
+                        'app': {'id': self.apps[name]['id']},
+                        'pipeline': {'id': pipeline},
+                        'stage': stage,
+                    }, {}
+        raise KeyError(name)
+
+    def couplings(self, method, headers, body, pipeline):
+        return 200, [
+            {'app': {'id': self.apps[name]['id']}, 'stage': stage}
+            for name, stage in self.pipelines[pipeline]
+        ], {}
+
+    def promote(self, method, headers, body):
+        source = self._app_by_id(body['source']['app']['id'])
+        latest = source['releases'][-1]
+        commit = latest['description'].split(' ')[-1]
+        promotion_id = str(uuid.uuid4())
+        targets = []
+        for target in body['targets']:
+            app = self._app_by_id(target['app']['id'])
+            self.add_release(
+                app['name'],
+                'Promote %s v%i %s' % (source['name'], latest['version'], commit)  # noqa
+            )
+            targets.append({'app': {'id': app['id']}, 'status': 'succeeded'})
+        self.promotions[promotion_id] = targets
+        return 201, {'id': promotion_id, 'status': 'completed'}, {}
+
+    def promotion(self, method, headers, body, promotion_id):
+        self.promotions[promotion_id]
+        return 200, {'id': promotion_id, 'status': 'completed'}, {}
+
+    def targets(self, method, headers, body, promotion_id):
+        return 200, self.promotions[promotion_id], {}
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Generation of synthetic git repos for benchmarking."""
+import os
+import subprocess
+
+
+def make_repo(path, commits=100, files=20, branch='master'):
+    """Create a git repo at path with a linear history of commits.
+
+    The history is written using a single `git fast-import`, so that
+    very large repos can be generated quickly. Each commit modifies one
+    of `files` files, in rotation.
+
+    Returns the list of commit hashes, oldest first.
+
+    """
+    subprocess.check_call(['git', 'init', '-q', path])
+    p = subprocess.Popen(
+        ['git', '-C', path, 'fast-import', '--quiet'],
+        stdin=subprocess.PIPE
+    )
+    for i in range(commits):
+        message = 'Commit %i' % i
+        content = 'content %i\n' % i
+        p.stdin.write(
+            'commit refs/heads/%s\n'
+            'mark :%i\n'
+            'committer Bench <bench@example.com> %i +0000\n'
+            'data %i\n%s\n'
+            'M 644 inline file%i.txt\n'
+            'data %i\n%s\n' % (
+                branch, i + 1, 1400000000 + i, len(message), message,
+                i % files, len(content), content
+            )
+        )
+    p.stdin.close()
+    if p.wait() > 0:
+        raise Exception("git fast-import failed")
+    subprocess.check_call(
+        ['git', '-C', path, 'symbolic-ref', 'HEAD', 'refs/heads/%s' % branch]
+    )
+    subprocess.check_call(['git', '-C', path, 'checkout', '-q', '-f', branch])
+    log = subprocess.check_output(
+        ['git', '-C', path, 'rev-list', '--reverse', branch]
+    )
+    return log.split()
+
+
+def work_dir_settings(path):
+    """Return a mock.patch that points heroku-tools git commands at path."""
+    from mock import patch
+    return patch('heroku_tools.git.get_work_dir', return_value=os.path.abspath(path))  # noqa
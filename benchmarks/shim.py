@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Fake `heroku` CLI, for benchmarking without the Heroku Toolbelt.
+
+The shim sleeps for a fixed start-up time (to approximate the CLI's cold
+start), then prints some output for the command - so that workflows that
+still fork the CLI (e.g. `heroku run` post-deploy tasks) can be timed
+without a network connection.
+
+"""
+import os
+import stat
+import sys
+
+SHIM = """#!%(python)s
+import sys
+import time
+time.sleep(%(startup)r)
+args = sys.argv[1:]
+if args[:1] == ['auth:token']:
+    print(%(token)r)
+elif args[:1] == ['run']:
+    for i in range(%(lines)i):
+        print('Running %%s: step %%i' %% (' '.join(args[1:]), i))
+else:
+    print('heroku %%s: done' %% ' '.join(args))
+"""
+
+
+def install_heroku_shim(bin_dir, startup=0.5, token='bench', lines=20):
+    """Write an executable `heroku` shim into bin_dir, and return its path.
+
+    Args:
+        bin_dir: the directory to write the shim to - this should be put
+            at the front of PATH.
+
+    Kwargs:
+        startup: the number of seconds the shim sleeps before running.
+        token: the token printed by `heroku auth:token`.
+        lines: the number of lines of output printed by `heroku run`.
+
+    """
+    path = os.path.join(bin_dir, 'heroku')
+    with open(path, 'w') as f:
+        f.write(SHIM % {
+            'python': sys.executable,
+            'startup': startup,
+            'token': token,
+            'lines': lines,
+        })
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)  # noqa
+    return path
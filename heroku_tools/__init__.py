@@ -5,12 +5,17 @@ import click
 from . import (
     config,
     settings,
-    deploy
+    deploy,
+    history,
+    timing
 )
 
 
 @click.group()
-def entry_point():
+@click.option('--timings', is_flag=True, help="Print a summary of where the time went")  # noqa
+@click.option('--trace', type=click.Path(), help="Write a Chrome trace-event file of the command")  # noqa
+@click.pass_context
+def entry_point(ctx, timings, trace):
     """Command line tools for managing Heroku applications.
 
     Heroku Tools is an application created out of tools that
@@ -20,10 +25,28 @@ def entry_point():
     on the YunoJuno tech blog.
 
     """
-    pass
+    if not (timings or trace):
+        return
+    recorder = timing.start()
+
+    def report():
+        timing.stop()
+        if timings:
+            timing.print_summary(recorder)
+        if trace:
+            timing.write_trace(recorder, trace)
+            click.echo("Trace written to %s" % trace)
+
+    ctx.call_on_close(report)
 
 # add sub-commands to the main entrypoint
 entry_point.add_command(settings.init_app_conf)
 entry_point.add_command(settings.print_settings)
 entry_point.add_command(deploy.deploy_application)
 entry_point.add_command(config.configure_application)
+entry_point.add_command(config.audit_applications)
+entry_point.add_command(history.sync_history)
+entry_point.add_command(history.print_history)
+entry_point.add_command(history.which_release)
+entry_point.add_command(history.deploy_stats)
+entry_point.add_command(history.tag_backfill)
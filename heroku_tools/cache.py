@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""On-disk caching of JSON documents.
+
+The cache is a flat directory of JSON files, one per key, named using
+the SHA1 of the key. It is bounded by total size on disk - when a new
+entry takes it over the limit, the least recently used entries (by
+file mtime, which is updated on each read) are removed.
+
+Cached entries may include secrets (e.g. application config vars), so
+the cache directory is created readable by the owner only, and each
+file is written with 0600 permissions.
+
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+class DiskCache(object):
+
+    """Size-bounded, LRU-evicted, owner-only cache of JSON documents."""
+
+    def __init__(self, path, max_size):
+        """Initialise cache.
+
+        Args:
+            path: the directory in which to store cache files; this is
+                created (with 0700 permissions) on first write.
+            max_size: the maximum total size of the cache, in bytes.
+
+        """
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def _filename(self, key):
+        """Return the path of the file used to store a key."""
+        return os.path.join(
+            self.path,
+            '%s.json' % hashlib.sha1(key.encode('utf-8')).hexdigest()
+        )
+
+    def get(self, key):
+        """Return the cached value for a key, or None if not cached."""
+        filename = self._filename(key)
+        try:
+            with open(filename, 'r') as f:
+                value = json.load(f)
+            # bump the mtime so that LRU eviction sees this as used
+            os.utime(filename, None)
+            return value
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        """Store value (which must be JSON serializable) against key."""
+        with self._lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0o700)
+            # makedirs is subject to the umask, and an existing directory
+            # may have been created with looser permissions.
+            os.chmod(self.path, 0o700)
+            # write to a temp file and rename, so that readers never
+            # see a partially written entry.
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(value, f)
+                os.rename(tmp, self._filename(key))
+            except Exception:
+                os.remove(tmp)
+                raise
+            self.evict()
+
+    def delete(self, key):
+        """Remove a key from the cache, if present."""
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove least recently used entries until within max_size."""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            filename = os.path.join(self.path, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(e[1] for e in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
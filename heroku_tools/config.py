@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
 """Configuration for heroku-tools itself and Heroku applications."""
+import glob
+import hashlib
+import json
 import os
+import sys
 
 import click
 import yaml
 
 from . import (
+    cache,
     heroku,
     settings,
+    timing,
     utils
 )
 
 
+# the C (libyaml) loader is many times faster than the pure Python one,
+# but is only available if PyYAML was built with libyaml.
+YAML_LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+
+
 class ConfigurationError(Exception):
 
     """Exception used when encountering a configuration error."""
@@ -19,6 +30,160 @@ class ConfigurationError(Exception):
     pass
 
 
+def get_config_cache():
+    """Return the DiskCache used for compiled app configuration, or None."""
+    if not settings.context.cache_dir:
+        return None
+    return cache.DiskCache(
+        os.path.join(settings.context.cache_dir, 'config'),
+        settings.context.cache_max_size
+    )
+
+
+def _merge(base, overlay):
+    """Return base updated with overlay, merging (not replacing) dicts."""
+    merged = dict(base)
+    for key, value in overlay.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _parse(filename, extended_by=()):
+    """Parse a conf file and the files it extends.
+
+    Returns a 2-tuple of the merged config dict, and a list of the
+    [filename, mtime, size, sha1] of each file read, for validating the
+    compiled cache.
+
+    """
+    if filename in extended_by:
+        raise ConfigurationError(
+            u"Invalid configuration - circular extends: %s" %
+            u" -> ".join(extended_by + (filename,))
+        )
+    try:
+        stat = os.stat(filename)
+        with open(filename, 'r') as f:
+            content = f.read()
+    except (IOError, OSError):
+        raise ConfigurationError(
+            u"Unable to read app configuration file: %s" % filename
+        )
+    try:
+        config = yaml.load(content, Loader=YAML_LOADER) or {}
+    except yaml.YAMLError as ex:
+        raise ConfigurationError(
+            u"Invalid YAML in app configuration file %s: %s" % (filename, ex)
+        )
+    if not isinstance(config, dict):
+        raise ConfigurationError(
+            u"Invalid configuration - not a YAML mapping: %s" % filename
+        )
+    sources = [[filename, stat.st_mtime, stat.st_size, hashlib.sha1(content).hexdigest()]]  # noqa
+    extends = config.pop('extends', None) or []
+    if isinstance(extends, basestring):
+        extends = [extends]
+    merged = {}
+    for base in extends:
+        base_config, base_sources = _parse(
+            os.path.join(os.path.dirname(filename), base),
+            extended_by + (filename,)
+        )
+        merged = _merge(merged, base_config)
+        sources.extend(base_sources)
+    return _merge(merged, config), sources
+
+
+def _is_fresh(sources):
+    """Return True if none of the files in a cached config have changed.
+
+    Files whose mtime and size are unchanged are assumed to be, otherwise
+    the content is hashed - so that touching a file (e.g. by checking it
+    out again) doesn't invalidate the cache.
+
+    """
+    for filename, mtime, size, digest in sources:
+        try:
+            stat = os.stat(filename)
+            if (stat.st_mtime, stat.st_size) == (mtime, size):
+                continue
+            with open(filename, 'r') as f:
+                if hashlib.sha1(f.read()).hexdigest() != digest:
+                    return False
+        except (IOError, OSError):
+            return False
+    return True
+
+
+def _native(value):
+    """Convert cached JSON to the types returned by yaml.load.
+
+    JSON decodes all strings as unicode, whereas yaml.load returns str
+    for ASCII strings, so these are encoded back to str.
+
+    """
+    value_type = type(value)
+    if value_type is unicode:
+        try:
+            return value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    if value_type is dict:
+        return dict((_native(k), _native(v)) for k, v in value.iteritems())
+    if value_type is list:
+        return [_native(v) for v in value]
+    return value
+
+
+def load_config(filename, use_cache=True):
+    """Return the config dict of a conf file, merged with any it extends.
+
+    A conf file can inherit from one or more base files, with `extends`
+    (file names are relative to the conf file). The conf file is merged
+    over its bases - nested mappings, such as `settings`, are merged key
+    by key, anything else (including lists) is replaced:
+
+        extends: common.yaml
+        application:
+            name: live_app
+        settings:
+            DJANGO_DEBUG: False
+
+    Base files can themselves extend other files. They should not end
+    in '.conf', so that they aren't taken to be environments.
+
+    The merged config is stored in the compiled config cache (if the
+    cache_dir is set), and is used until any of the files it was read
+    from is changed. Configs that can't be stored as JSON exactly (e.g.
+    those with dates, or non-string keys) are not cached.
+
+    Kwargs:
+        use_cache: if False, the cache is not read from or written to.
+
+    Raises ConfigurationError if a file can't be read, is not a YAML
+    mapping, or the files extend each other in a cycle.
+
+    """
+    filename = os.path.abspath(filename)
+    config_cache = get_config_cache() if use_cache else None
+    if config_cache is not None:
+        cached = config_cache.get(filename)
+        if cached is not None and _is_fresh(cached['sources']):
+            return _native(cached['config'])
+    config, sources = _parse(filename)
+    if config_cache is not None:
+        try:
+            cacheable = _native(json.loads(json.dumps(config))) == config
+        except (TypeError, ValueError):
+            cacheable = False
+        if cacheable:
+            config_cache.set(filename, {'sources': sources, 'config': config})  # noqa
+    return config
+
+
 class AppConfiguration(object):
 
     """Heroku application configuration, with helper methods."""
@@ -30,25 +195,23 @@ class AppConfiguration(object):
 
     @classmethod
     def load(cls, filename):
-        """Create new object from file."""
-        try:
-            with open(filename, 'r') as f:
-                config = yaml.load(f)
-                app = AppConfiguration(
-                    application=config.get('application'),
-                    settings=config.get('settings'),
-                )
-                # if pipeline is set, we need upstream also
-                if app.use_pipeline and not app.upstream_app:
-                    raise ConfigurationError(
-                        u"Invalid configuration - pipeline is set to run, "
-                        "but no upstream app is defined."
-                    )
-                return app
-        except IOError:
+        """Create new object from file (see load_config)."""
+        config = load_config(filename)
+        if not isinstance(config.get('application'), dict):
             raise ConfigurationError(
-                u"Unable to read app configuration file: %s" % filename
+                u"Invalid configuration - no application block: %s" % filename
             )
+        app = AppConfiguration(
+            application=config.get('application'),
+            settings=config.get('settings'),
+        )
+        # if pipeline is set, we need upstream also
+        if app.use_pipeline and not app.upstream_app:
+            raise ConfigurationError(
+                u"Invalid configuration - pipeline is set to run, "
+                "but no upstream app is defined."
+            )
+        return app
 
     @property
     def app_name(self):
@@ -75,6 +238,16 @@ class AppConfiguration(object):
         """Add release version as a git tag post-deployment."""
         return self.application.get('add_tag', False)
 
+    @property
+    def wait_for_dynos(self):
+        """Wait for dynos to restart on the new release before continuing."""
+        return self.application.get('wait_for_dynos', False)
+
+    @property
+    def warmup(self):
+        """The URLs to warm up post-deployment (see the warmup module)."""
+        return self.application.get('warmup')
+
     @property
     def post_deploy_tasks(self):
         """A list of strings to be executed as shell commands after deployment"""
@@ -106,21 +279,15 @@ def compare_settings(local_config_vars, remote_config_vars):
     The status value is one of '=', '!', '+', '?', as described above.
 
     """
+    local_keys = set(local_config_vars)
+    remote_keys = set(remote_config_vars)
     diff = []
-    for k, v in local_config_vars.items():
-        if k in remote_config_vars:
-            if str(remote_config_vars[k]) == str(v):
-                diff.append((k, v, remote_config_vars[k], '='))
-            else:
-                diff.append((k, v, remote_config_vars[k], '!'))
-        else:
-            diff.append((k, v, None, '+'))
-
-    # that's the local settings done - now for the remote settings.
-    for k, v in remote_config_vars.items():
-        if k not in local_config_vars:
-            diff.append((k, None, v, '?'))
-
+    for k in local_keys & remote_keys:
+        local, remote = local_config_vars[k], remote_config_vars[k]
+        status = '=' if u"%s" % local == u"%s" % remote else '!'
+        diff.append((k, local, remote, status))
+    diff.extend((k, local_config_vars[k], None, '+') for k in local_keys - remote_keys)  # noqa
+    diff.extend((k, None, remote_config_vars[k], '?') for k in remote_keys - local_keys)  # noqa
     return sorted(diff)
 
 
@@ -163,12 +330,19 @@ def set_vars(application, settings):
         settings: a list of 4-tuples as returned from the get_vars function.
             This list will be used to update remote settings to the current
             local value.
+
+    Returns the version of the latest Heroku release once the update has
+    been applied (see heroku.set_config_vars).
+
     """
     # prompt_for_pin(None)
-    # the Heroku config:set command takes a space delimited set of k=v pairs
-    cmd_args = " ".join([("%s=%s" % (s[0], s[1])) for s in settings])
-    command = u"config:set %s" % cmd_args
-    heroku.run_cmd(application, command)
+    # all of the settings are applied in a single API request. Values are
+    # converted as in compare_settings - so a local None is set as the
+    # string "None" (as it always has been), and never removes the var.
+    return heroku.set_config_vars(
+        application,
+        dict((s[0], u"%s" % s[1]) for s in settings)
+    )
 
 
 @click.command(name='config')
@@ -188,11 +362,12 @@ def configure_application(target_environment):
 
     """
     app = AppConfiguration.load(
-        os.path.join(settings.app_conf_dir, '%s.conf' % target_environment)
+        os.path.join(settings.context.app_conf_dir, '%s.conf' % target_environment)
     )
     app_name = app.app_name
-    release = heroku.HerokuRelease.get_latest_deployment(app_name)
-    diff = compare_settings(app.settings, release.get_config_vars())
+    with timing.span(u"config vars", app=app_name):
+        remote_config_vars = heroku.get_config_vars(app_name)
+    diff = compare_settings(app.settings, remote_config_vars)
 
     print u"\nLocal settings (diff shown by '!', '+' indicator):\n"
     print_diff(diff, statuses=['=', '+', '!'])
@@ -212,4 +387,128 @@ def configure_application(target_environment):
     print u""
 
     if utils.prompt_for_pin(""):
-        set_vars(app_name, updates)
+        with timing.span(u"apply", app=app_name, settings=len(updates)):
+            version = set_vars(app_name, updates)
+        print u"Settings applied to '%s' in release v%s." % (app_name, version)
+
+
+def _audit(filename):
+    """Return the (app name, diff, error) for a single conf file.
+
+    Any error loading the conf file, or fetching the config vars, is
+    returned rather than raised, so that one broken app doesn't stop
+    the audit of the others.
+
+    """
+    try:
+        app = AppConfiguration.load(filename)
+        remote_config_vars = heroku.get_config_vars(app.app_name)
+    except (ConfigurationError, heroku.HerokuError) as ex:
+        return None, None, ex
+    except Exception as ex:
+        return None, None, ConfigurationError(
+            u"Error loading %s: %s: %s" % (filename, type(ex).__name__, ex)
+        )
+    return app.app_name, compare_settings(app.settings or {}, remote_config_vars), None  # noqa
+
+
+def audit_config(conf_dir, concurrency=None):
+    """Compare local and remote settings for every app in conf_dir.
+
+    The remote config vars are fetched concurrently, and each conf file
+    is compared using compare_settings.
+
+    Returns a dict mapping each environment name (the conf file name) to
+    a 3-tuple of (app name, diff, error), where error is the exception
+    raised if the conf could not be loaded or compared (in which case
+    app name and diff are None).
+
+    """
+    filenames = sorted(glob.glob(os.path.join(conf_dir, '*.conf')))
+    results = utils.run_concurrently(
+        dict(
+            (os.path.basename(f)[:-len('.conf')], (_audit, (f,)))
+            for f in filenames
+        ),
+        processes=concurrency
+    )
+    return dict((env, result) for env, (result, _) in results.items())
+
+
+def print_audit(audit):
+    """Print the key x app matrix of statuses returned from audit_config.
+
+    Each row is a setting, and each column an environment, with the
+    compare_settings status of the setting in that environment ('=',
+    '!', '+', '?'), or blank if it is not set locally or remotely.
+    Values are never printed, as they may be secret.
+
+    """
+    envs = sorted(env for env in audit if audit[env][2] is None)
+    statuses = dict(
+        (env, dict((d[0], d[3]) for d in audit[env][1])) for env in envs
+    )
+    keys = sorted(set(k for env in envs for k in statuses[env]))
+    width = max([len(k) for k in keys] + [len(u"setting")])
+    print u"%s  %s" % (u"setting".ljust(width), u" ".join(envs))
+    for key in keys:
+        print u"%s  %s" % (
+            key.ljust(width),
+            u" ".join(statuses[env].get(key, u" ").center(len(env)) for env in envs)  # noqa
+        )
+    print u""
+    print u"= same  ! different  + local only  ? remote only"
+    print u""
+    for env in sorted(audit):
+        app_name, diff, error = audit[env]
+        if error is not None:
+            print u"%s: ERROR %s" % (env, error)
+            continue
+        counts = [s for _, _, _, s in diff]
+        print u"%s (%s): %i changed, %i new, %i remote only" % (
+            env, app_name, counts.count('!'), counts.count('+'), counts.count('?')  # noqa
+        )
+
+
+def audit_to_json(audit):
+    """Return the audit_config results as a JSON-serializable dict."""
+    return dict(
+        (
+            env,
+            {
+                'app': app_name,
+                'error': None if error is None else u"%s" % error,
+                'settings': dict((d[0], d[3]) for d in diff or []),
+            }
+        )
+        for env, (app_name, diff, error) in audit.items()
+    )
+
+
+@click.command(name='config-audit')
+@click.option('-j', '--concurrency', default=8, help="Max number of apps to fetch config vars for at once")  # noqa
+@click.option('--json', 'as_json', is_flag=True, help="Output the report as JSON")  # noqa
+def audit_applications(concurrency, as_json):
+    """Report settings drift for every app in the conf directory.
+
+    The remote config vars of every application with a .conf file in the
+    app_conf_dir are fetched concurrently, and compared with the local
+    settings. The result is printed as a matrix of setting x app, using
+    the same '=', '!', '+', '?' statuses as the config command.
+
+    Exits with status 1 if any app has local settings that have not
+    been applied ('!' or '+'), or could not be audited, so that it can
+    be used as a CI check.
+
+    """
+    audit = audit_config(settings.context.app_conf_dir, concurrency)
+    if as_json:
+        print json.dumps(audit_to_json(audit), indent=2, sort_keys=True)
+    else:
+        print_audit(audit)
+    drift = any(
+        error is not None or any(d[3] in ('!', '+') for d in diff)
+        for _, diff, error in audit.values()
+    )
+    if drift:
+        sys.exit(1)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 """Deployment scripts."""
+import glob
 import os
-import subprocess
+import sys
+import time
 
 import click
 import sarge
@@ -11,24 +13,378 @@ from . import (
     git,
     heroku,
     settings,
+    timing,
     utils
 )
+from .tasks import TaskError, parse_tasks, run_tasks
+from .warmup import parse_warmup, print_warmup
 
 
-def run_post_deployment_tasks(tasks):
-    # runs post-deployment tasks -- expects them to specify the heroku app involved as required
-    for task in tasks:
-        subprocess.call(task.split())  # ie, needs to be separated into individual words
-    click.echo("Post-deployment tasks completed")
+def run_post_deployment_tasks(tasks, window=None):
+    """Run the post-deployment tasks (a list of tasks.Task objects).
+
+    Tasks are expected to specify the heroku app involved as required.
+    See the tasks module for details of how they are configured and run.
+
+    Kwargs:
+        window: the MaintenanceWindow to open around tasks that require
+            the maintenance page, if any.
+
+    """
+    run_tasks(tasks, window=window)
+    utils.echo("Post-deployment tasks completed")
+
+
+def format_push(stats):
+    """Return a git.PushStats as e.g. '120 objects, 2.40 MiB in 1.20s'."""
+    return "%i objects, %s in %.2fs" % (
+        stats.objects, utils.format_size(stats.bytes), stats.elapsed
+    )
+
+
+class MaintenanceWindow(object):
+
+    """The period(s) for which an application's maintenance page is up.
+
+    The duration is measured from when the request to put up the page is
+    made, until the response to the request to take it down is received,
+    so it is the longest that users could have seen the page for. If the
+    window is opened more than once, `duration` is the total.
+
+    """
+
+    def __init__(self, application):
+        """Initialise with the name of the Heroku application."""
+        self.application = application
+        self.opened_at = None
+        self.duration = None
+
+    @property
+    def is_open(self):
+        """True if the maintenance page is currently up."""
+        return self.opened_at is not None
+
+    def open(self):
+        """Put up the maintenance page, if it's not already up."""
+        if self.is_open:
+            return
+        utils.echo("Putting up maintenance page")
+        self.opened_at = time.time()
+        heroku.toggle_maintenance(self.application, True)
+
+    def close(self):
+        """Take down the maintenance page, if it's up."""
+        if not self.is_open:
+            return
+        utils.echo("Pulling down maintenance page")
+        heroku.toggle_maintenance(self.application, False)
+        end = time.time()
+        timing.record(
+            u"maintenance window", 'phase', self.opened_at, end,
+            app=self.application
+        )
+        utils.echo(u"Maintenance page was up for %.2fs" % (end - self.opened_at))  # noqa
+        self.duration = (self.duration or 0.0) + end - self.opened_at
+        self.opened_at = None
+
+
+def resolve_environments(patterns, conf_dir):
+    """Return the list of target environments matching a set of patterns.
+
+    Each pattern is either the name of an environment (e.g. 'live'), or
+    a glob that is matched against the names of the .conf files in the
+    conf_dir (e.g. 'eu-*'). Environments are returned in the order in
+    which they are first matched, without duplicates.
+
+    Raises click.BadParameter if a glob pattern matches nothing.
+
+    """
+    environments = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            filenames = sorted(glob.glob(os.path.join(conf_dir, '%s.conf' % pattern)))  # noqa
+            if not filenames:
+                raise click.BadParameter(
+                    u"No environments in %s match '%s'" % (conf_dir, pattern)
+                )
+            matches = [os.path.basename(f)[:-len('.conf')] for f in filenames]
+        else:
+            matches = [pattern]
+        for environment in matches:
+            if environment not in environments:
+                environments.append(environment)
+    return environments
+
+
+class Deployment(object):
+
+    """The plan for deploying a single application, and its execution.
+
+    A Deployment is created by Deployment.plan, which gathers everything
+    required to describe the deployment (releases, commits, files). It
+    can then be printed out for confirmation, and executed.
+
+    """
+
+    def __init__(self, target_environment, app, branch, force):
+        """Initialise with app configuration and deployment options."""
+        self.target_environment = target_environment
+        self.app = app
+        self.branch = branch
+        self.force = force
+        self.tasks = parse_tasks(app.post_deploy_tasks, app.app_name)
+        self.warmup = parse_warmup(app.warmup, app.app_name)
+        self.window = MaintenanceWindow(app.app_name)
+        self.release = None
+        self.push_stats = None
+        self.remote_hash = None
+        self.local_hash = None
+        self.files = []
+        self.commits = []
+        self.timings = {}
+        self.planning_time = 0.0
+
+    @property
+    def app_name(self):
+        """Name of the Heroku application being deployed."""
+        return self.app.app_name
+
+    @property
+    def maintenance_tasks(self):
+        """The names of the tasks that require the maintenance page."""
+        return [t.name for t in self.tasks if t.maintenance]
+
+    @property
+    def up_to_date(self):
+        """True if the application is already running the local commit."""
+        return self.local_hash == self.remote_hash
+
+    @classmethod
+    def plan(cls, target_environment, app, branch=None, force=False, use_cache=True):  # noqa
+        """Gather the contents of the proposed deployment.
+
+        The releases (or branch head) are fetched concurrently, followed
+        by the git range analysis, and the time taken by each call is
+        recorded in the timings attribute. If use_cache is False, then
+        the git range analysis is not read from / written to the cache.
+
+        """
+        branch = branch or app.default_branch or git.get_current_branch()
+        deployment = cls(target_environment, app, branch, force)
+        start = time.time()
+        if app.use_pipeline:
+            # if we are using pipelines, then the commit we need is not the
+            # local one, but the latest version on the upstream app, as this
+            # is the one that will be deployed.
+            local_call = (heroku.HerokuRelease.get_latest_deployment, (app.upstream_app,))  # noqa
+        else:
+            local_call = (git.get_branch_head, (branch,))
+        timings = utils.run_concurrently({
+            'heroku release': (heroku.HerokuRelease.get_latest_deployment, (app.app_name,)),  # noqa
+            'local commit': local_call,
+        })
+        deployment.release = timings['heroku release'][0]
+        deployment.remote_hash = deployment.release.commit
+        if app.use_pipeline:
+            deployment.local_hash = timings['local commit'][0].commit
+        else:
+            deployment.local_hash = timings['local commit'][0]
+
+        if not deployment.up_to_date:
+            range_start = time.time()
+            with timing.span(u"git range", commits=u"%s..%s" % (deployment.remote_hash, deployment.local_hash)):  # noqa
+                analysis = git.get_range(
+                    deployment.remote_hash,
+                    deployment.local_hash,
+                    use_cache=use_cache
+                )
+            timings['git range'] = (analysis, time.time() - range_start)
+            deployment.commits = analysis.commits
+            deployment.files = analysis.files
+
+        deployment.timings = timings
+        deployment.planning_time = time.time() - start
+        return deployment
+
+    def print_plan(self):
+        """Print out the files, commits and options for the deployment."""
+        app = self.app
+        click.echo("")
+        click.echo("Comparing %s..%s" % (self.remote_hash, self.local_hash))
+        click.echo("")
+        click.echo("The following files have changed since the last deployment:\n")  # noqa
+        if len(self.files) == 0:
+            click.echo("  (no change)")
+        else:
+            click.echo("".join(["  * %s\n" % f for f in self.files]))
+        click.echo("")
+        click.echo("The following commits will be included in this deployment:\n")  # noqa
+        if len(self.commits) == 0:
+            click.echo("  (no change)")
+        else:
+            click.echo("".join(["  [%s] %s\n" % (c[0], c[1]) for c in self.commits]))  # noqa
+
+        utils.print_timings(
+            self.timings,
+            title="Deployment information gathered in %.2fs:" % self.planning_time  # noqa
+        )
+
+        # ============== summarise actions ==========================
+        click.echo("")
+        click.echo("Summary of deployment options:")  # noqa
+        click.echo("")
+        click.echo("  ----- Deployment SETTINGS -----------")
+        click.echo("")
+        click.echo("  Git branch:    %s" % self.branch)
+        click.echo("  Target env:    %s (%s)" % (self.target_environment, self.app_name))  # noqa
+        click.echo("  Force push:    %s" % self.force)
+        # pipeline promotion - buildpack won't run
+        click.echo("  Pipeline:      %s" % app.use_pipeline)
+        if app.use_pipeline:
+            click.echo("  Promote:       %s" % app.upstream_app)
+        click.echo("  Release tag:   %s" % app.add_tag)
+        if self.maintenance_tasks:
+            click.echo("  Maintenance:   only during %s" % ", ".join(self.maintenance_tasks))  # noqa
+        if self.warmup is not None:
+            click.echo("  Warm-up:       %s" % self.warmup)
+        click.echo("")
+        click.echo("  ----- Post-deployment commands ------")
+        click.echo("")
+
+        if not self.tasks:
+            click.echo("  (None specified)")
+        else:
+            for task in self.tasks:
+                notes = []
+                # plain commands (named by their command, see
+                # tasks._unique_name) implicitly run after the previous one
+                if task.depends_on and task.name.split(u" #")[0] != task.command:  # noqa
+                    notes.append("after %s" % ", ".join(task.depends_on))
+                if task.maintenance:
+                    notes.append("maintenance")
+                if notes:
+                    click.echo("  %s (%s)" % (task, "; ".join(notes)))
+                else:
+                    click.echo("  %s" % task)
+
+        click.echo("")
+        # ============== / summarise actions ========================
+
+    def execute(self, maintenance):
+        """Run the deployment, and return the new release.
+
+        Args:
+            maintenance: if True, put up the maintenance page - for the
+                duration of the deployment, or, if any post_deploy tasks
+                are flagged as requiring maintenance, only while those
+                tasks run. The time for which the page was up is then
+                in `self.window.duration`.
+
+        """
+        app = self.app
+        app_name = self.app_name
+        window = self.window if maintenance else None
+        if maintenance and not self.maintenance_tasks:
+            with timing.span(u"maintenance on", app=app_name):
+                window.open()
+
+        if app.use_pipeline:
+            utils.echo("Promoting upstream app: %s" % app.upstream_app)
+            with timing.span(u"promote", app=app.upstream_app):
+                heroku.promote_app(app.upstream_app)
+        else:
+            utils.echo("Pushing to git remote")
+            with timing.span(u"push", app=app_name, branch=self.branch) as s:
+                self.push_stats = git.push(
+                    remote=git.get_remote_url(app_name),
+                    local_branch=self.branch,
+                    remote_branch='master',
+                    force=self.force
+                )
+                s.set(objects=self.push_stats.objects, bytes=self.push_stats.bytes)  # noqa
+            utils.echo("Pushed %s" % format_push(self.push_stats))
+
+        utils.echo("Waiting for release of %s" % self.local_hash)
+        try:
+            with timing.span(u"release", app=app_name):
+                release = heroku.wait_for_release(
+                    app_name, self.local_hash, dynos=app.wait_for_dynos
+                )
+        except heroku.HerokuError:
+            # the release failed, or its state is unknown, so it's not safe
+            # to let users back in - as with a failed task, leave the page up.
+            if window is not None and window.is_open:
+                utils.echo("Maintenance page has been left up")
+            raise
+
+        if self.tasks:
+            utils.echo("Running post-deployment tasks:")
+            try:
+                with timing.span(u"post_deploy", app=app_name):
+                    # the window is only handed over if tasks control it,
+                    # otherwise it stays up for the whole deployment.
+                    run_post_deployment_tasks(
+                        self.tasks,
+                        window if self.maintenance_tasks else None
+                    )
+            except TaskError:
+                if window is not None and window.is_open:
+                    utils.echo("Maintenance page has been left up")
+                raise
+
+        if window is not None and window.is_open:
+            with timing.span(u"maintenance off", app=app_name):
+                window.close()
+
+        if self.warmup is not None:
+            utils.echo("Warming up: %s" % self.warmup)
+            start = time.time()
+            with timing.span(u"warmup", app=app_name):
+                results = self.warmup.run()
+            print_warmup(results, time.time() - start)
+
+        if app.add_tag:
+            utils.echo("Applying git tag")
+            message = "Deployed to %s by %s" % (app_name, release.deployed_by)
+            with timing.span(u"tag", tag=release.version):
+                git.apply_tag(commit=self.local_hash, tag=release.version, message=message)  # noqa
+
+        utils.echo(release)
+        return release
+
+
+def _plan(target_environment, config_file, branch, force, use_cache, prefix):
+    """Load app configuration and plan its deployment."""
+    app = config.AppConfiguration.load(
+        config_file or
+        os.path.join(settings.context.app_conf_dir, '%s.conf' % target_environment)  # noqa
+    )
+    with utils.output_prefix(prefix), timing.span(u"plan %s" % target_environment):  # noqa
+        return Deployment.plan(target_environment, app, branch, force, use_cache)
+
+
+def _execute(deployment, maintenance, prefix):
+    """Execute a deployment, returning an (error, elapsed) 2-tuple."""
+    start = time.time()
+    with utils.output_prefix(prefix), timing.span(u"execute %s" % deployment.target_environment):  # noqa
+        try:
+            deployment.execute(maintenance)
+            error = None
+        except Exception as ex:
+            utils.echo(u"Deployment failed: %s" % ex)
+            error = ex
+    return error, time.time() - start
 
 
 @click.command(name='deploy')
-@click.argument('target_environment')
+@click.argument('target_environments', nargs=-1, required=True)
 @click.option('-c', '--config-file', help="Specify application configuration file to use")  # noqa
 @click.option('-b', '--branch', help="Deploy a specific branch")
 @click.option('-f', '--force', is_flag=True, help="Run 'git push' with the '-f' force option")  # noqa
-def deploy_application(target_environment, config_file, branch, force):  # noqa
-    """Deploy a Heroku application.
+@click.option('-j', '--concurrency', default=4, help="Max number of applications to deploy at once")  # noqa
+@click.option('--no-cache', is_flag=True, help="Don't use cached git range analysis")  # noqa
+def deploy_application(target_environments, config_file, branch, force, concurrency, no_cache):  # noqa
+    """Deploy one or more Heroku applications.
 
     Push code via git, run collectstatic if relevant, then run any specific
     post-deployment commands specced in the configuration file, and wrap
@@ -42,77 +398,51 @@ def deploy_application(target_environment, config_file, branch, force):  # noqa
     The function encacsulates a fixed workflow that maps git-flow to
     heroku environments, by pushing specific branches to specific remotes:
 
+    Several environments can be deployed at once, either by listing them,
+    or by using a glob that matches conf file names, e.g. 'eu-*'. They are
+    all planned up front, confirmed with a single PIN, and then deployed
+    concurrently (up to --concurrency at a time).
+
     """
-    # read in and parse configuration
-    app = config.AppConfiguration.load(
-        config_file or
-        os.path.join(settings.app_conf_dir, '%s.conf' % target_environment)
+    environments = resolve_environments(
+        target_environments,
+        settings.context.app_conf_dir
     )
-    app_name = app.app_name
-    branch = branch or app.default_branch or git.get_current_branch()
-
-    # get the contents of the proposed deployment
-    release = heroku.HerokuRelease.get_latest_deployment(app_name)
-
-    remote_hash = release.commit
-    if app.use_pipeline:
-        # if we are using pipelines, then the commit we need is not the
-        # local one, but the latest version on the upstream app, as this
-        # is the one that will be deployed.
-        upstream_release = heroku.HerokuRelease.get_latest_deployment(app.upstream_app)  # noqa
-        local_hash = upstream_release.commit
-    else:
-        local_hash = git.get_branch_head(branch)
-
-    if local_hash == remote_hash:
-        click.echo(u"Heroku application is up-to-date, aborting deployment.")
-        return
-
-    files = git.get_files(remote_hash, local_hash)
-    commits = git.get_commits(remote_hash, local_hash)
-
-    post_deploy_tasks = app.post_deploy_tasks
-
-    click.echo("")
-    click.echo("Comparing %s..%s" % (remote_hash, local_hash))
-    click.echo("")
-    click.echo("The following files have changed since the last deployment:\n")  # noqa
-    if len(files) == 0:
-        click.echo("  (no change)")
-    else:
-        click.echo("".join(["  * %s\n" % f for f in files]))
-    click.echo("")
-    click.echo("The following commits will be included in this deployment:\n")  # noqa
-    if len(commits) == 0:
-        click.echo("  (no change)")
-    else:
-        click.echo("".join(["  [%s] %s\n" % (c[0], c[1]) for c in commits]))
+    if config_file and len(environments) > 1:
+        raise click.BadParameter(
+            u"--config-file can only be used with a single environment."
+        )
 
-    # ============== summarise actions ==========================
-    click.echo("")
-    click.echo("Summary of deployment options:")  # noqa
-    click.echo("")
-    click.echo("  ----- Deployment SETTINGS -----------")
-    click.echo("")
-    click.echo("  Git branch:    %s" % branch)
-    click.echo("  Target env:    %s (%s)" % (target_environment, app_name))
-    click.echo("  Force push:    %s" % force)
-    # pipeline promotion - buildpack won't run
-    click.echo("  Pipeline:      %s" % app.use_pipeline)
-    if app.use_pipeline:
-        click.echo("  Promote:       %s" % app.upstream_app)
-    click.echo("  Release tag:   %s" % app.add_tag)
-    click.echo("")
-    click.echo("  ----- Post-deployment commands ------")
-    click.echo("")
+    # read in and parse configuration, and plan each deployment
+    fleet = len(environments) > 1
+    plans = utils.run_concurrently(
+        dict(
+            (env, (_plan, (env, config_file, branch, force, not no_cache, '[%s] ' % env if fleet else '')))  # noqa
+            for env in environments
+        ),
+        processes=concurrency
+    )
+    deployments = []
+    for env in environments:
+        deployment = plans[env][0]
+        if fleet:
+            click.echo("")
+            click.echo("===== %s (%s) =====" % (env, deployment.app_name))
+        if deployment.up_to_date:
+            click.echo(u"Heroku application is up-to-date, aborting deployment.")  # noqa
+        else:
+            deployment.print_plan()
+            deployments.append(deployment)
 
-    if not post_deploy_tasks:
-        click.echo("  (None specified)")
-    else:
-        [click.echo("  %s" % x) for x in post_deploy_tasks]
+    if not deployments:
+        return
 
-    click.echo("")
-    # ============== / summarise actions ========================
+    if len(deployments) > 1:
+        click.echo("The following applications will be deployed:")
+        click.echo("")
+        for deployment in deployments:
+            click.echo("  %s (%s)" % (deployment.target_environment, deployment.app_name))  # noqa
+        click.echo("")
 
     # put up the maintenance page if required
     maintenance = utils.prompt_for_action(
@@ -123,35 +453,37 @@ def deploy_application(target_environment, config_file, branch, force):  # noqa
     if not utils.prompt_for_pin(""):
         exit(0)
 
-    if maintenance:
-        click.echo("Putting up maintenance page")
-        heroku.toggle_maintenance(app_name, True)
-
-    if app.use_pipeline:
-        click.echo("Promoting upstream app: %s" % app.upstream_app)
-        heroku.promote_app(app.upstream_app)
-    else:
-        click.echo("Pushing to git remote")
-        git.push(
-            remote=git.get_remote_url(app_name),
-            local_branch=branch,
-            remote_branch='master',
-            force=force
-        )
-
-    if post_deploy_tasks:
-        click.echo("Running post-deployment tasks:")
-        run_post_deployment_tasks(post_deploy_tasks)
-
-    if maintenance:
-        click.echo("Pulling down maintenance page")
-        heroku.toggle_maintenance(app_name, False)
-
-    release = heroku.HerokuRelease.get_latest_deployment(app_name)
+    if len(deployments) == 1:
+        with timing.span(u"execute %s" % deployments[0].target_environment):
+            deployments[0].execute(maintenance)
+        click.echo(heroku.get_client())
+        return
 
-    if app.add_tag:
-        click.echo("Applying git tag")
-        message = "Deployed to %s by %s" % (app_name, release.deployed_by)
-        git.apply_tag(commit=local_hash, tag=release.version, message=message)
+    results = utils.run_concurrently(
+        dict(
+            (
+                d.target_environment,
+                (_execute, (d, maintenance, '[%s] ' % d.target_environment))
+            )
+            for d in deployments
+        ),
+        processes=concurrency
+    )
 
-    click.echo(release)
+    click.echo("")
+    click.echo("Deployment summary:")
+    click.echo("")
+    width = max(len(d.target_environment) for d in deployments)
+    for deployment in deployments:
+        env = deployment.target_environment
+        (error, elapsed), _ = results[env]
+        status = "OK" if error is None else "FAILED (%s)" % error
+        if deployment.window.duration is not None:
+            status += " (maintenance %.2fs)" % deployment.window.duration
+        if deployment.push_stats is not None:
+            status += " (pushed %s)" % format_push(deployment.push_stats)
+        click.echo("  %s %6.2fs  %s" % (env.ljust(width), elapsed, status))
+    click.echo("")
+    click.echo(heroku.get_client())
+    if any(results[env][0][0] is not None for env in results):
+        sys.exit(1)
@@ -1,21 +1,60 @@
 # -*- coding: utf-8 -*-
 """Git related commands.
 
-Git module uses the Envoy library to run git commands
-against a git repo as configured in settings.SETTINGS
-with the WORK_DIR and GIT_DIR values.
+Git module uses the sarge library to run git commands
+against a git repo as configured in settings.context
+with the git_work_dir value. Long-running commands (push)
+are streamed through the process module.
 
 """
+import atexit
+import calendar
+import collections
 import os
+import re
+import subprocess
+import threading
+import time
 
 import sarge
 
-from . import settings
+from . import (
+    cache,
+    process,
+    settings,
+    timing,
+    utils
+)
 
-# location of the website git repo directory
-WORK_DIR = settings.git_work_dir
-GIT_DIR = os.path.join(WORK_DIR, '.git')
-GIT_CMD_PREFIX = "git --git-dir=%s --work-tree=%s " % (GIT_DIR, WORK_DIR)
+# the characters of a (lower case) git object hash
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+class GitError(Exception):
+
+    """Error raised when a git command or lookup fails."""
+
+    pass
+
+
+def get_work_dir():
+    """Return the location of the website git repo directory."""
+    return settings.context.git_work_dir
+
+
+def get_git_dir():
+    """Return the location of the website git repo .git directory."""
+    return os.path.join(get_work_dir(), '.git')
+
+
+def get_cmd_prefix():
+    """Return the git command prefix, including --git-dir and --work-tree."""
+    return "git --git-dir=%s --work-tree=%s " % (get_git_dir(), get_work_dir())
+
+
+def get_cmd_args():
+    """Return the git command prefix as a list, for use with subprocess."""
+    return ['git', '--git-dir=%s' % get_git_dir(), '--work-tree=%s' % get_work_dir()]  # noqa
 
 
 def run_git_cmd(command):
@@ -33,84 +72,461 @@ def run_git_cmd(command):
     Returns the output of the command as a string.
 
     """
-    cmd = GIT_CMD_PREFIX + command
-    r = sarge.capture_stdout(cmd)
+    cmd = get_cmd_prefix() + command
+    with timing.span(u"git %s" % command.split()[0], 'git', command=command) as s:  # noqa
+        r = sarge.capture_stdout(cmd)
+        s.set(returncode=r.returncode)
     if r.returncode > 0:
         # git doesn't play nicely so r.stderr is None even though it failed
-        raise Exception(u"Error running git command '%s'" % cmd)
+        raise GitError(u"Error running git command '%s'" % cmd)
     return r.stdout.text
 
 
+class GitWorker(object):
+
+    """Long-lived `git cat-file --batch` process for object lookups.
+
+    Rather than forking a new git process for each ref or object lookup,
+    requests are written to the stdin of a single `cat-file --batch`
+    process, and the responses read back from its stdout. The process
+    is started on first use, and restarted automatically if it dies, or
+    if the repo location changes.
+
+    The worker is thread-safe - requests are serialised over the pipe.
+
+    """
+
+    def __init__(self):
+        """Initialise worker - the git process is not started until used."""
+        self._args = None
+        self._process = None
+        self._lock = threading.Lock()
+
+    def _start(self, args):
+        self._args = args
+        self._process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+
+    def _request(self, ref):
+        """Write ref to the process, and return the response header line."""
+        args = get_cmd_args() + ['cat-file', '--batch']
+        for _ in range(2):
+            if (
+                self._process is None or
+                self._process.poll() is not None or
+                self._args != args
+            ):
+                self.close()
+                self._start(args)
+            try:
+                self._process.stdin.write(ref + '\n')
+                self._process.stdin.flush()
+                line = self._process.stdout.readline()
+            except (IOError, OSError):
+                line = ''
+            if line:
+                return line
+            # the process has died - restart it and try once more.
+            self.close()
+        raise GitError(u"git cat-file process failed reading '%s'" % ref)
+
+    def read_object(self, ref):
+        """Return the (hash, type, content) of the object named by ref.
+
+        Args:
+            ref: anything that git understands as an object name - e.g.
+                a branch, tag, full or abbreviated hash, 'HEAD~1' etc.
+
+        Raises GitError if the ref cannot be resolved.
+
+        """
+        if not ref or len(ref.split()) != 1:
+            raise GitError(u"Invalid git object name '%s'" % ref)
+        with self._lock, timing.span(u"git cat-file", 'git', ref=ref):
+            header = self._request(ref).split()
+            if len(header) != 3:
+                # e.g. "<ref> missing" or "<ref> ambiguous"
+                raise GitError(u"Unable to resolve git object '%s'" % ref)
+            sha, object_type, size = header
+            content = self._process.stdout.read(int(size))
+            # the content is followed by a newline
+            self._process.stdout.read(1)
+        return sha, object_type, content
+
+    def resolve(self, ref):
+        """Return the full hash of the object named by ref."""
+        return self.read_object(ref)[0]
+
+    def close(self):
+        """Stop the git process, if running."""
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+                self._process.wait()
+            except (IOError, OSError):
+                pass
+            self._process = None
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker():
+    """Return the process-wide GitWorker, creating it if required."""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = GitWorker()
+            atexit.register(_worker.close)
+        return _worker
+
+
 def get_remote_url(app_name):
     """Return the git remote address on Heroku."""
     return "git@heroku.com:%s.git" % app_name
 
 
+# the outcome of a push - the number of objects and bytes (of the pack)
+# written, and the time taken to write them.
+PushStats = collections.namedtuple('PushStats', ['objects', 'bytes', 'elapsed'])  # noqa
+
+# a `git push --progress` update, e.g.
+# "Writing objects:  40% (2/5), 1.20 MiB | 2.40 MiB/s"
+PUSH_PROGRESS = re.compile(
+    r'^(?P<phase>[A-Z][a-z]+ objects): +(?P<percent>\d+)% '
+    r'\((?P<done>\d+)/(?P<total>\d+)\)'
+    r'(?:, (?P<size>[\d.]+) (?P<unit>bytes|[KMG]iB))?'
+)
+
+# min number of seconds between echoed progress updates of a phase
+PUSH_PROGRESS_INTERVAL = 1.0
+
+
+class PushProgress(object):
+
+    """Parser for the progress output of `git push --progress`.
+
+    Each line of output is passed to on_line. Progress updates (of which
+    git writes several per second, separated by '\r') are only echoed
+    when a phase completes, or at most once per PUSH_PROGRESS_INTERVAL,
+    along with the objects and bytes written so far, and the throughput.
+    All other output (e.g. 'remote:' build output) is echoed as is.
+
+    The pack written is described by stats() once the push is done.
+
+    """
+
+    def __init__(self):
+        self.objects = 0
+        self.bytes = 0
+        self.started_at = None
+        self.finished_at = None
+        self._echoed_at = {}
+
+    def on_line(self, stream, line):
+        """Handle a line of push output (the process.Process callback)."""
+        match = PUSH_PROGRESS.match(line)
+        if match is None:
+            process.echo_line(line)
+            return
+        now = time.time()
+        phase = match.group('phase')
+        done = line.rstrip().endswith('done.')
+        if phase == 'Writing objects':
+            self.started_at = self.started_at or now
+            self.objects = int(match.group('done'))
+            if match.group('size'):
+                self.bytes = int(float(match.group('size')) * utils.SIZE_UNITS[match.group('unit')])  # noqa
+            if done:
+                self.finished_at = now
+        echoed_at = self._echoed_at.get(phase)
+        if done or echoed_at is None or now - echoed_at >= PUSH_PROGRESS_INTERVAL:  # noqa
+            self._echoed_at[phase] = now
+            if phase == 'Writing objects' and match.group('size'):
+                process.echo_line(
+                    "%s: %s%% (%s/%s), %s | %s/s%s" % (
+                        phase,
+                        match.group('percent'),
+                        match.group('done'),
+                        match.group('total'),
+                        utils.format_size(self.bytes),
+                        utils.format_size(self.bytes / max(now - self.started_at, 0.001)),  # noqa
+                        ", done." if done else ""
+                    )
+                )
+            else:
+                process.echo_line(line)
+
+    def stats(self):
+        """Return the PushStats of the pack written (zero if none was)."""
+        if self.started_at is None:
+            return PushStats(0, 0, 0.0)
+        return PushStats(
+            self.objects,
+            self.bytes,
+            (self.finished_at or time.time()) - self.started_at
+        )
+
+
 def push(remote, local_branch, remote_branch="master", force=False):
-    """Push a branch to a remote repo."""
+    """Push a branch to a remote repo, streaming the output.
+
+    The push is run with --progress, which is parsed (see PushProgress)
+    to report the objects and bytes written, and the throughput, as the
+    push runs.
+
+    Returns the PushStats of the pack pushed.
+
+    """
+    args = get_cmd_args() + ['push', '--progress', remote, '%s:%s' % (local_branch, remote_branch)]  # noqa
     if force:
-        run_git_cmd("push %s %s:%s -f" % (remote, local_branch, remote_branch))
-    else:
-        run_git_cmd("push %s %s:%s" % (remote, local_branch, remote_branch))
+        args.append('-f')
+    progress = PushProgress()
+    r = process.run(args, on_line=progress.on_line, echo=False)
+    if r.returncode > 0:
+        raise GitError(
+            u"Error running git command '%s':\n%s" %
+            (" ".join(args), "\n".join(r.tail))
+        )
+    return progress.stats()
 
 
 def get_current_branch():
-    """Return the current branch name (from GIT_DIR)."""
-    return run_git_cmd("rev-parse --abbrev-ref HEAD")
+    """Return the current branch name (from the git dir).
+
+    This reads the HEAD file directly, rather than forking git. It can't
+    go through the GitWorker, as `cat-file --batch` resolves HEAD to an
+    object, and has no way of returning the symbolic ref it points to.
+
+    Reading the file is safe as HEAD is always a loose file - it is never
+    moved to packed-refs - containing either `ref: refs/heads/<branch>`
+    or, if detached, a full hash. Anything else falls back to forking
+    `git rev-parse --abbrev-ref HEAD`, including:
+
+        * a worktree or submodule, where .git is a file pointing to the
+          real git dir, so .git/HEAD can't be opened.
+        * a symlinked HEAD (from very old versions of git), which would
+          read as the hash of the branch it points to.
+        * any other content (e.g. a ref outside refs/heads).
+
+    As with `rev-parse --abbrev-ref`, this returns 'HEAD' if the HEAD
+    is detached.
+
+    """
+    path = os.path.join(get_git_dir(), 'HEAD')
+    try:
+        if os.path.islink(path):
+            raise IOError(u"Symlinked HEAD: %s" % path)
+        with open(path, 'r') as f:
+            head = f.read().strip()
+    except (IOError, OSError):
+        head = None
+    if head and head.startswith('ref: refs/heads/'):
+        return head[len('ref: refs/heads/'):]
+    if head and len(head) == 40 and HEX_DIGITS.issuperset(head):
+        return 'HEAD'
+    return run_git_cmd("rev-parse --abbrev-ref HEAD").strip()
 
 
 def get_branch_head(branch):
     """Return the hash of the latest commit on a given branch."""
     # cast to str as passing unicode to git commands causes them to fail
-    return run_git_cmd("rev-parse %s" % branch)[:7]
+    return get_worker().resolve(str(branch))[:7]
 
 
 def get_commits(commit_from, commit_to):
-    """Return the oneline format history between two commits.
+    """Return the (hash, subject) history between two commits.
 
-    Args:
-        commit_from: the commit hash of the earlier commit.
-        commit_to: the commit hash of the later commit, defaults to HEAD.
+    A thin wrapper over get_range, kept for backwards compatibility -
+    it returns `get_range(commit_from, commit_to).commits`, a list of
+    2-tuples, most recent first, with merge commits excluded:
 
-    Returns a list of 2-tuples, each containing the commit hash, and the commit
-    message.
+        [
+            ('81a5ea8...', 'Fix for failing tests.'),
+            ('62d49e9...', 'Refactoring of conversations.')
+        ]
 
-    e.g. if the commit log looks like this:
+    """
+    return get_range(commit_from, commit_to).commits
 
-        81a5ea8 Fix for failing tests.
-        62d49e9 Refactoring of conversations.
 
-    The return value is:
+def get_descendants(commit):
+    """Return the full hashes of all commits that include a given commit.
 
-        [
-            ('81a5ea8', 'Fix for failing tests.'),
-            ('62d49e9', Refactoring of conversations.)
-        ]
+    This is the commit itself, and every commit (on any branch) that has
+    it as an ancestor - i.e. every commit that, if deployed, would have
+    deployed it. Raises GitError if the commit is unknown.
 
     """
-    command = "log --oneline --no-merges %s..%s" % (commit_from, commit_to)
-    raw = run_git_cmd(command)
-    lines = raw.lstrip().rstrip().split('\n')
-    # split on the first space - separating commit hash and message
-    return [l.split(' ', 1) for l in lines if l != '']
+    sha = get_worker().resolve(str(commit))
+    raw = run_git_cmd("rev-list --ancestry-path --all --not %s" % sha)
+    return [sha] + raw.split()
 
 
 def get_files(commit_from, commit_to):
-    """Return the names of the files that have changed between two commits.
+    """Return the sorted names of the files changed between two commits.
+
+    A thin wrapper over get_range, kept for backwards compatibility -
+    it returns `get_range(commit_from, commit_to).files`, the union of
+    the files changed by each (non-merge) commit in the range.
+
+    """
+    return get_range(commit_from, commit_to).files
+
+
+# the result of get_range - see its docstring for details
+RangeAnalysis = collections.namedtuple(
+    'RangeAnalysis', ['commits', 'commit_files', 'files']
+)
+
+# marks the start of each commit in the get_range log output
+COMMIT_MARKER = '\x01'
+
+
+def _read_tokens(stream, chunk_size=65536):
+    """Yield the NUL-delimited tokens read from a stream, chunk by chunk."""
+    remainder = ''
+    chunk = stream.read(chunk_size)
+    while chunk:
+        tokens = (remainder + chunk).split('\0')
+        remainder = tokens.pop()
+        for token in tokens:
+            yield token
+        chunk = stream.read(chunk_size)
+    if remainder:
+        yield remainder
+
+
+def get_range_cache():
+    """Return the DiskCache used for get_range results, or None."""
+    if not settings.context.cache_dir:
+        return None
+    return cache.DiskCache(
+        os.path.join(settings.context.cache_dir, 'git'),
+        settings.context.cache_max_size
+    )
+
+
+def _load_range(value):
+    """Convert a cached get_range result back into a RangeAnalysis."""
+    def _str(text):
+        return text.encode('utf-8')
+    return RangeAnalysis(
+        [(_str(h), _str(m)) for h, m in value['commits']],
+        dict(
+            (_str(h), [(_str(s), _str(f)) for s, f in files])
+            for h, files in value['commit_files'].items()
+        ),
+        [_str(f) for f in value['files']]
+    )
+
+
+def get_range(commit_from, commit_to, use_cache=True):
+    """Return the commits and changed files between two commits.
+
+    This runs a single `git log -z --name-status` over the range, and
+    parses its NUL-delimited output as it is read, so it is safe with
+    any characters in commit subjects or filenames, and does not hold
+    the raw output of very long ranges in memory.
+
+    This is a fork rather than a GitWorker request - `cat-file --batch`
+    can only read single objects, so walking the range and diffing each
+    commit's trees through it would take several round trips per commit,
+    where `git log` does it all in one process. The cache key is built
+    from hashes resolved by the worker, so on a cache hit there is no
+    fork at all.
+
+    As the result depends only on the two (immutable) commits, it is
+    cached on disk, keyed on their full hashes, so repeated analysis
+    of the same range - e.g. the same code going to several environments
+    - is served from the cache.
 
     Args:
-        commit_from: the first commit - can be a commit hash or a tag.
-        commit_to: the last commit - can be a commit hash or a tag.
+        commit_from: the commit hash of the earlier commit.
+        commit_to: the commit hash of the later commit.
+
+    Kwargs:
+        use_cache: if False, always run git, and don't cache the result.
 
-    Returns a list of fully qualified filenames.
+    Returns a RangeAnalysis namedtuple, containing:
+
+        commits: a list of (hash, subject) 2-tuples, most recent first.
+        commit_files: a dict mapping each commit hash to the list of
+            (status, filename) 2-tuples changed in that commit, where
+            status is the git --name-status letter ('A', 'M', 'D', 'R'...)
+            - renames and copies have an entry for both filenames.
+        files: the sorted list of all filenames changed in the range
+            (the union over all of the commits - for renames, both the
+            old and new names are included).
+
+    Merge commits are excluded.
 
     """
-    command = "diff --name-only %s..%s" % (commit_from, commit_to)
-    raw = run_git_cmd(command)
-    files = raw.lstrip().rstrip().split('\n')
-    files.sort()
-    # strip empty strings
-    return [f for f in files if f != '']
+    range_cache = get_range_cache() if use_cache else None
+    if range_cache is None:
+        return _analyse_range(commit_from, commit_to)
+    worker = get_worker()
+    key = u"range|%s..%s" % (
+        worker.resolve(commit_from),
+        worker.resolve(commit_to)
+    )
+    cached = range_cache.get(key)
+    if cached is not None:
+        return _load_range(cached)
+    analysis = _analyse_range(commit_from, commit_to)
+    try:
+        range_cache.set(key, analysis._asdict())
+    except UnicodeDecodeError:
+        # the output isn't valid UTF-8, and so can't be stored as JSON.
+        pass
+    return analysis
+
+
+@timing.timed(u"git log", 'git')
+def _analyse_range(commit_from, commit_to):
+    """Run git log over a range - see get_range for details."""
+    args = get_cmd_args() + [
+        'log',
+        '-z',
+        '--no-merges',
+        '--name-status',
+        '--format=%s%%h%%x00%%s' % COMMIT_MARKER,
+        '%s..%s' % (commit_from, commit_to),
+        '--',
+    ]
+    p = subprocess.Popen(args, stdout=subprocess.PIPE)
+    commits = []
+    commit_files = {}
+    files = set()
+    tokens = _read_tokens(p.stdout)
+    current = None
+    for token in tokens:
+        if token.startswith(COMMIT_MARKER):
+            current = token[len(COMMIT_MARKER):]
+            commits.append((current, next(tokens, '')))
+            commit_files[current] = []
+            continue
+        # each file is a status, followed by one filename, or two if the
+        # file was renamed or copied - the status is preceded by a newline
+        # if it's the first file for the commit.
+        status = token.lstrip('\n')
+        if not status:
+            continue
+        filenames = [next(tokens, '')]
+        if status[0] in ('R', 'C'):
+            filenames.append(next(tokens, ''))
+        for filename in filenames:
+            commit_files[current].append((status[0], filename))
+        # for copies, the source file has not changed
+        files.update(filenames[1:] if status[0] == 'C' else filenames)
+    p.stdout.close()
+    if p.wait() > 0:
+        raise GitError(u"Error running git command '%s'" % " ".join(args))
+    return RangeAnalysis(commits, commit_files, sorted(files))
 
 
 def apply_tag(commit, tag, message=None):
@@ -131,3 +547,76 @@ def apply_tag(commit, tag, message=None):
     else:
         command = "tag -a %s -m  '%s' %s" % (tag, message, commit)
     run_git_cmd(command)
+
+
+# an annotated tag to be created by create_tags - tagged_at is a
+# tz-aware datetime (or None for now).
+Tag = collections.namedtuple('Tag', ['name', 'commit', 'message', 'tagged_at'])  # noqa
+
+
+def _utf8(text):
+    """Return text as a utf-8 encoded str."""
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+def _run_with_input(args, data):
+    """Run a git command, writing data to its stdin, and return stdout."""
+    cmd = get_cmd_args() + args
+    with timing.span(u"git %s" % args[0], 'git', command=" ".join(args)) as s:  # noqa
+        p = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        stdout, stderr = p.communicate(data)
+        s.set(returncode=p.returncode)
+    if p.returncode > 0:
+        raise GitError(
+            u"Error running git command '%s':\n%s" %
+            (" ".join(cmd), stderr.decode('utf-8', 'replace'))
+        )
+    return stdout
+
+
+def get_tags():
+    """Return the set of the names of all tags in the repo."""
+    raw = _run_with_input(['for-each-ref', '--format=%(refname)', 'refs/tags'], '')  # noqa
+    return set(ref[len('refs/tags/'):] for ref in raw.splitlines())
+
+
+def create_tags(tags):
+    """Create many annotated tags at once, skipping any that exist already.
+
+    Rather than forking `git tag` for each one, the tag objects are
+    streamed into a single `git fast-import` process, which writes them
+    into one pack, and then creates all of the refs together. The tagger
+    is the user's git identity, with the tagged_at time of each tag.
+
+    Args:
+        tags: a list of Tag objects - commits must be full hashes.
+
+    Returns the list of tags created.
+
+    """
+    existing = get_tags()
+    new = [t for t in tags if t.name not in existing]
+    if not new:
+        return []
+    # "Fred <fred@example.com> 1371564472 +0000" - without the time
+    tagger = _utf8(run_git_cmd("var GIT_COMMITTER_IDENT").strip().rsplit(' ', 2)[0])  # noqa
+    stream = []
+    for tag in new:
+        message = _utf8(tag.message)
+        if not message.endswith('\n'):
+            message += '\n'
+        timestamp = (
+            calendar.timegm(tag.tagged_at.utctimetuple())
+            if tag.tagged_at is not None else int(time.time())
+        )
+        stream.append(
+            "tag %s\nfrom %s\ntagger %s %i +0000\ndata %i\n%s\n" %
+            (_utf8(tag.name), tag.commit, tagger, timestamp, len(message), message)  # noqa
+        )
+    _run_with_input(['fast-import', '--quiet'], "".join(stream))
+    return new
@@ -1,27 +1,67 @@
 # -*- coding: utf-8 -*-
 """Heroku API helper functions.
 
-Heroku module uses the Envoy library to run the Heroku
-Toolbelt CLI commands.
+Heroku module uses the process module to run the Heroku
+Toolbelt CLI commands, and the HerokuClient to call the API.
 
 It also includes the HerokuRelease class, which encapsulates
 the information returned from the API about a specific
 application release.
 
 """
-from dateutil import parser
-from os import getenv
+import collections
+import datetime
+import hashlib
+import os
+import shlex
+import socket
+import ssl
+import threading
+import time
+import urlparse
+from dateutil import parser, tz
 
-import click
 import requests
 import sarge
 
-from . import settings
-
-HEROKU_API_URL_STEM = 'https://api.heroku.com/apps/%s/'
+from . import (
+    cache,
+    process,
+    settings,
+    timing,
+    utils
+)
+
+HEROKU_API_URL = os.getenv('HEROKU_API_URL', 'https://api.heroku.com')
+HEROKU_API_URL_APP = '/apps/%s'
+HEROKU_API_URL_STEM = HEROKU_API_URL_APP + '/'
 HEROKU_API_URL_RELEASES = HEROKU_API_URL_STEM + 'releases'
 HEROKU_API_URL_CONFIG_VARS = HEROKU_API_URL_STEM + 'config-vars'
-HEROKU_API_MAX_RANGE = int(getenv('HEROKU_API_MAX_RANGE', 10))
+HEROKU_API_URL_DYNOS = HEROKU_API_URL_STEM + 'dynos'
+HEROKU_API_URL_DYNO = HEROKU_API_URL_DYNOS + '/%s'
+HEROKU_API_URL_PIPELINE_COUPLING = HEROKU_API_URL_STEM + 'pipeline-couplings'
+HEROKU_API_URL_PIPELINE_COUPLINGS = '/pipelines/%s/pipeline-couplings'
+HEROKU_API_URL_PROMOTIONS = '/pipeline-promotions'
+HEROKU_API_URL_PROMOTION = HEROKU_API_URL_PROMOTIONS + '/%s'
+HEROKU_API_URL_PROMOTION_TARGETS = HEROKU_API_URL_PROMOTION + '/promotion-targets'  # noqa
+HEROKU_API_MAX_RANGE = int(os.getenv('HEROKU_API_MAX_RANGE', 10))
+# max number of seconds to wait for a pipeline promotion to complete
+HEROKU_API_PROMOTION_TIMEOUT = float(os.getenv('HEROKU_API_PROMOTION_TIMEOUT', 600))  # noqa
+# max number of seconds to wait for a pushed / promoted commit to be released
+HEROKU_API_RELEASE_TIMEOUT = float(os.getenv('HEROKU_API_RELEASE_TIMEOUT', 300))  # noqa
+# max number of config vars set in a single PATCH request
+HEROKU_API_CONFIG_VARS_CHUNK_SIZE = int(os.getenv('HEROKU_API_CONFIG_VARS_CHUNK_SIZE', 500))  # noqa
+HEROKU_API_POOL_SIZE = int(os.getenv('HEROKU_API_POOL_SIZE', 10))
+HEROKU_API_CONNECT_TIMEOUT = float(os.getenv('HEROKU_API_CONNECT_TIMEOUT', 5))
+HEROKU_API_READ_TIMEOUT = float(os.getenv('HEROKU_API_READ_TIMEOUT', 30))
+# timeouts (in seconds) for `heroku run` commands - unset means no limit
+HEROKU_RUN_TIMEOUT = float(os.getenv('HEROKU_RUN_TIMEOUT', 0)) or None
+HEROKU_RUN_IDLE_TIMEOUT = float(os.getenv('HEROKU_RUN_IDLE_TIMEOUT', 0)) or None
+# size of one-off dynos - unset means the app's default
+HEROKU_RUN_SIZE = os.getenv('HEROKU_RUN_SIZE')
+# appended to one-off dyno output (as by the CLI) to report the exit status
+HEROKU_RUN_EXIT_STATUS = u'\uFFFF heroku-command-exit-status: '
+UTC = tz.tzutc()
 
 
 class HerokuError(Exception):
@@ -31,17 +71,84 @@ class HerokuError(Exception):
     pass
 
 
+def parse_timestamp(value):
+    """Return the (tz-aware, UTC) datetime of an API timestamp.
+
+    The API always returns timestamps as '2013-06-18T14:07:52Z', which
+    is sliced up directly - this is over 40x faster than dateutil,
+    which is only used for anything not in that format.
+
+    """
+    if len(value) == 20 and value[10] == 'T' and value[19] == 'Z':
+        try:
+            return datetime.datetime(
+                int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                tzinfo=UTC
+            )
+        except ValueError:
+            pass
+    return parser.parse(value)
+
+
+def _bytes(value):
+    """Return API text as a utf-8 encoded str."""
+    return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+
 class HerokuRelease(object):
 
     """Encapsulates a release as described by the Heroku release API.
 
+    The fields used are parsed once, when the release is created, and
+    the raw JSON is not kept - so that long release histories can be
+    processed without re-parsing, or holding on to, the full API
+    responses. Fields missing from the JSON are None.
+
+    Attributes:
+        application: the name of the application.
+        version: the version number (supplied by Heroku) of the release.
+        description: the description supplied by Heroku for the release.
+        commit: the hash of the commit deployed in the release, or
+            'invalid' if the release was not a deployment.
+        status: 'pending', 'succeeded' or 'failed' - releases are
+            'pending' while the release phase command runs.
+        deployed_by: the name of the person responsible for the release.
+        deployed_at: the datetime at which the deployment occurred.
+
     See https://devcenter.heroku.com/articles/platform-api-reference#release
 
     """
 
+    __slots__ = (
+        'application',
+        'version',
+        'description',
+        'commit',
+        'status',
+        'deployed_by',
+        'deployed_at',
+    )
+
     def __init__(self, raw):
         """Initialise new object from raw JSON as return from API."""
-        self._json = raw
+        self.application = (raw.get('app') or {}).get('name')
+        self.version = raw.get('version')
+        self.description = _bytes(raw.get('description') or '')
+        self.status = raw.get('status') or 'succeeded'
+        email = (raw.get('user') or {}).get('email')
+        self.deployed_by = None if email is None else _bytes(email)
+        updated_at = raw.get('updated_at')
+        self.deployed_at = None if updated_at is None else parse_timestamp(updated_at)  # noqa
+        words = self.description.split(' ')
+        if words[0] == 'Promote' and len(words) > 3:
+            # "Promote my-app v123 75c70c5"
+            self.commit = words[3]
+        elif words[0] == 'Deploy' and len(words) > 1:
+            # "Deploy 75c70c5"
+            self.commit = words[1]
+        else:
+            self.commit = "invalid"
 
     def __unicode__(self):
         return (
@@ -58,49 +165,9 @@ class HerokuRelease(object):
     def __str__(self):
         return unicode(self).encode('utf-8')
 
-    @property
-    def application(self):
-        """The name of the application."""
-        return self._json['app']['name']
-
-    @property
-    def commit(self):
-        """The hash of the commit deployed in the release."""
-        if self.description.startswith('Promote'):
-            # "Promote my-app v123 75c70c5"
-            return self.description.split(' ')[3]
-        elif self.description.startswith('Deploy'):
-            # "Deploy 75c70c5"
-            return self.description.split(' ')[1]
-        else:
-            return "invalid"
-
-    @property
-    def deployed_at(self):
-        """The datetime at which the deployment occurred."""
-        return parser.parse(self._json['updated_at'])
-
-    @property
-    def description(self):
-        """The description supplied by Heroku for the release."""
-        return str(self._json['description'])
-
-    @property
-    def version(self):
-        """The version number (supplied by Heroku) of the release."""
-        return self._json['version']
-
-    @property
-    def deployed_by(self):
-        """The name of the person responsible for the release."""
-        return str(self._json['user']['email'])
-
     def get_config_vars(self):
         """Fetch config vars for the app release via API."""
-        return call_api(
-            HEROKU_API_URL_CONFIG_VARS,
-            self.application
-        )
+        return get_config_vars(self.application)
 
     def collectstatic_enabled(self):
         """Return True if collectstatic runs as part of the buildpack.
@@ -118,40 +185,335 @@ class HerokuRelease(object):
     def get_latest_deployment(cls, application):
         """Return the most recent release as HerokuRelease object.
 
+        Releases are read a page at a time (see iter_releases), and
+        the first Deploy or Promote release found is returned - so
+        only as many pages are fetched as are required.
+
         See https://devcenter.heroku.com/articles/platform-api-reference#release  # noqa
         """
-        releases = call_api(
+        for release in iter_releases(application):
+            if release.description.split(' ')[0] in (u'Promote', u'Deploy'):
+                return release
+            else:
+                utils.echo("Ignoring release: %s" % release.description)
+
+        raise HerokuError(u"No deployments found in API response.")
+
+
+def iter_releases(application, order='desc', page_size=None):
+    """Yield all releases for an application as HerokuRelease objects.
+
+    The releases API is paginated using the Range header - each response
+    that has more results to follow includes a Next-Range header, which
+    is sent back as the Range for the next page. Pages are only fetched
+    as the generator is consumed, and only one page is held in memory at
+    a time, so it is safe to use over the full release history.
+
+    Args:
+        application: the name of the Heroku application.
+
+    Kwargs:
+        order: 'desc' (default, most recent first) or 'asc'.
+        page_size: the number of releases to fetch per API call, defaults
+            to HEROKU_API_MAX_RANGE.
+
+    """
+    range_header = 'version;max=%i,order=%s' % (
+        page_size or HEROKU_API_MAX_RANGE, order
+    )
+    while range_header is not None:
+        resp = api_request(
+            'GET',
             HEROKU_API_URL_RELEASES,
             application,
-            range_header='version;max=%i,order=desc' % HEROKU_API_MAX_RANGE
+            headers={'Range': range_header}
         )
+        for release in resp.json():
+            yield HerokuRelease(release)
+        next_range = resp.headers.get('Next-Range')
+        if resp.status_code == 206 and next_range != range_header:
+            range_header = next_range
+        else:
+            range_header = None
+
+
+# record of a single API call, as kept by HerokuClient.calls
+ApiCall = collections.namedtuple(
+    'ApiCall', ['method', 'path', 'status_code', 'elapsed', 'bytes']
+)
+
+
+class HerokuClient(object):
+
+    """Keep-alive HTTP client for the Heroku Platform API.
+
+    All API calls share a single requests.Session, so the TCP+TLS
+    handshake to the API is paid once per process, rather than once
+    per call. The client also records the latency and response size
+    of each call it makes (the most recent are kept in `calls`, and
+    running totals in `count`, `elapsed` and `bytes`).
 
-        for release in releases:
-            description = release.get('description', '').split(' ')[0]
-            if description in (u'Promote', u'Deploy'):
-                return HerokuRelease(release)
+    If a cache is supplied, GET responses that carry an ETag or
+    Last-Modified header are stored in it, keyed on URL and Range, and
+    subsequent requests for the same resource are made conditional
+    (If-None-Match / If-Modified-Since). A 304 response is then served
+    from the cache as though it were the original response.
+
+    """
+
+    def __init__(
+        self,
+        token,
+        base_url=HEROKU_API_URL,
+        pool_size=HEROKU_API_POOL_SIZE,
+        timeout=(HEROKU_API_CONNECT_TIMEOUT, HEROKU_API_READ_TIMEOUT),
+        max_calls=1000,
+        cache=None
+    ):
+        """Initialise session with auth and connection pool.
+
+        Args:
+            token: the Heroku API token used for basic auth.
+
+        Kwargs:
+            base_url: the root URL of the API, without trailing slash.
+            pool_size: the max number of connections kept alive.
+            timeout: (connect, read) timeouts in seconds, as per requests.
+            max_calls: the number of ApiCall records to keep in `calls`.
+            cache: a cache.DiskCache used for conditional GET requests.
+
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = requests.auth.HTTPBasicAuth('', token)
+        self.session.headers.update({
+            'Accept': 'application/vnd.heroku+json; version=3'
+        })
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.calls = collections.deque(maxlen=max_calls)
+        self.count = 0
+        self.elapsed = 0.0
+        self.bytes = 0
+        self.cache = cache
+        # cache keys include a hash of the token, so that responses cached
+        # for one Heroku account are never served to another.
+        self._token_hash = hashlib.sha1(token or '').hexdigest()
+        self._lock = threading.Lock()
+
+    def __unicode__(self):
+        return (
+            u"Heroku API: %i calls, %.2fs, %.1f KB" %
+            (self.count, self.elapsed, self.bytes / 1024.0)
+        )
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def request(self, method, path, headers=None, **kwargs):
+        """Make an API request and return the requests.Response.
+
+        Args:
+            method: the HTTP method, e.g. 'GET', 'PATCH'.
+            path: the path of the resource, e.g. '/apps/foo/releases'.
+
+        Kwargs:
+            headers: dict of extra headers to send with the request.
+            kwargs: passed through to requests.Session.request.
+
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        headers = dict(headers or {})
+        cache_key = cached = None
+        if method == 'GET' and self.cache is not None:
+            cache_key = u"%s|%s|%s" % (self._token_hash, path, headers.get('Range', ''))  # noqa
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                if cached.get('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get('last_modified'):
+                    headers['If-Modified-Since'] = cached['last_modified']
+        start = time.time()
+        resp = self.session.request(
+            method,
+            self.base_url + path,
+            headers=headers,
+            **kwargs
+        )
+        elapsed = time.time() - start
+        size = len(resp.content)
+        timing.record(
+            u"%s %s" % (method, path), 'api', start, start + elapsed,
+            status=resp.status_code, bytes=size
+        )
+        with self._lock:
+            self.calls.append(
+                ApiCall(method, path, resp.status_code, elapsed, size)
+            )
+            self.count += 1
+            self.elapsed += elapsed
+            self.bytes += size
+        if cache_key is None:
+            return resp
+        if resp.status_code == 304 and cached is not None:
+            return self._cached_response(cached, resp.url)
+        if resp.status_code in (200, 206):
+            self._cache_response(cache_key, resp)
+        return resp
+
+    def _cache_response(self, cache_key, resp):
+        """Store a response in the cache, if it supports validation."""
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return
+        self.cache.set(cache_key, {
+            'etag': etag,
+            'last_modified': last_modified,
+            'status_code': resp.status_code,
+            'headers': dict(resp.headers),
+            'content': resp.content.decode('utf-8'),
+        })
+
+    def _cached_response(self, cached, url):
+        """Rebuild a requests.Response from a cache entry."""
+        resp = requests.models.Response()
+        resp.status_code = cached['status_code']
+        resp.headers = requests.structures.CaseInsensitiveDict(
+            cached['headers']
+        )
+        resp._content = cached['content'].encode('utf-8')
+        resp.encoding = 'utf-8'
+        resp.url = url
+        return resp
+
+    def get(self, path, headers=None, **kwargs):
+        """Make an API GET request."""
+        return self.request('GET', path, headers=headers, **kwargs)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide HerokuClient, creating it if required."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            if settings.context.cache_dir:
+                api_cache = cache.DiskCache(
+                    os.path.join(settings.context.cache_dir, 'api'),
+                    settings.context.cache_max_size
+                )
             else:
-                click.echo("Ignoring release: %s" % release.get('description'))
+                api_cache = None
+            _client = HerokuClient(
+                settings.context.heroku_api_token,
+                cache=api_cache
+            )
+        return _client
 
-        raise HerokuError(u"No deployments found in API response.")
+
+def api_request(method, endpoint, application, headers=None, **kwargs):
+    """Call Heroku API and return the requests.Response.
+
+    Args:
+        method: the HTTP method, e.g. 'GET'.
+        endpoint: the API path, with '%s' placeholder for the application.
+        application: the name of the Heroku application (or other id to
+            substitute into the endpoint), or None if it has no placeholder.
+
+    Kwargs:
+        headers: dict of extra headers to send with the request.
+        kwargs: passed through to HerokuClient.request.
+
+    Raises HerokuError if the call fails or returns an error status. If
+    the token is rejected, and was cached in the credentials file, it is
+    removed from the file, so that the next run fetches a new one.
+
+    """
+    path = endpoint if application is None else endpoint % application
+    try:
+        resp = get_client().request(method, path, headers=headers, **kwargs)
+    except Exception as ex:
+        raise HerokuError(u"Error calling Heroku API: %s" % ex)
+    if resp.status_code == 401:
+        filename = settings.context.discard_heroku_api_token()
+        if filename:
+            hint = u"the cached token has been removed from %s, and a new one will be fetched next time" % filename  # noqa
+        else:
+            hint = u"check HEROKU_API_TOKEN, or the heroku_api_token setting"  # noqa
+        raise HerokuError(
+            u"Heroku API token rejected (%s): %s" % (hint, resp.text)
+        )
+    if resp.status_code > 299:
+        raise HerokuError(u"Error calling Heroku API: %s" % resp.text)
+    return resp
 
 
 def call_api(endpoint, application, range_header=None):
     """Call Heroku API and return response.json()."""
-    url = endpoint % application
-    auth = requests.auth.HTTPBasicAuth('', settings.heroku_api_token)
-    headers = {'Accept': 'application/vnd.heroku+json; version=3'}
+    headers = {}
     if range_header is not None:
         headers['Range'] = range_header
+    resp = api_request('GET', endpoint, application, headers=headers)
     try:
-        resp = requests.get(url, auth=auth, headers=headers)
-        if resp.status_code > 299:
-            raise HerokuError(resp.text)
         return resp.json()
     except Exception as ex:
         raise HerokuError(u"Error calling Heroku API: %s" % ex)
 
 
+def get_config_vars(application):
+    """Fetch the current config vars for an application via API."""
+    return call_api(HEROKU_API_URL_CONFIG_VARS, application)
+
+
+def set_config_vars(application, config_vars, chunk_size=None):
+    """Set config vars on an application via the API.
+
+    The vars are applied with a single PATCH request, which Heroku applies
+    atomically, as a single new release. Very large updates are split into
+    chunks of HEROKU_API_CONFIG_VARS_CHUNK_SIZE vars, each of which is a
+    separate request (and release).
+
+    Args:
+        application: the name of the Heroku application.
+        config_vars: dict of var names to values - values are converted
+            to strings, except for None, which removes the var.
+
+    Kwargs:
+        chunk_size: max number of vars per request, defaults to
+            HEROKU_API_CONFIG_VARS_CHUNK_SIZE.
+
+    Returns the version number of the latest release once applied. The
+    PATCH response doesn't identify the release it created, so this is
+    read from the releases API afterwards - if another release of the
+    app is created at the same time, its version may be returned. If the
+    vars are applied in chunks, it is the release of the last chunk.
+
+    """
+    chunk_size = chunk_size or HEROKU_API_CONFIG_VARS_CHUNK_SIZE
+    items = sorted(
+        (k, None if v is None else u"%s" % v)
+        for k, v in config_vars.items()
+    )
+    for i in range(0, len(items), chunk_size):
+        api_request(
+            'PATCH',
+            HEROKU_API_URL_CONFIG_VARS,
+            application,
+            json=dict(items[i:i + chunk_size])
+        )
+    for release in iter_releases(application, page_size=1):
+        return release.version
+
+
 def get_auth_token():
     """Use the heroku auth:token command to fetch the user's API token.
 
@@ -169,39 +531,383 @@ def get_auth_token():
         )
 
 
-def run_cmd(application, command):
-    """Run a Heroku Toolbelt command and return output."""
+def run_cmd(application, command, timeout=None, idle_timeout=None):
+    """Run a Heroku Toolbelt command, streaming its output.
+
+    Kwargs:
+        timeout: max number of seconds the command may run for.
+        idle_timeout: max number of seconds without any output.
+
+    Raises HerokuError if the command fails or times out, including the
+    tail of its output.
+
+    """
     cmd = "heroku %s --app %s" % (command, application)
-    r = _async(cmd)
+    r = _async(cmd, timeout=timeout, idle_timeout=idle_timeout)
+    if r.timed_out is not None:
+        raise HerokuError(
+            u"Heroku command '%s' timed out (%s):\n%s"
+            % (cmd, r.timed_out, "\n".join(r.tail))
+        )
     if r.returncode > 0:
         raise HerokuError(
-            u"Error running Heroku command '%s': %s"
-            % (cmd, r.stderr)
+            u"Error running Heroku command '%s':\n%s"
+            % (cmd, "\n".join(r.tail))
         )
 
 
-def run_command(application, command):
-    """Run a command against a Heroku application."""
-    run_cmd(application, "run %s" % command)
+class OneOffDyno(process.Process):
 
+    """A command run in a one-off dyno, with its output streamed as it runs.
 
-def toggle_maintenance(application, maintenance_on):
-    """Toggle the Heroku maintenance feature on/off."""
-    on_off = "on" if maintenance_on else "off"
-    run_cmd(application, "maintenance:%s" % on_off)
+    This is the equivalent of `heroku run`, without starting the CLI. The
+    dyno is created via the API, and its output is read from the
+    rendezvous socket it is attached to. As with the CLI, the command is
+    suffixed with an echo of its exit status, which is parsed out of the
+    output to set the returncode.
+
+    Output is handled as by process.Process - only the tail is kept, and
+    the wall-clock and idle timeouts are enforced, in which case the dyno
+    is stopped. Each instance has its own socket, so several one-off dynos
+    can be run concurrently (from separate threads).
+
+    """
+
+    def __init__(self, application, command, size=HEROKU_RUN_SIZE, **kwargs):
+        """Initialise dyno - it is not created until start().
+
+        Args:
+            application: the name of the Heroku application.
+            command: the command to run in the dyno.
+
+        Kwargs:
+            size: the dyno size, defaults to the app's default size.
+
+        All other kwargs are as for process.Process.
 
+        """
+        super(OneOffDyno, self).__init__(command, **kwargs)
+        self.application = application
+        self.command = command
+        self.size = size
+        self.dyno = None
+        self._socket = None
+
+    def start(self):
+        """Create the dyno, and connect to its output."""
+        self._start = time.time()
+        data = {
+            'command': u'%s; echo "%s$?"' % (self.command, HEROKU_RUN_EXIT_STATUS),  # noqa
+            'attach': True,
+            'type': 'run',
+        }
+        if self.size:
+            data['size'] = self.size
+        self.dyno = api_request(
+            'POST', HEROKU_API_URL_DYNOS, self.application, json=data
+        ).json()
+        self._socket = _rendezvous_connect(self.dyno['attach_url'])
+        return self
+
+    def kill(self):
+        """Disconnect, and stop the dyno, if it's still running."""
+        with self._lock:
+            if self._socket is None or self._killed_at is not None:
+                return
+            self._killed_at = time.time()
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        try:
+            api_request(
+                'DELETE',
+                HEROKU_API_URL_DYNO,
+                (self.application, self.dyno['name'])
+            )
+        except HerokuError as ex:
+            utils.echo(u"Unable to stop dyno %s: %s" % (self.dyno['name'], ex))
+
+    def wait(self):
+        """Stream the output until the dyno exits, and return the result.
 
-def promote_app(application):
-    """Run the Heroku pipeline promote command."""
-    run_cmd(application, "pipelines:promote")
+        Returns a process.ProcessResult - the returncode is None if the
+        exit status was not received (e.g. the dyno was killed).
 
+        """
+        marker = HEROKU_RUN_EXIT_STATUS.encode('utf-8')
+        returncode = None
+        buffer = ''
+        handshake = True
+        last_output = time.time()
+        while True:
+            now = time.time()
+            deadline = self._deadline(now, last_output)
+            if deadline is not None and deadline <= 0:
+                if self._killed_at is not None:
+                    break
+                if (
+                    self.timeout is not None and
+                    now - self._start >= self.timeout
+                ):
+                    self.timed_out = 'wall'
+                else:
+                    self.timed_out = 'idle'
+                self.kill()
+                continue
+            try:
+                self._socket.settimeout(deadline)
+                chunk = self._socket.recv(65536)
+            except socket.timeout:
+                continue
+            except Exception:
+                # a socket shut down by kill() may raise anything here
+                if self._killed_at is None:
+                    raise
+                break
+            if not chunk:
+                if buffer:
+                    self._line('stdout', buffer)
+                break
+            last_output = time.time()
+            lines, buffer = process.split_lines(buffer, chunk)
+            for line in lines:
+                if handshake:
+                    # the rendezvous service greets us before any output
+                    handshake = False
+                    if line == 'rendezvous':
+                        continue
+                if marker in line:
+                    before, _, status = line.partition(marker)
+                    if before:
+                        self._line('stdout', before)
+                    try:
+                        returncode = int(status.strip())
+                    except ValueError:
+                        pass
+                    continue
+                self._line('stdout', line)
+        self._socket.close()
+        end = time.time()
+        timing.record(
+            u"dyno %s" % self.application, 'dyno', self._start, end,
+            command=self.command, returncode=returncode,
+            timed_out=self.timed_out
+        )
+        return process.ProcessResult(
+            returncode,
+            end - self._start,
+            list(self.tail),
+            self.timed_out
+        )
+
+
+def _rendezvous_connect(attach_url):
+    """Connect to a dyno's rendezvous URL, and return the TLS socket.
+
+    The URL is of the form rendezvous://host:port/secret - the secret is
+    sent once connected, to attach to the dyno.
+
+    """
+    url = urlparse.urlparse(attach_url)
+    sock = socket.create_connection(
+        (url.hostname, url.port or 5000),
+        HEROKU_API_CONNECT_TIMEOUT
+    )
+    sock = ssl.create_default_context().wrap_socket(
+        sock,
+        server_hostname=url.hostname
+    )
+    sock.sendall(url.path.lstrip('/') + '\r\n')
+    return sock
 
-def _async(cmd):
-    """Run bash command async."""
-    r = sarge.run(cmd, stdout=sarge.Capture(), async=True)
-    r.close()
-    line = r.stdout.readline()
-    while line != '':
-        click.echo(line.strip())
-        line = r.stdout.readline()
+
+def run_command(application, command, timeout=HEROKU_RUN_TIMEOUT, idle_timeout=HEROKU_RUN_IDLE_TIMEOUT):  # noqa
+    """Run a command in a one-off dyno, and return the ProcessResult.
+
+    Raises HerokuError if the command exits with a non-zero status (or
+    its status is unknown), or times out, including the tail of its output.
+
+    """
+    r = OneOffDyno(
+        application,
+        command,
+        timeout=timeout,
+        idle_timeout=idle_timeout
+    ).start().wait()
+    if r.timed_out is not None:
+        raise HerokuError(
+            u"Command '%s' on %s timed out (%s):\n%s"
+            % (command, application, r.timed_out, "\n".join(r.tail))
+        )
+    if r.returncode != 0:
+        raise HerokuError(
+            u"Command '%s' on %s exited with status %s:\n%s"
+            % (command, application, r.returncode, "\n".join(r.tail))
+        )
     return r
+
+
+def toggle_maintenance(application, maintenance_on):
+    """Toggle the Heroku maintenance feature on/off via the API."""
+    api_request(
+        'PATCH',
+        HEROKU_API_URL_APP,
+        application,
+        json={'maintenance': bool(maintenance_on)}
+    )
+
+
+# pipeline stages, in the order in which apps are promoted through them
+PIPELINE_STAGES = ('review', 'development', 'staging', 'production')
+
+
+def get_promotion_targets(application):
+    """Return the (pipeline id, source app id, target app ids) for a promotion.
+
+    As with `heroku pipelines:promote`, the targets are all of the apps in
+    the pipeline stage that follows the application's own stage.
+
+    Raises HerokuError if the application is not in a pipeline, or there
+    are no apps downstream of it.
+
+    """
+    coupling = call_api(HEROKU_API_URL_PIPELINE_COUPLING, application)
+    pipeline_id = coupling['pipeline']['id']
+    stage = coupling['stage']
+    if stage not in PIPELINE_STAGES[:-1]:
+        raise HerokuError(
+            u"Unable to promote '%s' from the %s stage." % (application, stage)
+        )
+    next_stage = PIPELINE_STAGES[PIPELINE_STAGES.index(stage) + 1]
+    targets = [
+        c['app']['id']
+        for c in call_api(HEROKU_API_URL_PIPELINE_COUPLINGS, pipeline_id)
+        if c['stage'] == next_stage
+    ]
+    if not targets:
+        raise HerokuError(
+            u"No %s apps in the pipeline to promote '%s' to." %
+            (next_stage, application)
+        )
+    return pipeline_id, coupling['app']['id'], targets
+
+
+def promote_app(application, timeout=None):
+    """Promote an application to the next stage of its pipeline via the API.
+
+    This creates a pipeline promotion, and then polls its status until
+    it is complete (backing off up to 5s between polls).
+
+    Kwargs:
+        timeout: max number of seconds to wait for the promotion to
+            complete, defaults to HEROKU_API_PROMOTION_TIMEOUT.
+
+    Raises HerokuError if the promotion to any target app fails, or it
+    does not complete within the timeout.
+
+    """
+    pipeline_id, app_id, targets = get_promotion_targets(application)
+    promotion = api_request(
+        'POST',
+        HEROKU_API_URL_PROMOTIONS,
+        None,
+        json={
+            'pipeline': {'id': pipeline_id},
+            'source': {'app': {'id': app_id}},
+            'targets': [{'app': {'id': t}} for t in targets],
+        }
+    ).json()
+
+    def completed():
+        status = call_api(HEROKU_API_URL_PROMOTION, promotion['id'])['status']
+        return status if status != 'pending' else None
+
+    status = utils.poll(completed, timeout or HEROKU_API_PROMOTION_TIMEOUT)
+    if status is None:
+        raise HerokuError(
+            u"Timed out waiting for promotion of '%s' to complete." % application
+        )
+    failures = [
+        u"%s: %s" % (t['app']['id'], t.get('error_message'))
+        for t in call_api(HEROKU_API_URL_PROMOTION_TARGETS, promotion['id'])
+        if t['status'] != 'succeeded'
+    ]
+    if failures:
+        raise HerokuError(
+            u"Promotion of '%s' failed: %s" % (application, u"; ".join(failures))
+        )
+
+
+def _dynos_released(application, version):
+    """Return True if all of an app's dynos are up and running version.
+
+    One-off (`heroku run`) dynos are ignored.
+
+    """
+    return all(
+        dyno['state'] == 'up' and dyno['release']['version'] >= version
+        for dyno in call_api(HEROKU_API_URL_DYNOS, application)
+        if dyno['type'] != 'run'
+    )
+
+
+def wait_for_release(application, commit, timeout=None, dynos=False):
+    """Wait for a commit to be released to an app, and return the release.
+
+    After a push (or promotion) returns, Heroku may still be creating
+    the release (or running its release phase), so the latest release
+    is polled (backing off up to 5s between polls) until it is the
+    release of commit, and has succeeded. If dynos is True, then the
+    app's dynos are also polled until they have all restarted on the
+    new release.
+
+    The releases are requested with the same Range header on each poll,
+    so if the API cache is enabled these are conditional requests, and
+    an unchanged release list costs a 304.
+
+    Args:
+        application: the name of the Heroku application.
+        commit: the hash (full or abbreviated) of the commit deployed.
+
+    Kwargs:
+        timeout: max number of seconds to wait, defaults to
+            HEROKU_API_RELEASE_TIMEOUT.
+        dynos: if True, also wait for the dynos to be up on the release.
+
+    Raises HerokuError if the release fails, or the commit is not
+    released within the timeout.
+
+    """
+    range_header = 'version;max=%i,order=desc' % HEROKU_API_MAX_RANGE
+
+    def released():
+        for raw in call_api(HEROKU_API_URL_RELEASES, application, range_header):  # noqa
+            release = HerokuRelease(raw)
+            if release.commit == 'invalid':
+                # config var changes etc. - look for the latest deployment
+                continue
+            if release.commit[:7] != commit[:7]:
+                # the previous deployment is still the latest
+                return None
+            if release.status == 'failed':
+                raise HerokuError(u"Release of %s failed: %s" % (commit, release))  # noqa
+            if release.status != 'succeeded':
+                return None
+            if dynos and not _dynos_released(application, release.version):
+                return None
+            return release
+        return None
+
+    with timing.span(u"wait for release", 'api', app=application):
+        release = utils.poll(released, timeout or HEROKU_API_RELEASE_TIMEOUT)
+    if release is None:
+        raise HerokuError(
+            u"Timed out waiting for release of %s to '%s'." % (commit, application)  # noqa
+        )
+    return release
+
+
+def _async(cmd, **kwargs):
+    """Run command, streaming output, and return the ProcessResult."""
+    return process.run(shlex.split(cmd), **kwargs)
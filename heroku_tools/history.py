@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""Local store of Heroku application release history.
+
+Releases are fetched from the API by the `sync` command, and stored in
+a SQLite database (the `history_db` setting), indexed by version, commit
+and deployment time, so that questions about past deployments can be
+answered without paging through the releases API:
+
+    $ heroku-tools sync                   # all apps in app_conf_dir
+    $ heroku-tools history live --since 2016-09-01
+    $ heroku-tools which-release 75c70c5
+    $ heroku-tools deploy-stats --since 2016-01-01
+    $ heroku-tools tag-backfill live --prefix live-
+
+Syncing is incremental - releases are fetched newest first, and the
+sync stops at the highest version already in the store, so after the
+first sync of an app only new releases are fetched.
+
+"""
+import collections
+import datetime
+import os
+import sqlite3
+import threading
+
+import click
+from dateutil import parser, tz
+
+from . import (
+    config,
+    git,
+    heroku,
+    settings,
+    utils
+)
+from .deploy import resolve_environments
+
+# number of releases fetched per API call when syncing
+SYNC_PAGE_SIZE = int(os.getenv('HEROKU_TOOLS_SYNC_PAGE_SIZE', 200))
+
+# format in which deployment times are stored - as UTC, so that they
+# sort (and can be compared) as strings.
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS releases (
+    app TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    commit_hash TEXT,
+    description TEXT,
+    deployed_by TEXT,
+    deployed_at TEXT NOT NULL,
+    PRIMARY KEY (app, version)
+);
+CREATE INDEX IF NOT EXISTS releases_commit ON releases (commit_hash);
+CREATE INDEX IF NOT EXISTS releases_deployed_at ON releases (app, deployed_at);
+"""
+
+# a release as read back from the store - commit is None if the release
+# was not a deployment (e.g. a config change).
+StoredRelease = collections.namedtuple(
+    'StoredRelease',
+    ['app', 'version', 'commit', 'description', 'deployed_by', 'deployed_at']
+)
+
+# deployment frequency of a single app, as returned by ReleaseStore.stats
+DeployStats = collections.namedtuple(
+    'DeployStats',
+    ['app', 'deploys', 'per_week', 'median_interval', 'last_deployed_at']
+)
+
+
+def _text(value):
+    """Return a HerokuRelease (utf-8 str) field as unicode, for sqlite3.
+
+    Python 2's sqlite3 refuses non-ASCII byte strings.
+
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def format_timestamp(value):
+    """Return a datetime as a UTC timestamp string, as stored.
+
+    Naive datetimes are assumed to be UTC already.
+
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(tz.tzutc()).replace(tzinfo=None)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def parse_timestamp(value):
+    """Return the (naive, UTC) datetime from a stored timestamp string."""
+    return datetime.datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+class ReleaseStore(object):
+
+    """SQLite store of application releases.
+
+    The store is safe to use from multiple threads (e.g. when syncing
+    several apps concurrently) - access to the connection is serialised.
+
+    """
+
+    def __init__(self, path):
+        """Initialise store, creating the database if it doesn't exist.
+
+        Args:
+            path: the path to the SQLite database file, or ':memory:'.
+
+        """
+        if path != ':memory:':
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname, 0o700)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database connection."""
+        self._db.close()
+
+    def _query(self, sql, params=()):
+        """Return all rows of a query as StoredRelease objects."""
+        with self._lock:
+            return [StoredRelease(*row) for row in self._db.execute(sql, params)]  # noqa
+
+    def max_version(self, application):
+        """Return the highest version stored for an app, or 0 if none."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MAX(version) FROM releases WHERE app = ?",
+                (application,)
+            ).fetchone()
+        return row[0] or 0
+
+    def add(self, releases):
+        """Store a sequence of HerokuRelease objects, in a single transaction.
+
+        Releases without a deployment time can't be indexed, and so are
+        skipped. Returns the number of releases added.
+
+        """
+        rows = [
+            (
+                _text(r.application),
+                r.version,
+                None if r.commit == 'invalid' else _text(r.commit[:7]),
+                _text(r.description),
+                _text(r.deployed_by),
+                format_timestamp(r.deployed_at),
+            )
+            for r in releases if r.deployed_at is not None
+        ]
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO releases VALUES (?, ?, ?, ?, ?, ?)",  # noqa
+                    rows
+                )
+        return len(rows)
+
+    def releases(self, application, since=None):
+        """Return the releases of an app, most recent first.
+
+        Kwargs:
+            since: if set, a datetime - only releases deployed at or after
+                this are returned.
+
+        """
+        return self._query(
+            "SELECT * FROM releases WHERE app = ? AND deployed_at >= ? "
+            "ORDER BY version DESC",
+            (application, format_timestamp(since) if since else '')
+        )
+
+    def find_commits(self, commits):
+        """Return releases that deployed any of a list of commits.
+
+        Commits may be full or abbreviated hashes - as Heroku records
+        the abbreviated hash of each deployment, commits are stored, and
+        matched, on their first 7 characters.
+
+        Returns the releases ordered by app, then version.
+
+        """
+        prefixes = sorted(set(c[:7] for c in commits))
+        matches = []
+        # keep within SQLite's limit on the number of query parameters
+        for i in range(0, len(prefixes), 500):
+            chunk = prefixes[i:i + 500]
+            matches.extend(self._query(
+                "SELECT * FROM releases WHERE commit_hash IN (%s)" %
+                ", ".join("?" * len(chunk)),
+                chunk
+            ))
+        return sorted(matches)
+
+    def stats(self, since=None):
+        """Return the DeployStats of each app in the store.
+
+        Only releases that were deployments (i.e. have a commit) are
+        counted. The per week rate is over the period from `since` (or
+        the first deployment) to now.
+
+        """
+        now = datetime.datetime.utcnow()
+        deployed_at = collections.defaultdict(list)
+        for release in self._query(
+            "SELECT * FROM releases WHERE commit_hash IS NOT NULL "
+            "AND deployed_at >= ? ORDER BY app, deployed_at",
+            (format_timestamp(since) if since else '',)
+        ):
+            deployed_at[release.app].append(parse_timestamp(release.deployed_at))  # noqa
+        stats = []
+        for app, times in sorted(deployed_at.items()):
+            start = parse_timestamp(format_timestamp(since)) if since else times[0]  # noqa
+            weeks = max((now - start).total_seconds() / (7 * 86400), 1.0 / 7)
+            intervals = sorted(b - a for a, b in zip(times, times[1:]))
+            stats.append(DeployStats(
+                app,
+                len(times),
+                len(times) / weeks,
+                intervals[len(intervals) // 2] if intervals else None,
+                times[-1]
+            ))
+        return stats
+
+
+def get_store():
+    """Return a ReleaseStore for the history_db setting."""
+    return ReleaseStore(settings.context.history_db)
+
+
+def sync(store, application, page_size=SYNC_PAGE_SIZE):
+    """Fetch new releases of an app from the API into the store.
+
+    Releases are fetched most recent first, and fetching stops as soon
+    as a release that is already in the store is reached - so only the
+    pages that contain new releases are requested.
+
+    Returns the list of new releases (most recent first).
+
+    """
+    latest = store.max_version(application)
+    releases = []
+    for release in heroku.iter_releases(application, page_size=page_size):
+        if release.version <= latest:
+            break
+        releases.append(release)
+    store.add(releases)
+    return releases
+
+
+def _app_name(environment):
+    """Return the Heroku application name for an environment."""
+    return config.AppConfiguration.load(
+        os.path.join(settings.context.app_conf_dir, '%s.conf' % environment)
+    ).app_name
+
+
+def _all_environments():
+    """Return the names of all environments in the app_conf_dir."""
+    return resolve_environments(['*'], settings.context.app_conf_dir)
+
+
+def _since(value):
+    """Parse the --since option into a datetime (None if not set)."""
+    return parser.parse(value) if value else None
+
+
+@click.command(name='sync')
+@click.argument('target_environments', nargs=-1)
+@click.option('-j', '--concurrency', default=4, help="Max number of apps to sync at once")  # noqa
+def sync_history(target_environments, concurrency):
+    """Fetch new releases into the local release history.
+
+    Syncs the named environments (or globs of conf file names), or all of
+    the environments in the app_conf_dir if none are given.
+
+    """
+    environments = (
+        resolve_environments(target_environments, settings.context.app_conf_dir)  # noqa
+        if target_environments else _all_environments()
+    )
+    apps = dict((env, _app_name(env)) for env in environments)
+    store = get_store()
+    try:
+        results = utils.run_concurrently(
+            dict((env, (sync, (store, apps[env]))) for env in environments),
+            processes=concurrency
+        )
+    finally:
+        store.close()
+    for env in environments:
+        releases, elapsed = results[env]
+        if releases:
+            utils.echo(
+                u"%s (%s): %i new releases (v%s..v%s) in %.2fs" % (
+                    env, apps[env], len(releases),
+                    releases[-1].version, releases[0].version, elapsed
+                )
+            )
+        else:
+            utils.echo(u"%s (%s): up-to-date" % (env, apps[env]))
+
+
+@click.command(name='history')
+@click.argument('target_environment')
+@click.option('--since', help="Only show releases since this date")
+@click.option('--deploys-only', is_flag=True, help="Only show deployments (not config changes etc.)")  # noqa
+def print_history(target_environment, since, deploys_only):
+    """Print the release history of an application from the local store."""
+    store = get_store()
+    try:
+        releases = store.releases(_app_name(target_environment), _since(since))
+    finally:
+        store.close()
+    for r in releases:
+        if deploys_only and r.commit is None:
+            continue
+        click.echo(u"v%-6s %s  %-7s  %s  %s" % (
+            r.version, r.deployed_at, r.commit or u"", r.deployed_by, r.description  # noqa
+        ))
+
+
+@click.command(name='which-release')
+@click.argument('commit')
+def which_release(commit):
+    """Show the first release of each app that included a commit.
+
+    If the commit is in the local git repo, then releases of any later
+    commit that includes it are also matched; otherwise only releases of
+    the commit itself are found.
+
+    """
+    try:
+        commits = git.get_descendants(commit)
+    except git.GitError:
+        commits = [commit]
+    store = get_store()
+    try:
+        releases = store.find_commits(commits)
+    finally:
+        store.close()
+    first = collections.OrderedDict()
+    for release in releases:
+        first.setdefault(release.app, release)
+    if not first:
+        click.echo(u"No release of %s found in the release history." % commit)
+        return
+    for r in first.values():
+        click.echo(u"%s: v%s at %s by %s (deployed %s)" % (
+            r.app, r.version, r.deployed_at, r.deployed_by, r.commit
+        ))
+
+
+@click.command(name='deploy-stats')
+@click.option('--since', help="Only count deployments since this date")
+def deploy_stats(since):
+    """Print deployment frequency of each app in the local store."""
+    store = get_store()
+    try:
+        stats = store.stats(_since(since))
+    finally:
+        store.close()
+    if not stats:
+        click.echo(u"No deployments in the release history.")
+        return
+    width = max(len(s.app) for s in stats)
+    click.echo(u"%s  deploys  per week  median interval  last deployed" % u"app".ljust(width))  # noqa
+    for s in stats:
+        click.echo(u"%s  %7i  %8.1f  %15s  %s" % (
+            s.app.ljust(width),
+            s.deploys,
+            s.per_week,
+            s.median_interval or u"-",
+            s.last_deployed_at.strftime(TIMESTAMP_FORMAT)
+        ))
+
+
+@click.command(name='tag-backfill')
+@click.argument('target_environment')
+@click.option('--prefix', default='', help="Prefix of the tag names, e.g. 'live-'")  # noqa
+def tag_backfill(target_environment, prefix):
+    """Tag the commit of every past deployment of an application.
+
+    Walks the releases of the application (via the API), and creates an
+    annotated tag, named for the release version (as with add_tag), on
+    the commit of each deployment. Tags that already exist are skipped,
+    as are commits that are not in the local repo. All the tags are
+    created in a single git operation.
+
+    """
+    app_name = _app_name(target_environment)
+    worker = git.get_worker()
+    tags = []
+    missing = []
+    for release in heroku.iter_releases(app_name, order='asc', page_size=SYNC_PAGE_SIZE):  # noqa
+        if release.commit == 'invalid':
+            continue
+        try:
+            sha, object_type, _ = worker.read_object(release.commit)
+        except git.GitError:
+            sha, object_type = None, None
+        if object_type != 'commit':
+            missing.append(release)
+            continue
+        tags.append(git.Tag(
+            u"%s%s" % (prefix, release.version),
+            sha,
+            u"Deployed to %s by %s" % (app_name, release.deployed_by),
+            release.deployed_at
+        ))
+    created = git.create_tags(tags)
+    for release in missing:
+        utils.echo(u"Skipping v%s: commit %s not found" % (release.version, release.commit))  # noqa
+    utils.echo(
+        u"%s (%s): created %i tags, %i already existed, %i commits not found" %  # noqa
+        (target_environment, app_name, len(created), len(tags) - len(created), len(missing))  # noqa
+    )
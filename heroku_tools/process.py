@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""Streaming execution of external commands.
+
+All long-running commands (`heroku ...`, `git push`, post-deploy tasks)
+are run through this module, which reads stdout and stderr as they are
+written, without blocking on either, and echoes each line prefixed with
+a timestamp.
+
+Only a fixed-size tail of the output is retained (for use in error
+messages), so memory use is constant however much a command outputs,
+and both a wall-clock and an idle (no output) timeout can be enforced,
+so that a hung command is killed rather than waiting forever.
+
+"""
+import collections
+import datetime
+import errno
+import os
+import select
+import subprocess
+import threading
+import time
+
+from . import (
+    timing,
+    utils
+)
+
+# number of lines of output retained for error reporting
+TAIL_SIZE = 50
+
+# lines longer than this are split, so that memory use is bounded
+MAX_LINE_LENGTH = 64 * 1024
+
+# seconds to keep reading output after a command is killed - if it has
+# children that still hold its stdout/stderr open, we stop waiting.
+KILL_GRACE_PERIOD = 2
+
+# the outcome of running a command - timed_out is None, 'wall' or 'idle'
+ProcessResult = collections.namedtuple(
+    'ProcessResult', ['returncode', 'elapsed', 'tail', 'timed_out']
+)
+
+
+def split_lines(buffer, chunk):
+    """Split buffered output into lines, returning (lines, new buffer).
+
+    Lines are split on '\n' and '\r' (for progress output), and the
+    incomplete final line is returned as the new buffer - unless it is
+    longer than MAX_LINE_LENGTH, in which case it is returned as a line.
+
+    """
+    lines = (buffer + chunk).replace('\r\n', '\n').replace('\r', '\n').split('\n')  # noqa
+    buffer = lines.pop()
+    if len(buffer) > MAX_LINE_LENGTH:
+        lines.append(buffer)
+        buffer = ''
+    return lines, buffer
+
+
+def echo_line(line):
+    """Echo a (non-blank) line of command output, with a timestamp."""
+    if line.strip():
+        utils.echo(
+            u"[%s] %s" % (
+                datetime.datetime.now().strftime('%H:%M:%S'),
+                line.rstrip().decode('utf-8', 'replace')
+            )
+        )
+
+
+class Process(object):
+
+    """An external command, with its output streamed as it runs."""
+
+    def __init__(
+        self,
+        args,
+        timeout=None,
+        idle_timeout=None,
+        tail_size=TAIL_SIZE,
+        on_line=None,
+        echo=True
+    ):
+        """Initialise process - the command is not run until start().
+
+        Args:
+            args: the command to run, as a list of arguments.
+
+        Kwargs:
+            timeout: max number of seconds the command may run for.
+            idle_timeout: max number of seconds without any output.
+            tail_size: number of lines of output to keep in the tail.
+            on_line: function called as on_line(stream, line) for each
+                line of output, where stream is 'stdout' or 'stderr'.
+                Lines are split on '\n' and '\r' (for progress output).
+            echo: if True, echo each line (with a timestamp).
+
+        """
+        self.args = args
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.tail = collections.deque(maxlen=tail_size)
+        self.on_line = on_line
+        self.echo = echo
+        self.timed_out = None
+        self._stdin = None
+        self._popen = None
+        self._killed_at = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the command."""
+        self._start = time.time()
+        # commands are never interactive - they may be run concurrently
+        self._stdin = open(os.devnull, 'r')
+        self._popen = subprocess.Popen(
+            self.args,
+            stdin=self._stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        return self
+
+    def kill(self):
+        """Kill the command, if it's still running."""
+        with self._lock:
+            if self._popen is None:
+                return
+            self._killed_at = self._killed_at or time.time()
+            if self._popen.poll() is None:
+                try:
+                    self._popen.kill()
+                except OSError:
+                    pass
+
+    def _line(self, stream, line):
+        """Handle a single line of output."""
+        self.tail.append(line)
+        if self.echo:
+            echo_line(line)
+        if self.on_line is not None:
+            self.on_line(stream, line)
+
+    def _deadline(self, now, last_output):
+        """Return seconds until the next timeout, or None if there is none."""
+        remaining = []
+        if self._killed_at is not None:
+            return self._killed_at + KILL_GRACE_PERIOD - now
+        if self.timeout is not None:
+            remaining.append(self._start + self.timeout - now)
+        if self.idle_timeout is not None:
+            remaining.append(last_output + self.idle_timeout - now)
+        return min(remaining) if remaining else None
+
+    def wait(self):
+        """Stream the output until the command exits, and return the result.
+
+        Returns a ProcessResult - if the command was killed because it
+        timed out, then timed_out is 'wall' or 'idle', otherwise None.
+
+        """
+        streams = {
+            self._popen.stdout.fileno(): 'stdout',
+            self._popen.stderr.fileno(): 'stderr',
+        }
+        buffers = dict((fd, '') for fd in streams)
+        last_output = time.time()
+        while streams:
+            now = time.time()
+            deadline = self._deadline(now, last_output)
+            if deadline is not None and deadline <= 0:
+                if self._killed_at is not None:
+                    break
+                if (
+                    self.timeout is not None and
+                    now - self._start >= self.timeout
+                ):
+                    self.timed_out = 'wall'
+                else:
+                    self.timed_out = 'idle'
+                self.kill()
+                continue
+            try:
+                ready = select.select(list(streams), [], [], deadline)[0]
+            except select.error as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    if buffers[fd]:
+                        self._line(streams[fd], buffers[fd])
+                    del streams[fd]
+                    continue
+                last_output = time.time()
+                lines, buffers[fd] = split_lines(buffers[fd], chunk)
+                for line in lines:
+                    self._line(streams[fd], line)
+        returncode = self._popen.wait()
+        self._popen.stdout.close()
+        self._popen.stderr.close()
+        self._stdin.close()
+        end = time.time()
+        timing.record(
+            describe(self.args), 'process', self._start, end,
+            returncode=returncode, timed_out=self.timed_out
+        )
+        return ProcessResult(
+            returncode,
+            end - self._start,
+            list(self.tail),
+            self.timed_out
+        )
+
+
+def describe(args):
+    """Return a short name for a command, e.g. 'git push', 'heroku run'.
+
+    This is the program name, and the first argument that is not an
+    option (so that global options, such as git's --git-dir, are skipped).
+
+    """
+    name = os.path.basename(args[0])
+    for arg in args[1:]:
+        if not arg.startswith('-'):
+            return u"%s %s" % (name, arg)
+    return name
+
+
+def run(args, **kwargs):
+    """Run a command, streaming its output, and return a ProcessResult.
+
+    See Process for the supported kwargs.
+
+    """
+    return Process(args, **kwargs).start().wait()
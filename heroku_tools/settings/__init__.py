@@ -4,15 +4,24 @@
 Contains the CLI application settings (as distinct from the Heroku
 application settings, which are in the config module.)
 
-The settings themselves are loaded at the end of this module.
+The settings are exposed as a read-only `context` object, which is
+resolved lazily - the local .herokutoolsconf file is not read until a
+setting is first accessed, and the Heroku API token is not fetched
+(which may involve running `heroku auth:token`) until it is first
+needed by an API call. This keeps commands such as `--help` and `init`
+free of any subprocess or parsing overhead.
 
 >>> from heroku_tools import settings
->>> settings.app_conf_dir
+>>> settings.context.app_conf_dir
 foo/bar
 >>>
 
 """
+import copy
+import json
 import os
+import threading
+import time
 
 import click
 import sarge
@@ -25,7 +34,8 @@ def _auth_token():
     """Call the heroku auth:token api.
 
     This function is inside settings, not Heroku, as it's part of the
-    settings process, and is only called once, on startup.
+    settings process, and is only called when the token is first needed
+    and not available from the environment or the credentials file.
 
     """
     r = sarge.capture_stdout('heroku auth:token')
@@ -41,16 +51,17 @@ DEFAULT_SETTINGS = {
     'commands': {
         'collectstatic': 'python manage.py collectstatic --noinput',
     },
-    'heroku_api_token': os.getenv('HEROKU_API_TOKEN'),
+    'heroku_api_token': None,
+    # API responses are cached here, set to '' to disable caching
+    'cache_dir': os.path.expanduser('~/.heroku-tools/cache'),
+    'cache_max_size': 50 * 1024 * 1024,
+    # the token fetched from `heroku auth:token` is cached here
+    'credentials_file': os.path.expanduser('~/.heroku-tools/credentials'),
+    'credentials_ttl': 12 * 60 * 60,
+    # local SQLite store of application release history
+    'history_db': os.path.expanduser('~/.heroku-tools/history.db'),
 }
 
-if DEFAULT_SETTINGS['heroku_api_token'] is None:
-    click.echo("No HEROKU_API_TOKEN environment variable set, checking Heroku API.")
-    try:
-        DEFAULT_SETTINGS['heroku_api_token'] = _auth_token()
-    except Exception:
-        DEFAULT_SETTINGS['heroku_api_token'] = None
-
 
 def get_settings(filename):
     """Load configuration for heroku-tools itself.
@@ -60,11 +71,11 @@ def get_settings(filename):
     - local .herokutoolsconf YAML file in current working directory
     - DEFAULT_SETTINGS
 
-    This method is called within this module, making all settings available
-    to the rest of the application as heroku_tools.conf.settings.
+    This method is called by the Settings object the first time that
+    a setting is accessed, and returns a new dict each time.
 
     """
-    settings = DEFAULT_SETTINGS
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
 
     if filename in (None, ''):
         click.echo(u"No config specified, default settings will be applied.")
@@ -87,25 +98,171 @@ def get_settings(filename):
         click.echo(u"Default settings will be applied.")
         return settings
 
-# the default settings can be overridden by a local '.herokutoolsconf' files
-_settings = get_settings(os.path.join(os.getcwd(), '.herokutoolsconf'))
 
-# provide easy access to the settings
-app_conf_dir = _settings['app_conf_dir']
-git_work_dir = _settings['git_work_dir']
-commands = _settings['commands']
-collectstatic_cmd = commands['collectstatic']
-heroku_api_token = _settings['heroku_api_token']
+def read_credentials(filename):
+    """Return the cached API token from filename, or None if expired."""
+    try:
+        with open(filename, 'r') as f:
+            credentials = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if credentials.get('expires_at', 0) < time.time():
+        return None
+    return credentials.get('token')
+
+
+def write_credentials(filename, token, ttl):
+    """Cache the API token in filename (owner read/write only)."""
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o700)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'token': token, 'expires_at': time.time() + ttl}, f)
+
+
+class Settings(object):
+
+    """Read-only heroku-tools settings, resolved on first access.
+
+    The settings file is read the first time any setting is accessed.
+    The API token is resolved separately, the first time it is accessed,
+    from (in order): the HEROKU_API_TOKEN environment variable, the
+    settings file, the credentials file (if not expired), and finally
+    the `heroku auth:token` CLI command - in which case the token is
+    written to the credentials file for next time.
+
+    """
+
+    def __init__(self, filename):
+        """Initialise with the path to the settings file - nothing is read."""
+        self.__dict__['filename'] = filename
+        # re-entrant, as resolving the token loads the settings
+        self.__dict__['_lock'] = threading.RLock()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(u"Settings are read-only.")
+
+    def _resolve(self, key, func):
+        """Return cached value for key, calling func to set it if missing.
+
+        The first resolution of each key is made under a lock, as with
+        heroku.get_client(), so that threads that race for the same
+        setting (e.g. parallel fleet deployments) share a single call to
+        func - and so a single settings read or `heroku auth:token`.
+
+        """
+        if key not in self.__dict__:
+            with self._lock:
+                if key not in self.__dict__:
+                    self.__dict__[key] = func()
+        return self.__dict__[key]
+
+    @property
+    def _settings(self):
+        return self._resolve('_loaded', lambda: get_settings(self.filename))
+
+    @property
+    def app_conf_dir(self):
+        """Directory containing the application .conf files."""
+        return self._settings['app_conf_dir']
+
+    @property
+    def git_work_dir(self):
+        """Working directory of the application git repo."""
+        return self._settings['git_work_dir']
+
+    @property
+    def commands(self):
+        """Dict of named shell commands."""
+        return copy.deepcopy(self._settings['commands'])
+
+    @property
+    def collectstatic_cmd(self):
+        """The command used to run collectstatic."""
+        return self._settings['commands']['collectstatic']
+
+    @property
+    def cache_dir(self):
+        """Directory in which API responses are cached ('' to disable)."""
+        return self._settings['cache_dir']
+
+    @property
+    def cache_max_size(self):
+        """Maximum size of the API response cache, in bytes."""
+        return self._settings['cache_max_size']
+
+    @property
+    def history_db(self):
+        """Path of the SQLite release history store."""
+        return self._settings['history_db']
+
+    @property
+    def heroku_api_token(self):
+        """The Heroku API token, fetched only when first required."""
+        return self._resolve('_token', self._heroku_api_token)
+
+    def _heroku_api_token(self):
+        token = (
+            os.getenv('HEROKU_API_TOKEN') or
+            self._settings['heroku_api_token']
+        )
+        if token:
+            return token
+        filename = self._settings['credentials_file']
+        token = read_credentials(filename)
+        if token:
+            return token
+        click.echo("No HEROKU_API_TOKEN environment variable set, checking Heroku API.")
+        try:
+            token = _auth_token()
+        except Exception:
+            return None
+        try:
+            write_credentials(filename, token, self._settings['credentials_ttl'])
+        except (IOError, OSError) as ex:
+            click.echo("Unable to cache Heroku API token: %s" % ex)
+        return token
+
+
+    def discard_heroku_api_token(self):
+        """Remove the API token from the credentials file, if it came from it.
+
+        This is called when the API rejects the token (401) - e.g. it has
+        been revoked, or the CLI is now logged in to another account - so
+        that the next run fetches a fresh one, rather than failing until
+        the cached token expires. Tokens from the environment or the
+        settings file are left alone.
+
+        Returns the credentials filename if the token was removed from
+        it, else None.
+
+        """
+        token = self.__dict__.get('_token')
+        filename = self._settings['credentials_file']
+        if not token or read_credentials(filename) != token:
+            return None
+        try:
+            os.remove(filename)
+        except OSError:
+            return None
+        return filename
+
+
+# the default settings can be overridden by a local '.herokutoolsconf' files
+context = Settings(os.path.join(CWD, '.herokutoolsconf'))
 
 
 @click.command(name='settings')
 def print_settings():
     """Print out current settings."""
     click.echo(r"-------------------------------------")
-    click.echo(r"app_conf_dir      = %s" % app_conf_dir)
-    click.echo(r"git_work_dir      = %s" % git_work_dir)
-    click.echo(r"collectstatic_cmd = %s" % collectstatic_cmd)
-    click.echo(r"heroku_api_token  = %s" % heroku_api_token)
+    click.echo(r"app_conf_dir      = %s" % context.app_conf_dir)
+    click.echo(r"git_work_dir      = %s" % context.git_work_dir)
+    click.echo(r"collectstatic_cmd = %s" % context.collectstatic_cmd)
+    click.echo(r"heroku_api_token  = %s" % context.heroku_api_token)
+    click.echo(r"cache_dir         = %s" % context.cache_dir)
+    click.echo(r"history_db        = %s" % context.history_db)
     click.echo(r"-------------------------------------")
 
 
@@ -113,7 +270,7 @@ def print_settings():
 @click.argument('environment')
 def init_app_conf(environment):
     """Create a new app conf file from user prompts."""
-    path = os.path.join(app_conf_dir, '%s.conf' % environment)
+    path = os.path.join(context.app_conf_dir, '%s.conf' % environment)
     if os.path.exists(path):
         click.echo("A conf file already exists for '%s' at '%s'" % (environment, path))
         return
@@ -135,7 +292,7 @@ def init_app_conf(environment):
     }
     if pipeline:
         data['application']['upstream'] = upstream
-    path = os.path.join(app_conf_dir, '%s.conf' % environment)
+    path = os.path.join(context.app_conf_dir, '%s.conf' % environment)
     with open(path, 'w') as f:
         yaml.dump(data, f, default_flow_style=False)
     click.echo("Configuration data written to %s" % path)
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""Post-deployment task runner.
+
+Post-deployment tasks are configured in the `post_deploy` list of the
+application conf file. Each entry is either a plain shell command, or
+a named task with dependencies, timeouts, and a number of retries:
+
+    post_deploy:
+        - name: migrate
+          command: heroku run python manage.py migrate -a live_app
+          timeout: 600
+        - name: reindex
+          command: heroku run python manage.py reindex -a live_app
+          depends_on: [migrate]
+          idle_timeout: 120
+          retries: 2
+        - name: invalidate-cdn
+          command: ./bin/invalidate-cdn
+        - name: warm-cache
+          run: python manage.py warm_cache
+          depends_on: [migrate]
+        - name: migrate-schema
+          run: python manage.py migrate
+          maintenance: true
+
+Tasks with `run` instead of `command` are run in a one-off dyno, created
+via the API rather than with `heroku run` (which starts the whole CLI),
+on the application being deployed, or the one given by `app`.
+
+Tasks with `maintenance: true` need the maintenance page to be up while
+they run (e.g. schema migrations). If there are any, and the maintenance
+page is requested, then it is only put up just before the first of them
+starts, and taken down as soon as they have completed - rather than for
+the whole deployment.
+
+Tasks are run as a dependency graph - a task starts as soon as all of
+the tasks it depends on have completed, and independent tasks run
+concurrently. Plain commands depend on the entry before them, so a list
+of plain commands runs in order, as it always has.
+
+If any task fails (non-zero exit, or timeout, after any retries) then
+no further tasks are started, running tasks are stopped, and TaskError
+is raised.
+
+"""
+import collections
+import Queue
+import shlex
+import threading
+import time
+
+from . import (
+    heroku,
+    process,
+    timing,
+    utils
+)
+from .config import ConfigurationError
+
+# default number of tasks that can run at the same time
+MAX_CONCURRENT_TASKS = 4
+
+# the outcome of running a task
+TaskResult = collections.namedtuple(
+    'TaskResult', ['name', 'returncode', 'elapsed', 'attempts']
+)
+
+
+class TaskError(Exception):
+
+    """Error raised when a post-deployment task fails."""
+
+    pass
+
+
+class Task(object):
+
+    """A single post-deployment task."""
+
+    def __init__(self, name, command, depends_on=None, timeout=None, idle_timeout=None, retries=0, application=None, maintenance=False):  # noqa
+        """Initialise task.
+
+        Args:
+            name: the name of the task, used to label its output.
+            command: the shell command to run.
+
+        Kwargs:
+            depends_on: list of task names that must complete first.
+            timeout: max number of seconds the command may run for.
+            idle_timeout: max number of seconds without any output.
+            retries: number of times to re-run the command if it fails.
+            application: if set, the command is run in a one-off dyno
+                on this Heroku application, rather than locally.
+            maintenance: if True, the maintenance page must be up while
+                the task runs.
+
+        """
+        self.name = name
+        self.command = command
+        self.depends_on = list(depends_on or [])
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.application = application
+        self.maintenance = maintenance
+
+    def __unicode__(self):
+        if self.application is not None:
+            return u"%s: run %s (one-off dyno on %s)" % (
+                self.name, self.command, self.application
+            )
+        if self.name == self.command:
+            return u"%s" % self.command
+        return u"%s: %s" % (self.name, self.command)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def run(self, group=None):
+        """Run the command, with retries, and return a TaskResult.
+
+        Kwargs:
+            group: the ProcessGroup to run the command in, so that it can
+                be stopped if another task fails.
+
+        """
+        group = group or ProcessGroup()
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            with timing.span(u"task %s" % self.name, 'task', attempt=attempt) as s:  # noqa
+                returncode = group.run(self.command, self.timeout, self.idle_timeout, self.application)  # noqa
+                s.set(returncode=returncode)
+            if returncode == 0 or attempt > self.retries or group.stopped:
+                return TaskResult(self.name, returncode, time.time() - start, attempt)  # noqa
+            utils.echo(
+                u"Failed with exit code %s, retrying (%i of %i)" %
+                (returncode, attempt, self.retries)
+            )
+
+
+def parse_tasks(post_deploy, application=None):
+    """Return the list of Task objects from the post_deploy config.
+
+    Kwargs:
+        application: the Heroku application on which `run` tasks are
+            run, if they don't specify their own `app`.
+
+    Raises ConfigurationError if the config is invalid - a task is
+    missing its command (or has both `command` and `run`), task names
+    are duplicated, a dependency doesn't exist, or dependencies form a
+    cycle. Unnamed tasks are named by their command (see _unique_name).
+
+    """
+    explicit = [
+        entry['name'] for entry in post_deploy or []
+        if isinstance(entry, dict) and entry.get('name')
+    ]
+    for name in explicit:
+        if explicit.count(name) > 1:
+            raise ConfigurationError(
+                u"Duplicate post_deploy task name: %s" % name
+            )
+    used = set(explicit)
+    tasks = []
+    previous = None
+    for entry in post_deploy or []:
+        if isinstance(entry, basestring):
+            task = Task(
+                name=_unique_name(entry, used),
+                command=entry,
+                depends_on=[previous] if previous else None
+            )
+        elif (
+            isinstance(entry, dict) and
+            bool(entry.get('command')) != bool(entry.get('run'))
+        ):
+            command = entry.get('command') or entry['run']
+            task = Task(
+                name=entry.get('name') or _unique_name(command, used),
+                command=command,
+                depends_on=entry.get('depends_on'),
+                timeout=entry.get('timeout'),
+                idle_timeout=entry.get('idle_timeout'),
+                retries=entry.get('retries', 0),
+                application=(
+                    entry.get('app') or application
+                    if entry.get('run') else None
+                ),
+                maintenance=bool(entry.get('maintenance', False))
+            )
+            if entry.get('run') and task.application is None:
+                raise ConfigurationError(
+                    u"post_deploy task '%s' has no app to run on" % task.name
+                )
+        else:
+            raise ConfigurationError(
+                u"Invalid post_deploy task, no command specified: %s" % entry
+            )
+        tasks.append(task)
+        previous = task.name
+
+    names = [t.name for t in tasks]
+    for task in tasks:
+        for dependency in task.depends_on:
+            if dependency not in names:
+                raise ConfigurationError(
+                    u"post_deploy task '%s' depends on unknown task '%s'" %
+                    (task.name, dependency)
+                )
+    _check_for_cycles(tasks)
+    return tasks
+
+
+def _unique_name(command, used):
+    """Return the name of an unnamed task - its command, made unique.
+
+    Unnamed tasks are named by their command, and the same command may
+    be listed more than once, so repeats are named 'command #2', etc.
+
+    """
+    name = command
+    count = 1
+    while name in used:
+        count += 1
+        name = u"%s #%i" % (command, count)
+    used.add(name)
+    return name
+
+
+def _check_for_cycles(tasks):
+    """Raise ConfigurationError if the task dependencies contain a cycle."""
+    done = set()
+    remaining = list(tasks)
+    while remaining:
+        ready = [t for t in remaining if set(t.depends_on) <= done]
+        if not ready:
+            raise ConfigurationError(
+                u"post_deploy tasks have circular dependencies: %s" %
+                u", ".join(t.name for t in remaining)
+            )
+        done.update(t.name for t in ready)
+        remaining = [t for t in remaining if t.name not in done]
+
+
+class ProcessGroup(object):
+
+    """The set of commands being run by a single run_tasks call.
+
+    Keeping track of the running processes allows them all to be stopped
+    as soon as one task fails. Once stopped, no new commands are run.
+
+    """
+
+    def __init__(self):
+        self.stopped = False
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def run(self, command, timeout=None, idle_timeout=None, application=None):  # noqa
+        """Run a shell command, echoing its output, and return the exit code.
+
+        If application is set, then the command is run in a one-off dyno
+        on that Heroku application, instead of locally.
+
+        If the command runs for longer than timeout seconds, or produces
+        no output for idle_timeout seconds, it is killed, and the return
+        code is None - as it is if the group is stopped.
+
+        """
+        if application is None:
+            p = process.Process(
+                shlex.split(command),
+                timeout=timeout,
+                idle_timeout=idle_timeout
+            )
+        else:
+            p = heroku.OneOffDyno(
+                application,
+                command,
+                timeout=timeout,
+                idle_timeout=idle_timeout
+            )
+        with self._lock:
+            if self.stopped:
+                return None
+            p.start()
+            self._processes.add(p)
+        try:
+            result = p.wait()
+        finally:
+            with self._lock:
+                self._processes.discard(p)
+        if result.timed_out is not None:
+            utils.echo(u"Timed out (%s) after %.1fs" % (result.timed_out, result.elapsed))  # noqa
+            return None
+        return None if self.stopped else result.returncode
+
+    def stop(self):
+        """Kill all running commands, and prevent any more from starting."""
+        with self._lock:
+            self.stopped = True
+            for p in self._processes:
+                p.kill()
+
+
+def run_tasks(tasks, concurrency=MAX_CONCURRENT_TASKS, window=None):
+    """Run tasks in dependency order, and return a list of TaskResults.
+
+    Each task's output is prefixed with its name. Up to `concurrency`
+    tasks are run at the same time.
+
+    Kwargs:
+        window: an object with open() and close() methods, e.g. a
+            deploy.MaintenanceWindow. It is opened before any task that
+            has `maintenance` set is started, and closed as soon as no
+            such task is running (or ready to run). If a task fails, the
+            window is left open. If no task has `maintenance` set, the
+            window is not touched at all.
+
+    Raises TaskError if any task fails.
+
+    """
+    prefix = utils.get_output_prefix()
+    group = ProcessGroup()
+    completed = Queue.Queue()
+    pending = list(tasks)
+    running = {}
+    results = []
+    done = set()
+    failed = None
+
+    def worker(task):
+        with utils.output_prefix(prefix + '[%s] ' % task.name):
+            try:
+                result = task.run(group)
+            except Exception as ex:
+                utils.echo(u"Error running task: %s" % ex)
+                result = TaskResult(task.name, None, 0.0, 1)
+        completed.put(result)
+
+    maintenance = set(t.name for t in tasks if t.maintenance)
+    if not maintenance:
+        # the caller owns the window - e.g. it is up for the whole deploy.
+        window = None
+
+    while pending or running:
+        if failed is None:
+            ready = [t for t in pending if set(t.depends_on) <= done]
+            ready = ready[:max(concurrency - len(running), 0)]
+            if window is not None:
+                try:
+                    if any(t.name in maintenance for t in ready):
+                        window.open()
+                    elif not maintenance & set(running):
+                        window.close()
+                except Exception:
+                    group.stop()
+                    raise
+            for task in ready:
+                pending.remove(task)
+                thread = threading.Thread(target=worker, args=(task,))
+                thread.daemon = True
+                running[task.name] = thread
+                thread.start()
+        if not running:
+            break
+        result = completed.get()
+        running.pop(result.name).join()
+        results.append(result)
+        if result.returncode == 0:
+            done.add(result.name)
+        elif failed is None:
+            failed = result
+            group.stop()
+
+    if window is not None and failed is None:
+        window.close()
+    print_results(results)
+    if failed is not None:
+        if pending:
+            utils.echo(
+                u"Tasks not run: %s" % u", ".join(t.name for t in pending)
+            )
+        raise TaskError(
+            u"Post-deployment task '%s' failed (exit code %s)" %
+            (failed.name, failed.returncode)
+        )
+    return results
+
+
+def print_results(results):
+    """Print the timing table of task results."""
+    if not results:
+        return
+    width = max(len(r.name) for r in results)
+    utils.echo(u"Post-deployment task timings:")
+    for r in results:
+        status = u"OK" if r.returncode == 0 else u"FAILED (%s)" % r.returncode
+        attempts = u" (%i attempts)" % r.attempts if r.attempts > 1 else u""
+        utils.echo(u"  %s %7.2fs  %s%s" % (r.name.ljust(width), r.elapsed, status, attempts))  # noqa
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 import json
+import os
+import shutil
+import stat
+import tempfile
 import unittest
-from mock import patch, call
+from mock import patch, call, Mock
 
-from . import utils
+from . import cache, settings, utils
 from .heroku import HerokuRelease, HerokuError
-from .git import get_commits
+from .git import get_commits, get_files
 
 
 class MockResponse(object):
@@ -14,11 +18,87 @@ class MockResponse(object):
         """Return JSON representation."""
         return json.load(open('heroku_tools/test_data/foo.json', 'r'))
 
+    @property
+    def content(self):
+        return open('heroku_tools/test_data/foo.json', 'r').read()
+
     @property
     def status_code(self):
         return 200
 
 
+class MockPage(object):
+    """Mock a single page of a Range-paginated API response."""
+    def __init__(self, data, next_range=None):
+        self.data = data
+        self.status_code = 200 if next_range is None else 206
+        self.headers = {} if next_range is None else {'Next-Range': next_range}
+
+    def json(self):
+        return self.data
+
+
+class FakeHerokuAPI(object):
+    """Local stand-in for the Heroku Platform API, served from a thread.
+
+    Responses are looked up in the routes dict, keyed on (method, path),
+    where each value is either a (status, data) 2-tuple, or a function
+    that takes the decoded JSON request body and returns one. Every
+    request is recorded in `requests` as (method, path, headers, body).
+
+    """
+    def __init__(self, routes):
+        import BaseHTTPServer
+        import threading
+        api = self
+        self.routes = routes
+        self.requests = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                api.requests.append(
+                    (self.command, self.path, dict(self.headers), body)
+                )
+                route = api.routes.get((self.command, self.path), (404, {}))
+                status, data = route(body) if callable(route) else route
+                content = json.dumps(data)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_PATCH = do_POST = do_DELETE = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%i' % self.server.server_port
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            kwargs={'poll_interval': 0.01}
+        )
+        self.thread.daemon = True
+
+    def __enter__(self):
+        from heroku_tools.heroku import HerokuClient
+        self.thread.start()
+        self.patcher = patch(
+            'heroku_tools.heroku.get_client',
+            return_value=HerokuClient('token', base_url=self.url)
+        )
+        self.patcher.start()
+        return self
+
+    def __exit__(self, *args):
+        self.patcher.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
 def mock_get(*args, **kwargs):
     return MockResponse()
 
@@ -31,57 +111,90 @@ class HerokuReleaseTests(unittest.TestCase):
         self.initial_release_json = json_data[0]
         self.herokurelease = HerokuRelease(self.json_input)
 
-    @patch("heroku_tools.heroku.call_api")
-    @patch("heroku_tools.heroku.click.echo")
-    @patch("heroku_tools.heroku.HerokuRelease")
-    def test_get_latest_deployment(self, HerokuRelease, echo, call_api):
+    @patch("heroku_tools.heroku.get_client")
+    @patch("heroku_tools.heroku.utils.echo")
+    def test_get_latest_deployment(self, echo, get_client):
         """Test unpacking of Heroku API release JSON."""
-        call_api.return_value = [
+        request = get_client.return_value.request
+        request.return_value = MockPage([
             {'description': 'Deploy'},
             {'description': 'Promote'}
-        ]
-        self.herokurelease.get_latest_deployment('x')
-        call_api.assert_called_once_with(
-            'https://api.heroku.com/apps/%s/releases',
-            'x',
-            range_header='version;max=10,order=desc'
+        ])
+        release = self.herokurelease.get_latest_deployment('x')
+        request.assert_called_once_with(
+            'GET',
+            '/apps/x/releases',
+            headers={'Range': 'version;max=10,order=desc'}
         )
-        HerokuRelease.assert_called_once_with({'description': 'Deploy'})
+        self.assertEqual(release.description, 'Deploy')
 
         #  If no Deploy or Promote description HerokuError will be raised
         # from heroku_tools.heroku import HerokuError
-        call_api.return_value = [{'description': 'Hulahoop'}]
+        request.return_value = MockPage([{'description': 'Hulahoop'}])
         with self.assertRaises(HerokuError):
             self.herokurelease.get_latest_deployment('x')
 
         # now test with the HEROKU_API_MAX_RELEASE set
-        call_api.return_value = [{'description': 'Deploy'}]
+        request.return_value = MockPage([{'description': 'Deploy'}])
         with patch('heroku_tools.heroku.HEROKU_API_MAX_RANGE', 1):
             self.herokurelease.get_latest_deployment('x')
-            call_api.assert_called_with(
-                'https://api.heroku.com/apps/%s/releases',
-                'x',
-                range_header='version;max=1,order=desc'
+            request.assert_called_with(
+                'GET',
+                '/apps/x/releases',
+                headers={'Range': 'version;max=1,order=desc'}
             )
 
-    @patch("requests.auth.HTTPBasicAuth")
-    @patch("requests.get", side_effect=mock_get)
-    def test_call_api(self, get, HTTPBasicAuth):
+        # the deployment is on the second page - which is only read once
+        # the first page has been exhausted, and no further.
+        request.reset_mock()
+        request.side_effect = [
+            MockPage([{'description': 'Set FOO'}], next_range='version ]9..'),
+            MockPage([{'description': 'Deploy'}], next_range='version ]8..'),
+            MockPage([{'description': 'Deploy'}]),
+        ]
+        release = self.herokurelease.get_latest_deployment('x')
+        self.assertEqual(release.description, 'Deploy')
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(
+            request.call_args,
+            call('GET', '/apps/x/releases', headers={'Range': 'version ]9..'})
+        )
+
+    @patch("heroku_tools.heroku.get_client")
+    def test_iter_releases(self, get_client):
+        """Test that iter_releases follows Next-Range to the last page."""
+        request = get_client.return_value.request
+        request.side_effect = [
+            MockPage([{'version': 3}, {'version': 2}], next_range='version ]2..'),
+            MockPage([{'version': 1}]),
+        ]
+        from heroku_tools.heroku import iter_releases
+        releases = iter_releases('x', page_size=2)
+        self.assertEqual(request.call_count, 0)
+        self.assertEqual([r.version for r in releases], [3, 2, 1])
+        self.assertEqual(
+            request.call_args_list[0],
+            call('GET', '/apps/x/releases', headers={'Range': 'version;max=2,order=desc'})
+        )
+
+    @patch("requests.Session.request", side_effect=mock_get)
+    def test_call_api(self, request):
 
         """Test call_api function of heroku_tools"""
 
-        HTTPBasicAuth.return_value = "authorized"
-        from heroku_tools.heroku import call_api
-        result = call_api('endpoint-%s', 'application', 'range_header')
+        from heroku_tools.heroku import call_api, HerokuClient
+        with patch(
+            'heroku_tools.heroku.get_client',
+            return_value=HerokuClient('token', base_url='http://api')
+        ):
+            result = call_api('/endpoint-%s', 'application', 'range_header')
         self.assertEqual(
-            get.call_args,
+            request.call_args,
             call(
-                'endpoint-application',
-                auth='authorized',
-                headers={
-                    'Range': 'range_header',
-                    'Accept': 'application/vnd.heroku+json; version=3'
-                }
+                'GET',
+                'http://api/endpoint-application',
+                headers={'Range': 'range_header'},
+                timeout=(5.0, 30.0)
             )
         )
         self.assertEqual(
@@ -121,22 +234,62 @@ class HerokuReleaseTests(unittest.TestCase):
             }]
         )
 
-    @patch("heroku_tools.heroku.parser")
-    def test_heroku_attributes(self, parser):
+    @patch("requests.Session.request", side_effect=mock_get)
+    def test_client_stats(self, request):
+        """Test that the client records each call, and is shared."""
+        from heroku_tools import heroku
+        client = heroku.HerokuClient('token', base_url='http://api/')
+        client.get('/foo')
+        client.get('/bar')
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(client.count, 2)
+        self.assertEqual([c.path for c in client.calls], ['/foo', '/bar'])
+        self.assertEqual(client.calls[0].method, 'GET')
+        self.assertEqual(client.calls[0].status_code, 200)
+        self.assertEqual(client.bytes, 2 * len(MockResponse().content))
+        self.assertEqual(request.call_args[0][1], 'http://api/bar')
+        with patch('heroku_tools.heroku._client', None), \
+                patch('heroku_tools.heroku.settings.context') as context:
+            context.cache_dir = ''
+            context.heroku_api_token = 'token'
+            self.assertIs(heroku.get_client(), heroku.get_client())
+
+    def test_heroku_attributes(self):
+        import datetime
+        from dateutil import tz
         for attribute in ('version', 'description'):
             self.assertEqual(
                 getattr(self.herokurelease, attribute),
                 self.json_input[attribute]
             )
+        self.assertEqual(self.herokurelease.application, 'test_app')
+        self.assertEqual(self.herokurelease.status, 'succeeded')
         self.assertEqual(
             self.herokurelease.deployed_by,
             self.json_input['user']['email']
         )
-        parser.parse.return_value = '2013-06-18T14:07:52Z'
+        self.assertIsInstance(self.herokurelease.deployed_by, str)
         self.assertEqual(
-            self.json_input['updated_at'],
-            self.herokurelease.deployed_at
+            self.herokurelease.deployed_at,
+            datetime.datetime(2013, 6, 18, 14, 7, 52, tzinfo=tz.tzutc())
         )
+        # fields are parsed up front, and the raw JSON isn't kept
+        self.assertFalse(hasattr(self.herokurelease, '__dict__'))
+        with self.assertRaises(AttributeError):
+            self.herokurelease.foo = 'bar'
+
+    def test_parse_timestamp(self):
+        from dateutil import parser
+        from heroku_tools.heroku import parse_timestamp
+        for value in (
+            '2013-06-18T14:07:52Z',
+            '2013-06-18T14:07:52+01:00',
+            '2013-06-18T14:07:52.123Z',
+        ):
+            self.assertEqual(parse_timestamp(value), parser.parse(value))
+        with patch('heroku_tools.heroku.parser') as mock_parser:
+            parse_timestamp('2013-06-18T14:07:52Z')
+        self.assertFalse(mock_parser.parse.called)
 
     def test_commit(self):
 
@@ -152,6 +305,784 @@ class HerokuReleaseTests(unittest.TestCase):
         self.assertEqual(deploy.commit, '75c70c5')
 
 
+class HerokuPlatformTests(unittest.TestCase):
+
+    """Tests for the native API implementations of CLI commands."""
+
+    def test_toggle_maintenance(self):
+        from heroku_tools.heroku import toggle_maintenance
+        with FakeHerokuAPI({
+            ('PATCH', '/apps/foo'): lambda body: (200, body),
+        }) as api:
+            toggle_maintenance('foo', True)
+            toggle_maintenance('foo', False)
+        self.assertEqual(
+            [(r[0], r[1], r[3]) for r in api.requests],
+            [
+                ('PATCH', '/apps/foo', {'maintenance': True}),
+                ('PATCH', '/apps/foo', {'maintenance': False}),
+            ]
+        )
+
+    @patch('heroku_tools.utils.time.sleep')
+    def test_promote_app(self, sleep):
+        from heroku_tools.heroku import promote_app
+        statuses = ['pending', 'pending', 'completed']
+        routes = {
+            ('GET', '/apps/staging/pipeline-couplings'): (200, {
+                'app': {'id': 'app-staging'},
+                'pipeline': {'id': 'pipe'},
+                'stage': 'staging',
+            }),
+            ('GET', '/pipelines/pipe/pipeline-couplings'): (200, [
+                {'app': {'id': 'app-dev'}, 'stage': 'development'},
+                {'app': {'id': 'app-staging'}, 'stage': 'staging'},
+                {'app': {'id': 'app-live-1'}, 'stage': 'production'},
+                {'app': {'id': 'app-live-2'}, 'stage': 'production'},
+            ]),
+            ('POST', '/pipeline-promotions'): (201, {'id': 'promo', 'status': 'pending'}),  # noqa
+            ('GET', '/pipeline-promotions/promo'): lambda body: (200, {'status': statuses.pop(0)}),  # noqa
+            ('GET', '/pipeline-promotions/promo/promotion-targets'): (200, [
+                {'app': {'id': 'app-live-1'}, 'status': 'succeeded'},
+                {'app': {'id': 'app-live-2'}, 'status': 'succeeded'},
+            ]),
+        }
+        with FakeHerokuAPI(routes) as api:
+            promote_app('staging')
+        promotion = [r[3] for r in api.requests if r[0] == 'POST'][0]
+        self.assertEqual(promotion, {
+            'pipeline': {'id': 'pipe'},
+            'source': {'app': {'id': 'app-staging'}},
+            'targets': [{'app': {'id': 'app-live-1'}}, {'app': {'id': 'app-live-2'}}],  # noqa
+        })
+        # polled until complete, backing off between polls
+        self.assertEqual(statuses, [])
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.5, 1])
+
+        # a failed target is reported
+        routes[('GET', '/pipeline-promotions/promo')] = (200, {'status': 'completed'})  # noqa
+        routes[('GET', '/pipeline-promotions/promo/promotion-targets')] = (200, [
+            {'app': {'id': 'app-live-1'}, 'status': 'failed', 'error_message': 'boom'},  # noqa
+        ])
+        with FakeHerokuAPI(routes):
+            with self.assertRaises(HerokuError) as ctx:
+                promote_app('staging')
+        self.assertIn('app-live-1: boom', str(ctx.exception))
+
+        # nothing downstream of production
+        routes[('GET', '/apps/staging/pipeline-couplings')][1]['stage'] = 'production'  # noqa
+        with FakeHerokuAPI(routes):
+            with self.assertRaises(HerokuError):
+                promote_app('staging')
+
+
+    @patch('heroku_tools.utils.time.sleep')
+    def test_wait_for_release(self, sleep):
+        from heroku_tools.heroku import wait_for_release
+
+        def release(version, description, status='succeeded'):
+            return {
+                'version': version,
+                'description': description,
+                'status': status,
+                'app': {'name': 'foo'},
+                'user': {'email': 'fred@example.com'},
+                'updated_at': '2016-01-01T12:00:00Z',
+            }
+
+        previous = release(10, 'Deploy 1111111')
+        pages = [
+            # push has returned, but the release is not yet created
+            [previous],
+            # a config change doesn't hide the release being waited for
+            [release(12, 'Set FOO config vars'), release(11, 'Deploy 2222222', 'pending'), previous],  # noqa
+            [release(12, 'Set FOO config vars'), release(11, 'Deploy 2222222'), previous],  # noqa
+        ]
+        # released, but then waiting for the web dyno to restart
+        pages.append(pages[-1])
+        dynos = [
+            [{'type': 'web', 'state': 'starting', 'release': {'version': 11}}],
+            [
+                {'type': 'web', 'state': 'up', 'release': {'version': 11}},
+                {'type': 'run', 'state': 'up', 'release': {'version': 10}},
+            ],
+        ]
+        routes = {
+            ('GET', '/apps/foo/releases'): lambda body: (200, pages.pop(0)),
+            ('GET', '/apps/foo/dynos'): lambda body: (200, dynos.pop(0)),
+        }
+        with FakeHerokuAPI(routes) as api:
+            r = wait_for_release('foo', '2222222abcdef', dynos=True)
+        self.assertEqual(r.version, 11)
+        self.assertEqual((pages, dynos), ([], []))
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [0.5, 1, 2])  # noqa
+        # the same Range on each poll, so that they can be conditional
+        self.assertEqual(
+            set(req[2]['range'] for req in api.requests if req[1].endswith('releases')),  # noqa
+            set(['version;max=10,order=desc'])
+        )
+
+        # a failed release phase is reported immediately
+        routes[('GET', '/apps/foo/releases')] = (200, [release(11, 'Deploy 2222222', 'failed')])  # noqa
+        with FakeHerokuAPI(routes):
+            with self.assertRaises(HerokuError):
+                wait_for_release('foo', '2222222')
+
+        # as is a release that never appears
+        routes[('GET', '/apps/foo/releases')] = (200, [previous])
+        with FakeHerokuAPI(routes):
+            with self.assertRaises(HerokuError):
+                wait_for_release('foo', '2222222', timeout=0.01)
+
+class OneOffDynoTests(unittest.TestCase):
+
+    """Tests for running commands in one-off dynos."""
+
+    ROUTES = {
+        ('POST', '/apps/foo/dynos'): (201, {
+            'name': 'run.1234',
+            'attach_url': 'rendezvous://rendezvous.example.com:5000/secret',
+        }),
+        ('DELETE', '/apps/foo/dynos/run.1234'): (202, {}),
+    }
+
+    def setUp(self):
+        self.echo_patcher = patch("heroku_tools.utils.click.echo")
+        self.echo = self.echo_patcher.start()
+
+    def tearDown(self):
+        self.echo_patcher.stop()
+
+    def rendezvous(self, *chunks):
+        """Return a fake _rendezvous_connect that sends chunks of output."""
+        import socket
+        import threading
+        import time
+        urls = []
+
+        def connect(attach_url):
+            urls.append(attach_url)
+            local, remote = socket.socketpair()
+
+            def send():
+                try:
+                    for chunk in chunks:
+                        if chunk is None:
+                            time.sleep(1)
+                            continue
+                        remote.sendall(chunk)
+                except socket.error:
+                    pass  # disconnected by kill()
+                remote.close()
+
+            threading.Thread(target=send).start()
+            return local
+
+        connect.urls = urls
+        return connect
+
+    def test_run_command(self):
+        from heroku_tools.heroku import run_command
+        connect = self.rendezvous(
+            'rendezvous\r\n',
+            'Running migrations:\r\n  Apply',
+            'ing 0001_initial... OK\r\n',
+            '\xef\xbf\xbf heroku-command-exit-status: 0\r\n',
+        )
+        with patch('heroku_tools.heroku._rendezvous_connect', connect):
+            with FakeHerokuAPI(self.ROUTES) as api:
+                r = run_command('foo', 'python manage.py migrate')
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(r.tail, ['Running migrations:', '  Applying 0001_initial... OK'])  # noqa
+        self.assertEqual(connect.urls, ['rendezvous://rendezvous.example.com:5000/secret'])  # noqa
+        body = api.requests[0][3]
+        self.assertTrue(body['attach'])
+        self.assertEqual(
+            body['command'],
+            u'python manage.py migrate; echo "\uFFFF heroku-command-exit-status: $?"'  # noqa
+        )
+
+        # the real exit status is propagated
+        connect = self.rendezvous(
+            'rendezvous\r\nerror\r\n\xef\xbf\xbf heroku-command-exit-status: 3\r\n'  # noqa
+        )
+        with patch('heroku_tools.heroku._rendezvous_connect', connect):
+            with FakeHerokuAPI(self.ROUTES):
+                with self.assertRaises(HerokuError) as ctx:
+                    run_command('foo', 'false')
+        self.assertIn('exited with status 3', str(ctx.exception))
+
+    def test_concurrent_dynos_and_timeout(self):
+        import time
+        from heroku_tools.heroku import OneOffDyno
+        from heroku_tools.utils import run_concurrently
+
+        def run(idle_timeout=None):
+            return OneOffDyno('foo', 'x', idle_timeout=idle_timeout).start().wait()  # noqa
+
+        connect = self.rendezvous(
+            'rendezvous\r\n', None, 'done\r\n',
+            '\xef\xbf\xbf heroku-command-exit-status: 0\r\n',
+        )
+        with patch('heroku_tools.heroku._rendezvous_connect', connect):
+            with FakeHerokuAPI(self.ROUTES) as api:
+                start = time.time()
+                results = run_concurrently(dict((i, (run, ())) for i in range(3)))  # noqa
+                self.assertLess(time.time() - start, 1.9)
+                self.assertEqual([results[i][0].returncode for i in range(3)], [0, 0, 0])  # noqa
+
+                # a dyno that produces no output is killed, and stopped
+                r = run(idle_timeout=0.2)
+        self.assertEqual(r.timed_out, 'idle')
+        self.assertIsNone(r.returncode)
+        self.assertEqual(api.requests[-1][:2], ('DELETE', '/apps/foo/dynos/run.1234'))  # noqa
+
+
+class ConfigTests(unittest.TestCase):
+
+    """Tests for the config module."""
+
+    def test_set_vars(self):
+        """Test that settings are applied in a single PATCH request."""
+        from heroku_tools.config import set_vars
+        release = {
+            'version': 42, 'description': 'Set FOO, BAR config vars',
+            'app': {'name': 'foo'}, 'user': {'email': 'x@x'},
+        }
+        with FakeHerokuAPI({
+            ('PATCH', '/apps/foo/config-vars'): lambda body: (200, body),
+            ('GET', '/apps/foo/releases'): (200, [release]),
+        }) as api:
+            version = set_vars('foo', [
+                ('FOO', 'with spaces and "quotes"', None, '+'),
+                ('BAR', True, 'False', '!'),
+                ('BAZ', None, 'x', '!'),
+            ])
+        self.assertEqual(version, 42)
+        method, path, headers, body = api.requests[0]
+        self.assertEqual((method, path), ('PATCH', '/apps/foo/config-vars'))
+        self.assertEqual(headers['content-type'], 'application/json')
+        # a local None is set as "None", not deleted
+        self.assertEqual(body, {'FOO': 'with spaces and "quotes"', 'BAR': 'True', 'BAZ': 'None'})  # noqa
+        self.assertEqual(len(api.requests), 2)
+
+    def test_set_config_vars_chunked(self):
+        from heroku_tools.heroku import set_config_vars
+        with FakeHerokuAPI({
+            ('PATCH', '/apps/foo/config-vars'): lambda body: (200, body),
+            ('GET', '/apps/foo/releases'): (200, [{'version': 7}]),
+        }) as api:
+            config_vars = dict(('VAR_%03i' % i, i) for i in range(25))
+            self.assertEqual(set_config_vars('foo', config_vars, chunk_size=10), 7)
+        patches = [r[3] for r in api.requests if r[0] == 'PATCH']
+        self.assertEqual([len(p) for p in patches], [10, 10, 5])
+        merged = {}
+        for p in patches:
+            merged.update(p)
+        self.assertEqual(merged, dict((k, str(v)) for k, v in config_vars.items()))
+
+    def test_set_config_vars_error(self):
+        from heroku_tools.heroku import set_config_vars
+        with FakeHerokuAPI({
+            ('PATCH', '/apps/foo/config-vars'): (422, {'message': 'Invalid'}),
+        }):
+            with self.assertRaises(HerokuError):
+                set_config_vars('foo', {'FOO': 'bar'})
+
+    def test_compare_settings(self):
+        from heroku_tools.config import compare_settings
+        diff = compare_settings(
+            {'SAME': 1, 'CHANGED': True, 'NEW': u'caf\xe9'},
+            {'SAME': u'1', 'CHANGED': u'true', 'ADDON_URL': u'x'}
+        )
+        self.assertEqual(diff, [
+            ('ADDON_URL', None, u'x', '?'),
+            ('CHANGED', True, u'true', '!'),
+            ('NEW', u'caf\xe9', None, '+'),
+            ('SAME', 1, u'1', '='),
+        ])
+
+    def write_confs(self, **files):
+        """Write files into a temp dir, and return its path."""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        for name, content in files.items():
+            with open(os.path.join(tmp, name.replace('_', '.')), 'w') as f:
+                f.write(content)
+        return tmp
+
+    def test_load_config_extends(self):
+        """Test that conf files are merged over the files they extend."""
+        from heroku_tools.config import (
+            AppConfiguration, ConfigurationError, load_config
+        )
+        tmp = self.write_confs(
+            common_yaml=(
+                "application:\n    branch: master\n    add_tag: True\n"
+                "    post_deploy: [one, two]\n"
+                "settings:\n    DEBUG: False\n    SECRET: common\n"
+            ),
+            eu_yaml=(
+                "extends: common.yaml\n"
+                "settings:\n    REGION: eu\n    SECRET: eu\n"
+            ),
+            live_conf=(
+                "extends: [eu.yaml]\n"
+                "application:\n    name: live_app\n    post_deploy: [three]\n"  # noqa
+                "settings:\n    SECRET: live\n"
+            ),
+            loop_conf="extends: loop.conf\n",
+            list_conf="- not a mapping\n",
+        )
+        with patch('heroku_tools.config.get_config_cache', return_value=None):  # noqa
+            app = AppConfiguration.load(os.path.join(tmp, 'live.conf'))
+            self.assertEqual(app.app_name, 'live_app')
+            self.assertEqual(app.default_branch, 'master')
+            self.assertTrue(app.add_tag)
+            # lists are replaced, mappings merged
+            self.assertEqual(app.post_deploy_tasks, ['three'])
+            self.assertEqual(app.settings, {
+                'DEBUG': False, 'REGION': 'eu', 'SECRET': 'live'
+            })
+            for name in ('loop.conf', 'list.conf', 'missing.conf'):
+                with self.assertRaises(ConfigurationError):
+                    load_config(os.path.join(tmp, name))
+
+    def test_load_config_cache(self):
+        """Test the compiled config cache, and its invalidation."""
+        from heroku_tools import config
+        tmp = self.write_confs(
+            common_yaml="settings:\n    DEBUG: False\n    NAME: caf\xc3\xa9\n",  # noqa
+            live_conf="extends: common.yaml\napplication:\n    name: live_app\n",  # noqa
+            dated_conf="application:\n    name: x\n    since: 2016-01-01\n",
+        )
+        live = os.path.join(tmp, 'live.conf')
+        common = os.path.join(tmp, 'common.yaml')
+        config_cache = cache.DiskCache(os.path.join(tmp, 'cache'), 1024 * 1024)  # noqa
+        with patch('heroku_tools.config.get_config_cache', return_value=config_cache), \
+                patch('heroku_tools.config.yaml.load', wraps=config.yaml.load) as load:  # noqa
+            first = config.load_config(live)
+            self.assertEqual(load.call_count, 2)
+            # the second load is served from the cache, with the same types
+            cached = config.load_config(live)
+            self.assertEqual(load.call_count, 2)
+            self.assertEqual(cached, first)
+            self.assertIsInstance(cached['application']['name'], str)
+            self.assertIsInstance(cached['settings']['NAME'], unicode)
+            # touching a file doesn't invalidate the cache...
+            os.utime(common, (0, 0))
+            config.load_config(live)
+            self.assertEqual(load.call_count, 2)
+            # ...but changing one, even a base file, does
+            with open(common, 'a') as f:
+                f.write("    EXTRA: 1\n")
+            self.assertEqual(config.load_config(live)['settings']['EXTRA'], 1)  # noqa
+            self.assertEqual(load.call_count, 4)
+            config.load_config(live, use_cache=False)
+            self.assertEqual(load.call_count, 6)
+            # configs that don't survive JSON aren't cached
+            dated = os.path.join(tmp, 'dated.conf')
+            config.load_config(dated)
+            config.load_config(dated)
+            self.assertEqual(load.call_count, 8)
+
+    def test_config_audit(self):
+        """Test the audit of all conf files, as a matrix and as JSON."""
+        from click.testing import CliRunner
+        from heroku_tools.config import audit_applications, audit_config
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        for env, app, config in (
+            ('live', 'foo', 'FOO: 1\n    BAR: x'),
+            ('staging', 'bar', 'FOO: 1'),
+            ('broken', 'gone', 'FOO: 1'),
+        ):
+            with open(os.path.join(tmp, '%s.conf' % env), 'w') as f:
+                f.write(
+                    'application:\n    name: %s\nsettings:\n    %s\n' %
+                    (app, config)
+                )
+        # malformed conf files are reported, without stopping the audit
+        for env, content in (
+            ('bad-yaml', 'application:\n  name: [oops\n'),
+            ('no-app', 'settings:\n    FOO: 1\n'),
+        ):
+            with open(os.path.join(tmp, '%s.conf' % env), 'w') as f:
+                f.write(content)
+        routes = {
+            ('GET', '/apps/foo/config-vars'): (200, {'FOO': '1', 'BAR': 'y'}),
+            ('GET', '/apps/bar/config-vars'): (200, {'FOO': '1', 'DB': 'z'}),
+            ('GET', '/apps/gone/config-vars'): (404, {'message': 'Not found'}),  # noqa
+        }
+        with FakeHerokuAPI(routes), \
+                patch('heroku_tools.config.get_config_cache', return_value=None):  # noqa
+            audit = audit_config(tmp)
+        self.assertEqual(sorted(audit), ['bad-yaml', 'broken', 'live', 'no-app', 'staging'])  # noqa
+        for env in ('bad-yaml', 'no-app'):
+            self.assertEqual(audit[env][:2], (None, None))
+            self.assertIn('%s.conf' % env, unicode(audit[env][2]))
+        self.assertEqual(audit['live'][0], 'foo')
+        self.assertEqual([(d[0], d[3]) for d in audit['live'][1]], [('BAR', '!'), ('FOO', '=')])  # noqa
+        self.assertIsInstance(audit['broken'][2], HerokuError)
+
+        with patch.object(settings, 'context', Mock(app_conf_dir=tmp, cache_dir='')):  # noqa
+            with FakeHerokuAPI(routes):
+                result = CliRunner().invoke(audit_applications, ['--json'])
+            self.assertEqual(result.exit_code, 1)
+            report = json.loads(result.output)
+            self.assertEqual(report['staging'], {
+                'app': 'bar',
+                'error': None,
+                'settings': {'FOO': '=', 'DB': '?'},
+            })
+            self.assertTrue(report['broken']['error'])
+
+            with FakeHerokuAPI(routes):
+                result = CliRunner().invoke(audit_applications)
+        lines = result.output.splitlines()
+        self.assertEqual(lines[0].split(), ['setting', 'live', 'staging'])
+        self.assertEqual(lines[1].split(), ['BAR', '!'])
+        self.assertEqual(lines[2].split(), ['DB', '?'])
+        self.assertEqual(lines[3].split(), ['FOO', '=', '='])
+        self.assertIn('broken: ERROR', result.output)
+
+
+class HistoryTests(unittest.TestCase):
+
+    """Tests for the local release history store."""
+
+    def release(self, version, commit=None, day=1):
+        return HerokuRelease({
+            'version': version,
+            'description': 'Deploy %s' % commit if commit else 'Set FOO config vars',  # noqa
+            'app': {'name': 'foo'},
+            'user': {'email': 'fred@example.com'},
+            'updated_at': '2016-09-%02iT12:00:00Z' % day,
+        })
+
+    def test_sync(self):
+        """Test that sync stops at the highest version already stored."""
+        from heroku_tools.history import ReleaseStore, sync
+        store = ReleaseStore(':memory:')
+        fetched = []
+
+        def iter_releases(application, page_size=None):
+            for release in releases:
+                fetched.append(release.version)
+                yield release
+
+        releases = [self.release(v, 'abc%04i' % v) for v in range(5, 0, -1)]
+        with patch('heroku_tools.heroku.iter_releases', iter_releases):
+            self.assertEqual([r.version for r in sync(store, 'foo')], [5, 4, 3, 2, 1])  # noqa
+            self.assertEqual(store.max_version('foo'), 5)
+            releases = [self.release(v, 'abc%04i' % v) for v in range(7, 0, -1)]  # noqa
+            del fetched[:]
+            self.assertEqual([r.version for r in sync(store, 'foo')], [7, 6])
+        # only the new releases, and the first stored one, are read
+        self.assertEqual(fetched, [7, 6, 5])
+        self.assertEqual(len(store.releases('foo')), 7)
+
+    def test_add_text(self):
+        """Test non-ASCII fields, and releases without a timestamp."""
+        from heroku_tools.history import ReleaseStore
+        store = ReleaseStore(':memory:')
+        self.assertEqual(store.add([
+            HerokuRelease({
+                'version': 1,
+                'description': u'Set caf\xe9 config vars',
+                'app': {'name': 'foo'},
+                'user': {'email': u'fr\xe9d@example.com'},
+                'updated_at': '2016-09-01T12:00:00Z',
+            }),
+            HerokuRelease({'version': 2, 'app': {'name': 'foo'}}),
+        ]), 1)
+        release, = store.releases('foo')
+        self.assertEqual(release.description, u'Set caf\xe9 config vars')
+        self.assertEqual(release.deployed_by, u'fr\xe9d@example.com')
+
+    def test_queries(self):
+        import datetime
+        from heroku_tools.history import ReleaseStore
+        store = ReleaseStore(':memory:')
+        store.add([
+            self.release(1, '1111111aaa', day=1),
+            self.release(2, day=2),
+            self.release(3, '3333333', day=8),
+            self.release(4, '4444444', day=15),
+        ])
+        since = store.releases('foo', since=datetime.datetime(2016, 9, 2))
+        self.assertEqual([r.version for r in since], [4, 3, 2])
+        self.assertIsNone(since[-1].commit)
+        self.assertEqual(since[0].deployed_at, '2016-09-15T12:00:00Z')
+        self.assertEqual(store.releases('bar'), [])
+
+        # commits are matched on their abbreviated hash
+        found = store.find_commits(['4444444ffffff', '1111111', 'fedcba9'])
+        self.assertEqual([(r.version, r.commit) for r in found], [(1, '1111111'), (4, '4444444')])  # noqa
+
+        stats = store.stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0].deploys, 3)
+        self.assertEqual(stats[0].median_interval, datetime.timedelta(days=7))
+        self.assertEqual(stats[0].last_deployed_at, datetime.datetime(2016, 9, 15, 12))  # noqa
+        self.assertEqual(store.stats(datetime.datetime(2016, 9, 10))[0].deploys, 1)  # noqa
+
+    @patch('heroku_tools.git.get_descendants')
+    def test_which_release(self, get_descendants):
+        from click.testing import CliRunner
+        from heroku_tools import history
+        store = history.ReleaseStore(':memory:')
+        store.add([
+            self.release(1, '1111111', day=1),
+            self.release(2, '2222222', day=2),
+            self.release(3, '3333333', day=3),
+        ])
+        store.close = Mock()
+        get_descendants.return_value = ['2222222' + 'f' * 33, '3333333' + 'f' * 33]  # noqa
+        with patch.object(history, 'get_store', return_value=store):
+            result = CliRunner().invoke(history.which_release, ['2222222'])
+        self.assertEqual(
+            result.output,
+            "foo: v2 at 2016-09-02T12:00:00Z by fred@example.com (deployed 2222222)\n"  # noqa
+        )
+
+
+class DiskCacheTests(unittest.TestCase):
+
+    """Tests for the cache module."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_get_set(self):
+        disk_cache = cache.DiskCache(self.path, 1024)
+        self.assertIsNone(disk_cache.get('foo'))
+        disk_cache.set('foo', {'bar': 1})
+        self.assertEqual(disk_cache.get('foo'), {'bar': 1})
+        disk_cache.delete('foo')
+        self.assertIsNone(disk_cache.get('foo'))
+
+    def test_permissions(self):
+        disk_cache = cache.DiskCache(self.path, 1024)
+        disk_cache.set('foo', {'SECRET_KEY': 'bar'})
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o700)
+        filename = disk_cache._filename('foo')
+        self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0o600)
+        # an existing directory is tightened on write
+        os.chmod(self.path, 0o755)
+        disk_cache.set('foo', {'SECRET_KEY': 'baz'})
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o700)
+
+    def test_lru_eviction(self):
+        disk_cache = cache.DiskCache(self.path, 250)
+        value = 'x' * 100
+        disk_cache.set('a', value)
+        disk_cache.set('b', value)
+        os.utime(disk_cache._filename('a'), (1, 1))
+        os.utime(disk_cache._filename('b'), (2, 2))
+        # reading 'a' makes it the most recently used
+        disk_cache.get('a')
+        disk_cache.set('c', value)
+        self.assertEqual(disk_cache.get('a'), value)
+        self.assertIsNone(disk_cache.get('b'))
+        self.assertEqual(disk_cache.get('c'), value)
+
+    @patch("requests.Session.request")
+    def test_conditional_request(self, request):
+        """Test that cached responses are revalidated with ETags."""
+        from heroku_tools.heroku import HerokuClient
+        client = HerokuClient(
+            'token',
+            base_url='http://api',
+            cache=cache.DiskCache(self.path, 1024)
+        )
+        request.return_value = Mock(
+            status_code=200,
+            headers={'ETag': '"abc"', 'Content-Type': 'application/json'},
+            content='{"FOO": "bar"}'
+        )
+        self.assertEqual(client.get('/foo').content, '{"FOO": "bar"}')
+        self.assertEqual(request.call_args[1]['headers'], {})
+
+        request.return_value = Mock(status_code=304, headers={}, content='')
+        resp = client.get('/foo')
+        self.assertEqual(
+            request.call_args[1]['headers'],
+            {'If-None-Match': '"abc"'}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), {'FOO': 'bar'})
+        self.assertEqual(resp.headers['etag'], '"abc"')
+        self.assertEqual(client.calls[-1].status_code, 304)
+
+        # a different Range is a different cache entry
+        client.get('/foo', headers={'Range': 'version;max=1'})
+        self.assertEqual(
+            request.call_args[1]['headers'],
+            {'Range': 'version;max=1'}
+        )
+
+        # ...as is the same path requested with a different token
+        other = HerokuClient(
+            'other-token',
+            base_url='http://api',
+            cache=cache.DiskCache(self.path, 1024)
+        )
+        request.return_value = Mock(
+            status_code=200,
+            headers={'Content-Type': 'application/json'},
+            content='{"FOO": "other"}'
+        )
+        self.assertEqual(other.get('/foo').content, '{"FOO": "other"}')
+        self.assertEqual(request.call_args[1]['headers'], {})
+        request.return_value = Mock(status_code=304, headers={}, content='')
+        self.assertEqual(client.get('/foo').json(), {'FOO': 'bar'})
+        self.assertEqual(
+            request.call_args[1]['headers'],
+            {'If-None-Match': '"abc"'}
+        )
+
+
+class SettingsTests(unittest.TestCase):
+
+    """Tests for the lazily resolved settings context."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.conf = os.path.join(self.tmp, '.herokutoolsconf')
+        self.credentials = os.path.join(self.tmp, 'credentials')
+        with open(self.conf, 'w') as f:
+            f.write(
+                "settings:\n"
+                "    app_conf_dir: /foo\n"
+                "    credentials_file: %s\n" % self.credentials
+            )
+        self.env_patcher = patch.dict('os.environ', {'HEROKU_API_TOKEN': ''})
+        self.env_patcher.start()
+        self.echo_patcher = patch("heroku_tools.settings.click.echo")
+        self.echo_patcher.start()
+
+    def tearDown(self):
+        self.env_patcher.stop()
+        self.echo_patcher.stop()
+        shutil.rmtree(self.tmp)
+
+    @patch("heroku_tools.settings._auth_token")
+    @patch("heroku_tools.settings.yaml.load")
+    def test_lazy(self, load, auth_token):
+        """Test that nothing is read or run until a setting is used."""
+        context = settings.Settings(self.conf)
+        self.assertFalse(load.called)
+        load.return_value = {'settings': {'app_conf_dir': '/foo'}}
+        self.assertEqual(context.app_conf_dir, '/foo')
+        self.assertEqual(context.app_conf_dir, '/foo')
+        self.assertEqual(load.call_count, 1)
+        self.assertFalse(auth_token.called)
+
+    def test_read_only(self):
+        context = settings.Settings(self.conf)
+        with self.assertRaises(AttributeError):
+            context.app_conf_dir = '/bar'
+        self.assertEqual(context.app_conf_dir, '/foo')
+        # defaults are not modified by the local settings file
+        self.assertEqual(settings.DEFAULT_SETTINGS['app_conf_dir'], settings.CWD)
+
+    @patch("heroku_tools.settings._auth_token", return_value='from-cli')
+    def test_heroku_api_token(self, auth_token):
+        """Test token resolution, and caching in the credentials file."""
+        with patch.dict('os.environ', {'HEROKU_API_TOKEN': 'from-env'}):
+            context = settings.Settings(self.conf)
+            self.assertEqual(context.heroku_api_token, 'from-env')
+        self.assertFalse(auth_token.called)
+
+        context = settings.Settings(self.conf)
+        self.assertEqual(context.heroku_api_token, 'from-cli')
+        self.assertEqual(auth_token.call_count, 1)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.credentials).st_mode), 0o600
+        )
+        # a new context reads the token from the credentials file
+        context = settings.Settings(self.conf)
+        self.assertEqual(context.heroku_api_token, 'from-cli')
+        self.assertEqual(auth_token.call_count, 1)
+
+        # ...until it expires
+        settings.write_credentials(self.credentials, 'expired', -1)
+        self.assertIsNone(settings.read_credentials(self.credentials))
+        context = settings.Settings(self.conf)
+        self.assertEqual(context.heroku_api_token, 'from-cli')
+        self.assertEqual(auth_token.call_count, 2)
+
+    @patch("heroku_tools.settings._auth_token", return_value='from-cli')
+    def test_discard_heroku_api_token(self, auth_token):
+        """Test that a rejected token is removed from the credentials file."""
+        from heroku_tools import heroku
+        with patch.dict('os.environ', {'HEROKU_API_TOKEN': 'from-env'}):
+            context = settings.Settings(self.conf)
+            self.assertEqual(context.heroku_api_token, 'from-env')
+            self.assertIsNone(context.discard_heroku_api_token())
+
+        context = settings.Settings(self.conf)
+        self.assertEqual(context.heroku_api_token, 'from-cli')
+        self.assertTrue(os.path.exists(self.credentials))
+        client = Mock()
+        client.request.return_value = Mock(status_code=401, text='Unauthorized')  # noqa
+        with patch('heroku_tools.settings.context', context), \
+                patch('heroku_tools.heroku.get_client', return_value=client):
+            with self.assertRaises(HerokuError) as ex:
+                heroku.api_request('GET', '/apps/%s', 'foo')
+        self.assertIn(self.credentials, unicode(ex.exception))
+        self.assertFalse(os.path.exists(self.credentials))
+        # the next run fetches a new token
+        context = settings.Settings(self.conf)
+        self.assertEqual(context.heroku_api_token, 'from-cli')
+        self.assertEqual(auth_token.call_count, 2)
+
+    def test_heroku_api_token_threads(self):
+        """Test that racing threads share a single token fetch."""
+        import threading
+        import time
+
+        def slow_token():
+            time.sleep(0.05)
+            return 'from-cli'
+
+        context = settings.Settings(self.conf)
+        tokens = []
+        with patch("heroku_tools.settings._auth_token", side_effect=slow_token) as auth_token:  # noqa
+            threads = [
+                threading.Thread(target=lambda: tokens.append(context.heroku_api_token))  # noqa
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(tokens, ['from-cli'] * 5)
+        self.assertEqual(auth_token.call_count, 1)
+
+    def test_help_runs_no_subprocess(self):
+        """Test that --help doesn't resolve settings or fork anything."""
+        from click.testing import CliRunner
+        from heroku_tools import entry_point
+        context = settings.Settings(self.conf)
+        with patch('heroku_tools.settings.context', context), \
+                patch('subprocess.Popen', side_effect=AssertionError), \
+                patch('os.fork', side_effect=AssertionError):
+            runner = CliRunner()
+            for args in [['--help']] + [
+                [name, '--help'] for name in entry_point.commands
+            ]:
+                result = runner.invoke(entry_point, args)
+                self.assertEqual(result.exit_code, 0, result.output)
+        self.assertNotIn('_loaded', context.__dict__)
+        self.assertNotIn('_token', context.__dict__)
+
+
 class UtilsTests(unittest.TestCase):
 
     def setUp(self):
@@ -201,6 +1132,65 @@ class UtilsTests(unittest.TestCase):
         answer_default_false = utils.prompt_for_action("Do you like hulahoop ?", False)
         self.assertFalse(answer_default_false)
 
+    def test_run_concurrently(self):
+        """Test that calls overlap, and results and errors are gathered."""
+        import time
+
+        def slow(value):
+            time.sleep(0.2)
+            return value
+
+        start = time.time()
+        results = utils.run_concurrently({
+            'a': (slow, (1,)),
+            'b': (slow, (2,)),
+            'c': (slow, (3,)),
+        })
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(
+            dict((k, v[0]) for k, v in results.items()),
+            {'a': 1, 'b': 2, 'c': 3}
+        )
+        self.assertGreaterEqual(results['a'][1], 0.2)
+
+        def fail():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            utils.run_concurrently({'a': (slow, (1,)), 'b': (fail, ())})
+
+    def test_echo_output_prefix(self):
+        """Test that echo prefixes every line, per thread."""
+        utils.echo("no prefix")
+        self.assertEqual(self.mock_click_echo.call_args, call(u'no prefix'))
+        with utils.output_prefix('[dev] '):
+            utils.echo("line1\nline2")
+            self.assertEqual(
+                self.mock_click_echo.call_args,
+                call(u'[dev] line1\n[dev] line2')
+            )
+            with utils.output_prefix('[x] '):
+                utils.echo(u"nested")
+                self.assertEqual(
+                    self.mock_click_echo.call_args,
+                    call(u'[dev] [x] nested')
+                )
+        utils.echo(1)
+        self.assertEqual(self.mock_click_echo.call_args, call(u'1'))
+
+    def test_run_concurrently_output_prefix(self):
+        """Test that calls inherit the output prefix of the caller."""
+        with utils.output_prefix('[live] '):
+            utils.run_concurrently({
+                'a': (utils.echo, ('from a',)),
+                'b': (utils.echo, ('from b',)),
+            })
+        self.assertEqual(
+            sorted(c[0][0] for c in self.mock_click_echo.call_args_list),
+            [u'[live] from a', u'[live] from b']
+        )
+        self.assertEqual(utils.get_output_prefix(), '')
+
     def test_split_print_lines(self):
         input_text = "line1, line2, line3"
         utils.split_print_lines(input_text, delimiter=",")
@@ -214,22 +1204,820 @@ class UtilsTests(unittest.TestCase):
         )
 
 
+class TimingTests(unittest.TestCase):
+
+    """Tests for the timing instrumentation."""
+
+    def tearDown(self):
+        from heroku_tools import timing
+        timing.stop()
+
+    def test_disabled(self):
+        from heroku_tools import timing
+        calls = []
+
+        @timing.timed('func')
+        def func(x):
+            calls.append(x)
+            return x * 2
+
+        self.assertFalse(timing.is_recording())
+        # the same no-op span is returned every time
+        self.assertIs(timing.span('a'), timing.span('b', 'git', x=1))
+        with timing.span('a') as s:
+            s.set(x=1)
+        timing.record('a', 'process', 0, 1)
+        self.assertEqual(func(2), 4)
+        self.assertEqual(calls, [2])
+
+    def test_recording(self):
+        from heroku_tools import timing
+        from heroku_tools.utils import run_concurrently
+
+        @timing.timed('double', 'call')
+        def double(x):
+            with timing.span('inner', 'git', x=x):
+                return x * 2
+
+        recorder = timing.start()
+        with timing.span('outer', app='foo') as s:
+            run_concurrently({'one': (double, (1,)), 'two': (double, (2,))})
+            s.set(result='ok')
+        with self.assertRaises(ValueError):
+            with timing.span('failing'):
+                raise ValueError()
+        self.assertIs(timing.stop(), recorder)
+        with timing.span('not recorded'):
+            pass
+
+        spans = dict((sp.name, sp) for sp in recorder.spans)
+        self.assertEqual(
+            sorted(spans),
+            ['double', 'failing', 'inner', 'one', 'outer', 'two']
+        )
+        self.assertEqual(spans['outer'].args, {'app': 'foo', 'result': 'ok'})  # noqa
+        self.assertEqual(spans['failing'].args, {'error': 'ValueError'})
+        self.assertNotEqual(spans['one'].thread, spans['outer'].thread)
+        self.assertLessEqual(spans['outer'].start, spans['one'].start)
+        self.assertGreaterEqual(spans['outer'].end, spans['one'].end)
+
+        summary = dict((row[0], row[1:]) for row in recorder.summary())
+        self.assertEqual(summary['double'][:2], ('call', 2))
+        self.assertEqual(summary['inner'][:2], ('git', 2))
+
+        trace = recorder.chrome_trace()
+        events = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+        threads = [e for e in trace['traceEvents'] if e['ph'] == 'M']
+        self.assertEqual(len(events), 8)
+        self.assertGreaterEqual(len(threads), 2)
+        self.assertEqual(
+            set(e['tid'] for e in events),
+            set(e['tid'] for e in threads)
+        )
+        outer = [e for e in events if e['name'] == 'outer'][0]
+        self.assertEqual(outer['cat'], 'phase')
+        self.assertGreaterEqual(outer['dur'], 0)
+        json.dumps(trace)
+
+    def test_cli_options(self):
+        from click.testing import CliRunner
+        from heroku_tools import entry_point, timing
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        trace = os.path.join(tmp, 'trace.json')
+        with patch.object(settings, 'context', Mock(app_conf_dir=tmp)):
+            result = CliRunner().invoke(
+                entry_point,
+                ['--timings', '--trace', trace, 'config-audit', '--json']
+            )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Timings', result.output)
+        self.assertIn('Trace written to %s' % trace, result.output)
+        with open(trace) as f:
+            self.assertIn('traceEvents', json.load(f))
+        self.assertFalse(timing.is_recording())
+
+
+class DeployTests(unittest.TestCase):
+
+    """Tests for the deploy module."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for env in ('eu-1', 'eu-2', 'us-1'):
+            open(os.path.join(self.tmp, '%s.conf' % env), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_resolve_environments(self):
+        from heroku_tools.deploy import resolve_environments
+        self.assertEqual(resolve_environments(['live'], self.tmp), ['live'])
+        self.assertEqual(
+            resolve_environments(['eu-*'], self.tmp),
+            ['eu-1', 'eu-2']
+        )
+        self.assertEqual(
+            resolve_environments(['us-1', '*-1', 'eu-2'], self.tmp),
+            ['us-1', 'eu-1', 'eu-2']
+        )
+        import click
+        with self.assertRaises(click.BadParameter):
+            resolve_environments(['ap-*'], self.tmp)
+
+    @patch('heroku_tools.heroku.toggle_maintenance')
+    def test_maintenance_window(self, toggle_maintenance):
+        from heroku_tools.deploy import MaintenanceWindow
+        window = MaintenanceWindow('foo')
+        window.close()
+        self.assertIsNone(window.duration)
+        window.open()
+        window.open()
+        self.assertTrue(window.is_open)
+        window.close()
+        window.open()
+        window.close()
+        self.assertFalse(window.is_open)
+        self.assertGreaterEqual(window.duration, 0)
+        self.assertEqual(
+            toggle_maintenance.call_args_list,
+            [call('foo', True), call('foo', False)] * 2
+        )
+
+    @patch('heroku_tools.utils.echo')
+    @patch('heroku_tools.heroku.wait_for_release')
+    @patch('heroku_tools.heroku.promote_app')
+    @patch('heroku_tools.heroku.toggle_maintenance')
+    def test_execute_maintenance(self, toggle_maintenance, promote_app, wait_for_release, echo):  # noqa
+        """Test that the page is up for the whole deploy without flagged tasks."""  # noqa
+        from heroku_tools.deploy import Deployment
+        from heroku_tools.tasks import Task, TaskResult
+        events = []
+        toggle_maintenance.side_effect = lambda app, on: events.append('maintenance %s' % on)  # noqa
+        promote_app.side_effect = lambda app: events.append('promote')
+
+        def run(task, group=None):
+            events.append('task %s' % task.command)
+            return TaskResult(task.name, 0, 0.0, 1)
+
+        app = Mock(
+            app_name='foo',
+            use_pipeline=True,
+            upstream_app='bar',
+            post_deploy_tasks=[
+                'heroku run python manage.py migrate -a foo',
+                'heroku run python manage.py clear_cache -a foo',
+            ],
+            warmup=None,
+            wait_for_dynos=False,
+            add_tag=False,
+        )
+        deployment = Deployment('live', app, 'master', False)
+        deployment.local_hash = 'abcdef0'
+        with patch.object(Task, 'run', run):
+            deployment.execute(maintenance=True)
+        self.assertEqual(events, [
+            'maintenance True',
+            'promote',
+            'task heroku run python manage.py migrate -a foo',
+            'task heroku run python manage.py clear_cache -a foo',
+            'maintenance False',
+        ])
+        self.assertFalse(deployment.window.is_open)
+
+    @patch('heroku_tools.utils.echo')
+    @patch('heroku_tools.heroku.wait_for_release')
+    @patch('heroku_tools.heroku.promote_app')
+    @patch('heroku_tools.heroku.toggle_maintenance')
+    def test_execute_release_failed(self, toggle_maintenance, promote_app, wait_for_release, echo):  # noqa
+        """Test that the maintenance page is left up if the release fails."""
+        from heroku_tools.deploy import Deployment
+        app = Mock(
+            app_name='foo',
+            use_pipeline=True,
+            upstream_app='bar',
+            post_deploy_tasks=[],
+            warmup=None,
+            wait_for_dynos=False,
+        )
+        deployment = Deployment('live', app, 'master', False)
+        deployment.local_hash = 'abcdef0'
+        wait_for_release.side_effect = HerokuError(u"Release v2 failed")
+        with self.assertRaises(HerokuError):
+            deployment.execute(maintenance=True)
+        self.assertTrue(deployment.window.is_open)
+        self.assertEqual(toggle_maintenance.call_args_list, [call('foo', True)])  # noqa
+        self.assertEqual(echo.call_args[0][0], "Maintenance page has been left up")  # noqa
+
+
+class TaskTests(unittest.TestCase):
+
+    """Tests for the post-deployment task runner."""
+
+    def setUp(self):
+        self.echo_patcher = patch("heroku_tools.utils.click.echo")
+        self.echo = self.echo_patcher.start()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.echo_patcher.stop()
+        shutil.rmtree(self.tmp)
+
+    def output(self):
+        return [c[0][0] for c in self.echo.call_args_list]
+
+    def test_parse_tasks(self):
+        from heroku_tools.config import ConfigurationError
+        from heroku_tools.tasks import parse_tasks
+        tasks = parse_tasks([
+            'echo one',
+            'echo two',
+            {'name': 'three', 'command': 'echo three', 'timeout': 5},
+            {'name': 'four', 'command': 'echo four', 'depends_on': ['three'], 'retries': 2},  # noqa
+        ])
+        self.assertEqual([t.name for t in tasks], ['echo one', 'echo two', 'three', 'four'])  # noqa
+        # plain commands run in order, named tasks only after dependencies
+        self.assertEqual(tasks[0].depends_on, [])
+        self.assertEqual(tasks[1].depends_on, ['echo one'])
+        self.assertEqual(tasks[2].depends_on, [])
+        self.assertEqual(tasks[2].timeout, 5)
+        self.assertEqual(tasks[3].depends_on, ['three'])
+        self.assertEqual(tasks[3].retries, 2)
+        self.assertEqual(parse_tasks(None), [])
+
+        # repeated plain commands are all run, in order
+        tasks = parse_tasks([
+            'python manage.py clear_cache',
+            'python manage.py migrate',
+            'python manage.py clear_cache',
+        ])
+        self.assertEqual([t.name for t in tasks], [
+            'python manage.py clear_cache',
+            'python manage.py migrate',
+            'python manage.py clear_cache #2',
+        ])
+        self.assertEqual([t.command for t in tasks][2], 'python manage.py clear_cache')  # noqa
+        self.assertEqual(tasks[2].depends_on, ['python manage.py migrate'])
+
+        # 'run' tasks are run in a one-off dyno on the deployed app
+        tasks = parse_tasks([
+            {'name': 'migrate', 'run': 'python manage.py migrate'},
+            {'name': 'other', 'run': 'true', 'app': 'bar'},
+            {'name': 'local', 'command': 'true'},
+        ], 'foo')
+        self.assertEqual([t.application for t in tasks], ['foo', 'bar', None])
+        self.assertEqual(tasks[0].command, 'python manage.py migrate')
+
+        for invalid in (
+            [{'name': 'a'}],
+            [{'name': 'a', 'command': 'x', 'run': 'y'}],
+            [{'name': 'a', 'run': 'y'}],
+            [{'name': 'a', 'command': 'x'}, {'name': 'a', 'command': 'y'}],
+            [{'name': 'a', 'command': 'x', 'depends_on': ['b']}],
+            [
+                {'name': 'a', 'command': 'x', 'depends_on': ['b']},
+                {'name': 'b', 'command': 'y', 'depends_on': ['a']},
+            ],
+        ):
+            with self.assertRaises(ConfigurationError):
+                parse_tasks(invalid)
+
+    def test_run_tasks(self):
+        """Test that independent tasks overlap, and dependencies are respected."""
+        import time
+        from heroku_tools.tasks import parse_tasks, run_tasks
+        marker = os.path.join(self.tmp, 'marker')
+        tasks = parse_tasks([
+            {'name': 'slow-a', 'command': 'sleep 0.3'},
+            {'name': 'slow-b', 'command': 'sleep 0.3'},
+            {'name': 'first', 'command': 'touch %s' % marker},
+            {'name': 'second', 'command': 'ls %s' % marker, 'depends_on': ['first']},  # noqa
+        ])
+        start = time.time()
+        results = run_tasks(tasks)
+        self.assertLess(time.time() - start, 0.55)
+        self.assertEqual(
+            sorted((r.name, r.returncode) for r in results),
+            [('first', 0), ('second', 0), ('slow-a', 0), ('slow-b', 0)]
+        )
+        self.assertTrue(any(
+            l.startswith(u'[second] [') and l.endswith(marker)
+            for l in self.output()
+        ))
+
+    def test_run_tasks_fails_fast(self):
+        from heroku_tools.tasks import parse_tasks, run_tasks, TaskError
+        counter = os.path.join(self.tmp, 'counter')
+        tasks = parse_tasks([
+            {'name': 'flaky', 'command': 'sh -c "echo x >> %s; exit 3"' % counter, 'retries': 1},  # noqa
+            {'name': 'long', 'command': 'sleep 5'},
+            {'name': 'after', 'command': 'echo after', 'depends_on': ['flaky']},
+        ])
+        with self.assertRaises(TaskError):
+            run_tasks(tasks)
+        # the failing task was retried once, and nothing ran after it
+        self.assertEqual(open(counter).read(), 'x\nx\n')
+        self.assertFalse(any(l.startswith(u'[after]') for l in self.output()))
+        self.assertIn(u'Tasks not run: after', self.output())
+
+    def test_task_timeout(self):
+        from heroku_tools.tasks import Task
+        result = Task('t', 'sleep 5', timeout=0.2).run()
+        self.assertIsNone(result.returncode)
+        self.assertLess(result.elapsed, 2)
+
+    def test_maintenance_window(self):
+        """Test that the window is only open around maintenance tasks."""
+        from heroku_tools.tasks import TaskError, parse_tasks, run_tasks
+        events = []
+
+        class Window(object):
+            def open(window):
+                events.append(('open', sorted(os.listdir(self.tmp))))
+
+            def close(window):
+                events.append(('close', sorted(os.listdir(self.tmp))))
+
+        def tasks(migrate='true'):
+            return parse_tasks([
+                {'name': 'build', 'command': 'touch %s/build' % self.tmp},
+                {'name': 'migrate', 'command': migrate, 'depends_on': ['build'], 'maintenance': True},  # noqa
+                {'name': 'after', 'command': 'touch %s/after' % self.tmp, 'depends_on': ['migrate']},  # noqa
+            ])
+
+        # close() may be called when the window isn't open, so look at
+        # the first close after the open.
+        run_tasks(tasks('touch %s/migrate' % self.tmp), window=Window())
+        opened = [i for i, e in enumerate(events) if e[0] == 'open']
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(events[opened[0]], ('open', ['build']))
+        self.assertEqual(events[opened[0] + 1], ('close', ['build', 'migrate']))  # noqa
+
+        # if a maintenance task fails, the window is left open
+        del events[:]
+        os.remove(os.path.join(self.tmp, 'build'))
+        with self.assertRaises(TaskError):
+            run_tasks(tasks('false'), window=Window())
+        self.assertEqual([e[0] for e in events if e[0] == 'open'], ['open'])
+        self.assertEqual(events[-1][0], 'open')
+
+
+class WarmupTests(unittest.TestCase):
+
+    """Tests for the post-deployment warm-up."""
+
+    def test_parse_warmup(self):
+        from heroku_tools.config import ConfigurationError
+        from heroku_tools.warmup import parse_warmup
+        self.assertIsNone(parse_warmup(None, 'foo'))
+        w = parse_warmup({'urls': ['/', '/login/', 'https://cdn.example.com/x']}, 'foo')  # noqa
+        self.assertEqual(w.urls, [
+            'https://foo.herokuapp.com/',
+            'https://foo.herokuapp.com/login/',
+            'https://cdn.example.com/x',
+        ])
+        self.assertEqual((w.concurrency, w.requests, w.timeout), (4, 10, 10))
+        w = parse_warmup({
+            'base_url': 'https://www.example.com/',
+            'concurrency': 8,
+            'requests': 2,
+            'urls': ['/'],
+        }, 'foo')
+        self.assertEqual(w.urls, ['https://www.example.com/'])
+        self.assertEqual(str(w), "1 URLs x 2 requests (8 at a time)")
+        for invalid in ({'urls': []}, ['/'], {'urls': ['/'], 'concurrency': 0}):  # noqa
+            with self.assertRaises(ConfigurationError):
+                parse_warmup(invalid, 'foo')
+
+    def test_percentile(self):
+        from heroku_tools.warmup import percentile
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 90), 3)
+        self.assertIsNone(percentile([], 50))
+
+    def test_run(self):
+        import BaseHTTPServer
+        import SocketServer
+        import socket
+        import threading
+        import time
+        from heroku_tools.warmup import Warmup
+        state = {'active': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with lock:
+                    state['active'] += 1
+                    state['peak'] = max(state['peak'], state['active'])
+                time.sleep(0.01)
+                with lock:
+                    state['active'] -= 1
+                self.send_response(500 if self.path == '/broken' else 200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write('ok')
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            # keep-alive handler threads are tracked, so that they can be
+            # closed and joined, rather than fail at interpreter exit.
+            daemon_threads = True
+            connections = []
+
+            def process_request(self, request, client_address):
+                thread = threading.Thread(
+                    target=self.process_request_thread,
+                    args=(request, client_address)
+                )
+                thread.daemon = True
+                self.connections.append((request, thread))
+                thread.start()
+
+            def close(self):
+                self.shutdown()
+                for request, thread in self.connections:
+                    try:
+                        request.shutdown(socket.SHUT_RDWR)
+                    except socket.error:
+                        pass
+                    thread.join(1.0)
+                self.server_close()
+
+        server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01})  # noqa
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%i' % server.server_port
+        try:
+            results = Warmup(
+                [url + '/', url + '/broken', 'http://127.0.0.1:1/'],
+                concurrency=3,
+                requests=5
+            ).run()
+        finally:
+            server.close()
+        ok, broken, refused = results
+        self.assertEqual((ok.url, ok.requests, ok.errors), (url + '/', 5, 0))
+        self.assertTrue(0.01 <= ok.p50 <= ok.p90 <= ok.p99 <= ok.max)
+        self.assertEqual(broken.errors, 5)
+        self.assertIsNotNone(broken.p50)
+        # no response at all - errors, but no latencies
+        self.assertEqual(refused.errors, 5)
+        self.assertIsNone(refused.p50)
+        # requests were made concurrently, but within the limit
+        self.assertTrue(2 <= state['peak'] <= 3)
+
+
+class ProcessTests(unittest.TestCase):
+
+    """Tests for the streaming process executor."""
+
+    def setUp(self):
+        self.echo_patcher = patch("heroku_tools.utils.click.echo")
+        self.echo = self.echo_patcher.start()
+
+    def tearDown(self):
+        self.echo_patcher.stop()
+
+    def test_run(self):
+        """Test that stdout and stderr are both read, and timestamped."""
+        import re
+        from heroku_tools import process
+        lines = []
+        r = process.run(
+            ['sh', '-c', 'echo out; echo err >&2; printf "a\\rb\\n"; exit 2'],
+            on_line=lambda stream, line: lines.append((stream, line))
+        )
+        self.assertEqual(r.returncode, 2)
+        self.assertIsNone(r.timed_out)
+        self.assertEqual(sorted(r.tail), ['a', 'b', 'err', 'out'])
+        self.assertIn(('stderr', 'err'), lines)
+        self.assertIn(('stdout', 'out'), lines)
+        output = [c[0][0] for c in self.echo.call_args_list]
+        self.assertEqual(len(output), 4)
+        self.assertTrue(all(re.match(r'^\[\d\d:\d\d:\d\d\] ', l) for l in output))
+
+    def test_bounded_tail(self):
+        """Test that a chatty stderr neither deadlocks nor grows memory."""
+        from heroku_tools import process
+        r = process.run(
+            ['sh', '-c', 'i=0; while [ $i -lt 5000 ]; do echo "line $i" >&2; i=$((i+1)); done'],  # noqa
+            tail_size=3,
+            echo=False
+        )
+        self.assertEqual(r.returncode, 0)
+        self.assertEqual(r.tail, ['line 4997', 'line 4998', 'line 4999'])
+        self.assertFalse(self.echo.called)
+
+    def test_timeouts(self):
+        from heroku_tools import process
+        r = process.run(['sleep', '5'], timeout=0.2)
+        self.assertEqual(r.timed_out, 'wall')
+        self.assertLess(r.elapsed, 2)
+        r = process.run(
+            ['sh', '-c', 'echo start; sleep 5'],
+            timeout=10,
+            idle_timeout=0.3
+        )
+        self.assertEqual(r.timed_out, 'idle')
+        self.assertEqual(r.tail, ['start'])
+        # the orphaned sleep keeps the pipes open, so we stop waiting for
+        # them after the grace period.
+        self.assertLess(r.elapsed, process.KILL_GRACE_PERIOD + 1)
+
+
 class GitTests(unittest.TestCase):
 
     """Tests for the git module functions."""
 
-    @patch('heroku_tools.git.run_git_cmd')
-    def test_get_commits(self, mock_git):
-        """Test the parsing of one-line git commit logs."""
-        # check that it works with variables commit hash lengths (git
-        # defaults to 7 chars, but may increase this based on the
-        # likelihood of a clash.
-        mock_git.return_value = (
-            "81a5ea8 Fix failing tests\n"
-            "62d49e9ab Refactor foobar"
-        )
-        commits = get_commits('ABC', 'DEF')
-        mock_git.assert_called_once_with('log --oneline --no-merges ABC..DEF')
-        self.assertEqual(len(commits), 2)
-        self.assertEqual(commits[0], ['81a5ea8', 'Fix failing tests'])
-        self.assertEqual(commits[1], ['62d49e9ab', 'Refactor foobar'])
+    def make_repo(self):
+        """Create a temporary git repo, and point settings at it.
+
+        Returns a 2-tuple of functions - git(*args), which runs a git
+        command in the repo, and commit(message, **files) which writes
+        files and commits them, returning the abbreviated hash.
+
+        """
+        import subprocess
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        patcher = patch('heroku_tools.git.get_work_dir', return_value=tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def git(*args):
+            return subprocess.check_output(
+                ('git', '-C', tmp, '-c', 'user.name=x', '-c', 'user.email=x@x')
+                + args
+            ).strip()
+
+        def commit(message, **files):
+            for name, content in files.items():
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(content)
+            git('add', '-A')
+            git('commit', '-q', '--allow-empty', '-m', message)
+            return git('rev-parse', '--short', 'HEAD')
+
+        git('init', '-q')
+        return git, commit
+
+    @patch('heroku_tools.git.time.time')
+    @patch('heroku_tools.git.process.echo_line')
+    def test_push_progress(self, echo_line, now):
+        """Test parsing of `git push --progress` output."""
+        from heroku_tools.git import PushProgress
+        progress = PushProgress()
+        self.assertEqual(progress.stats(), (0, 0, 0.0))
+        for t, line in (
+            (0.0, 'Counting objects:  50% (1/2)'),
+            (0.1, 'Counting objects: 100% (2/2), done.'),
+            (0.2, 'Writing objects:  10% (1/10)'),
+            (0.5, 'Writing objects:  50% (5/10), 1.00 MiB | 2.00 MiB/s'),
+            (1.3, 'Writing objects:  90% (9/10), 2.50 MiB | 2.27 MiB/s'),
+            (1.4, 'Writing objects: 100% (10/10), 3.00 MiB | 2.50 MiB/s, done.'),  # noqa
+            (1.5, 'Total 10 (delta 2), reused 0 (delta 0)'),
+            (1.6, 'remote: Compressing source files... done.'),
+        ):
+            now.return_value = t
+            progress.on_line('stderr', line)
+        self.assertEqual(progress.stats(), (10, 3 * 1024 * 1024, 1.2))
+        # progress is throttled, but completed phases are always echoed
+        self.assertEqual([c[0][0] for c in echo_line.call_args_list], [
+            'Counting objects:  50% (1/2)',
+            'Counting objects: 100% (2/2), done.',
+            'Writing objects:  10% (1/10)',
+            'Writing objects: 90% (9/10), 2.50 MiB | 2.27 MiB/s',
+            'Writing objects: 100% (10/10), 3.00 MiB | 2.50 MiB/s, done.',
+            'Total 10 (delta 2), reused 0 (delta 0)',
+            'remote: Compressing source files... done.',
+        ])
+
+    def test_push(self):
+        """Test pushing to a local remote reports the pack written."""
+        from heroku_tools.git import push
+        git, commit = self.make_repo()
+        commit('Initial', a='a' * 10000)
+        remote = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, remote)
+        git('init', '-q', '--bare', remote)
+        with patch('heroku_tools.utils.click.echo'):
+            stats = push(remote, 'HEAD', 'master')
+        self.assertEqual(stats.objects, 3)
+        self.assertTrue(stats.bytes > 0)
+        self.assertEqual(git('--git-dir', remote, 'rev-parse', 'master'), git('rev-parse', 'HEAD'))  # noqa
+        with patch('heroku_tools.utils.click.echo'):
+            self.assertEqual(push(remote, 'HEAD', 'master').objects, 0)
+
+    @patch.dict(os.environ, {'GIT_COMMITTER_NAME': 'Fred', 'GIT_COMMITTER_EMAIL': 'fred@example.com'})  # noqa
+    def test_create_tags(self):
+        """Test creating annotated tags in a single batch."""
+        import datetime
+        from dateutil import tz
+        from heroku_tools.git import Tag, create_tags, get_tags
+        git, commit = self.make_repo()
+        first = git('rev-parse', commit('First', a='a'))
+        second = git('rev-parse', commit('Second', a='b'))
+        git('tag', '-a', '1', '-m', 'Existing', first)
+        deployed_at = datetime.datetime(2016, 9, 1, 12, tzinfo=tz.tzutc())
+        created = create_tags([
+            Tag('1', first, 'Deployed v1', deployed_at),
+            Tag('2', second, u'Deployed by caf\xe9', deployed_at),
+            Tag('live-2', second, 'Deployed v2\n', None),
+        ])
+        self.assertEqual([t.name for t in created], ['2', 'live-2'])
+        self.assertEqual(get_tags(), set(['1', '2', 'live-2']))
+        # existing tags are left alone
+        self.assertEqual(git('tag', '-l', '-n1', '1').split(None, 1)[1], 'Existing')  # noqa
+        self.assertEqual(git('rev-parse', '2^{commit}'), second)
+        self.assertEqual(git('cat-file', 'tag', '2').splitlines()[3], 'tagger Fred <fred@example.com> 1472731200 +0000')  # noqa
+        self.assertEqual(git('tag', '-l', '--format=%(contents)', '2').decode('utf-8'), u'Deployed by caf\xe9')  # noqa
+        self.assertEqual(create_tags([Tag('2', second, 'Again', None)]), [])
+
+    @patch.dict(os.environ, {'GIT_COMMITTER_NAME': 'Fred', 'GIT_COMMITTER_EMAIL': 'fred@example.com'})  # noqa
+    def test_tag_backfill(self):
+        """Test tagging the past deployments of an app."""
+        from click.testing import CliRunner
+        from heroku_tools import git as git_module, history
+        git, commit = self.make_repo()
+        first = commit('First', a='a')
+        second = commit('Second', a='b')
+        git('tag', '-a', 'live-1', '-m', 'Existing', first)
+
+        def release(version, description):
+            return HerokuRelease({
+                'version': version,
+                'description': description,
+                'app': {'name': 'foo'},
+                'user': {'email': 'fred@example.com'},
+                'updated_at': '2016-09-01T12:00:00Z',
+            })
+
+        releases = [
+            release(1, 'Deploy %s' % first),
+            release(2, 'Set FOO config vars'),
+            release(3, 'Deploy %s' % second),
+            release(4, 'Deploy abcdef0'),
+            release(5, 'Promote staging v9 %s' % first),
+        ]
+        worker = git_module.GitWorker()
+        self.addCleanup(worker.close)
+        with patch('heroku_tools.heroku.iter_releases', return_value=iter(releases)) as iter_releases, \
+                patch('heroku_tools.git.get_worker', return_value=worker), \
+                patch.object(history, '_app_name', return_value='foo'), \
+                patch('heroku_tools.utils.click.echo') as echo:  # noqa
+            result = CliRunner().invoke(history.tag_backfill, ['live', '--prefix', 'live-'])  # noqa
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(iter_releases.call_args[0], ('foo',))
+        self.assertEqual(iter_releases.call_args[1]['order'], 'asc')
+        self.assertEqual(git_module.get_tags(), set(['live-1', 'live-3', 'live-5']))  # noqa
+        self.assertEqual(git('rev-parse', '--short', 'live-5^{commit}'), first)  # noqa
+        self.assertEqual(git('tag', '-l', '--format=%(contents)', 'live-3'), 'Deployed to foo by fred@example.com')  # noqa
+        output = [c[0][0] for c in echo.call_args_list]
+        self.assertEqual(output, [
+            u"Skipping v4: commit abcdef0 not found",
+            u"live (foo): created 2 tags, 1 already existed, 1 commits not found",  # noqa
+        ])
+
+    def test_get_range(self):
+        """Test single-pass range analysis against a real repo."""
+        from heroku_tools.git import get_range
+        git, commit = self.make_repo()
+        patcher = patch('heroku_tools.git.get_range_cache', return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        base = commit('Initial', a='a', b='b')
+        c1 = commit(u'Odd subject: \u00e9 \t "quoted"'.encode('utf-8'), a='aa')
+        git('mv', 'b', 'c d')
+        c2 = commit('Rename b\n\nwith a body', **{'e\nf': 'new'})
+        c3 = commit('Empty commit')
+        analysis = get_range(base, c3)
+        self.assertEqual(
+            analysis.commits,
+            [
+                (c3, 'Empty commit'),
+                (c2, 'Rename b'),
+                (c1, u'Odd subject: \u00e9 \t "quoted"'.encode('utf-8')),
+            ]
+        )
+        self.assertEqual(analysis.commit_files[c3], [])
+        self.assertEqual(analysis.commit_files[c1], [('M', 'a')])
+        self.assertEqual(
+            sorted(analysis.commit_files[c2]),
+            [('A', 'e\nf'), ('R', 'b'), ('R', 'c d')]
+        )
+        self.assertEqual(analysis.files, ['a', 'b', 'c d', 'e\nf'])
+        self.assertEqual(get_range(c3, c3).commits, [])
+        # the legacy wrappers return the same data
+        self.assertEqual(get_commits(base, c3), analysis.commits)
+        self.assertEqual(get_files(base, c3), analysis.files)
+        with self.assertRaises(Exception):
+            get_range(base, 'does-not-exist')
+
+    def test_get_range_cache(self):
+        """Test that range analysis is cached against the full hashes."""
+        from heroku_tools import git as git_module
+        git, commit = self.make_repo()
+        base = commit('Initial', a='a')
+        head = commit(u'Caf\u00e9'.encode('utf-8'), a='b')
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        range_cache = cache.DiskCache(tmp, 1024 * 1024)
+        worker = git_module.GitWorker()
+        self.addCleanup(worker.close)
+        with patch('heroku_tools.git.get_range_cache', return_value=range_cache), \
+                patch('heroku_tools.git.get_worker', return_value=worker), \
+                patch('heroku_tools.git._analyse_range', wraps=git_module._analyse_range) as analyse:  # noqa
+            analysis = git_module.get_range(base, head)
+            self.assertEqual(analyse.call_count, 1)
+            # abbreviated or full, the hashes resolve to the same key
+            cached = git_module.get_range(git('rev-parse', base), head[:5])
+            self.assertEqual(analyse.call_count, 1)
+            self.assertEqual(cached, analysis)
+            self.assertIsInstance(cached.commits[0][1], str)
+            git_module.get_range(base, head, use_cache=False)
+            self.assertEqual(analyse.call_count, 2)
+
+    def test_git_worker(self):
+        """Test lookups via the persistent cat-file process."""
+        from heroku_tools import git as git_module
+        git, commit = self.make_repo()
+        first = commit('First', a='a')
+        second = commit('Second', a='b')
+        git('checkout', '-q', '-b', 'feature/foo')
+        worker = git_module.GitWorker()
+        self.addCleanup(worker.close)
+        sha, object_type, content = worker.read_object('HEAD~1')
+        self.assertEqual(sha, git('rev-parse', 'HEAD~1'))
+        self.assertEqual(object_type, 'commit')
+        self.assertIn('\n\nFirst\n', content)
+        self.assertEqual(worker.resolve('feature/foo')[:7], second)
+        process = worker._process
+        with self.assertRaises(git_module.GitError):
+            worker.resolve('no-such-branch')
+        with self.assertRaises(git_module.GitError):
+            worker.resolve('HEAD HEAD')
+        self.assertIs(worker._process, process)
+
+        # if the process dies, it is restarted on the next lookup
+        process.kill()
+        process.wait()
+        self.assertEqual(worker.resolve(first)[:7], first)
+        self.assertIsNot(worker._process, process)
+
+        with patch('heroku_tools.git.get_worker', return_value=worker):
+            self.assertEqual(git_module.get_current_branch(), 'feature/foo')
+            self.assertEqual(git_module.get_branch_head('feature/foo'), second)
+            git('checkout', '-q', first)
+            self.assertEqual(git_module.get_current_branch(), 'HEAD')
+
+    def test_get_current_branch_fallback(self):
+        """Test that a HEAD that can't be read directly falls back to git."""
+        from heroku_tools import git as git_module
+        git, commit = self.make_repo()
+        commit('First')
+        git('checkout', '-q', '-b', 'feature/foo')
+        with patch('heroku_tools.git.run_git_cmd', return_value='feature/foo\n') as run:  # noqa
+            self.assertEqual(git_module.get_current_branch(), 'feature/foo')
+            self.assertFalse(run.called)
+        # a worktree, where .git is a file
+        tree = os.path.join(tempfile.mkdtemp(), 'tree')
+        self.addCleanup(shutil.rmtree, os.path.dirname(tree))
+        git('worktree', 'add', '-q', '-b', 'other', tree)
+        with patch('heroku_tools.git.get_work_dir', return_value=tree):
+            self.assertTrue(os.path.isfile(git_module.get_git_dir()))
+            self.assertEqual(git_module.get_current_branch(), 'other')
+        # unexpected content
+        with open(os.path.join(git_module.get_git_dir(), 'HEAD'), 'w') as f:
+            f.write('ref: refs/remotes/origin/master\n')
+        with patch('heroku_tools.git.run_git_cmd', return_value='origin/master\n') as run:  # noqa
+            self.assertEqual(git_module.get_current_branch(), 'origin/master')
+            run.assert_called_once_with("rev-parse --abbrev-ref HEAD")
+
+    def test_get_descendants(self):
+        from heroku_tools import git as git_module
+        git, commit = self.make_repo()
+        first = commit('First')
+        second = commit('Second')
+        git('checkout', '-q', '-b', 'side', first)
+        side = commit('Side')
+        worker = git_module.GitWorker()
+        self.addCleanup(worker.close)
+        with patch('heroku_tools.git.get_worker', return_value=worker):
+            self.assertEqual(
+                sorted(c[:7] for c in git_module.get_descendants(second)),
+                [second]
+            )
+            self.assertEqual(
+                sorted(c[:7] for c in git_module.get_descendants(first)),
+                sorted([first, second, side])
+            )
+            with self.assertRaises(git_module.GitError):
+                git_module.get_descendants('no-such-commit')
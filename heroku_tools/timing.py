@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""Timing instrumentation of workflow phases and external calls.
+
+Code is instrumented with spans - named, timed blocks, with optional
+metadata - which are only recorded if a Recorder has been started (by
+the `--timings` or `--trace` options of the CLI):
+
+    with timing.span('push', 'phase', remote=remote) as s:
+        ...
+        s.set(returncode=0)
+
+    @timing.timed('git range', 'git')
+    def get_range(...):
+        ...
+
+When no Recorder is running, span() returns a shared no-op object, and
+timed() calls straight through, so the cost of the instrumentation is a
+single global lookup per span.
+
+The recorded spans can be printed as a summary table (total time per
+span name), or exported as a Chrome trace-event file, which can be
+loaded into chrome://tracing, or https://ui.perfetto.dev, to view the
+spans (across all threads) as a flame chart.
+
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+import click
+
+# a single completed span - start and end are as returned by time.time()
+Span = collections.namedtuple(
+    'Span', ['name', 'category', 'start', 'end', 'thread', 'args']
+)
+
+# the running Recorder, or None if spans are not being recorded
+_recorder = None
+
+
+class Recorder(object):
+
+    """Collects the spans recorded (from any thread) while it is running."""
+
+    def __init__(self):
+        self.spans = []
+        self.started_at = time.time()
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, category, start, end, args):
+        """Record a completed span."""
+        thread = threading.current_thread()
+        with self._lock:
+            self._threads.setdefault(thread.ident, thread.name)
+            self.spans.append(
+                Span(name, category, start, end, thread.ident, args)
+            )
+
+    def summary(self):
+        """Return a list of (name, category, count, total, max) tuples.
+
+        Spans are grouped by name and category, and ordered by total
+        time, longest first.
+
+        """
+        totals = collections.OrderedDict()
+        for s in self.spans:
+            key = (s.name, s.category)
+            count, total, longest = totals.get(key, (0, 0.0, 0.0))
+            elapsed = s.end - s.start
+            totals[key] = (count + 1, total + elapsed, max(longest, elapsed))
+        return sorted(
+            (key + value for key, value in totals.items()),
+            key=lambda row: -row[3]
+        )
+
+    def chrome_trace(self):
+        """Return the spans as a Chrome trace-event format dict.
+
+        Each span is a 'complete' (ph='X') event, with times in
+        microseconds since the recorder started, and each thread is named
+        using a metadata event.
+
+        """
+        pid = os.getpid()
+        tids = dict((ident, i) for i, ident in enumerate(sorted(self._threads)))  # noqa
+        events = [
+            {
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': pid,
+                'tid': tids[ident],
+                'args': {'name': name},
+            }
+            for ident, name in self._threads.items()
+        ]
+        for s in self.spans:
+            events.append({
+                'name': s.name,
+                'cat': s.category,
+                'ph': 'X',
+                'ts': int((s.start - self.started_at) * 1e6),
+                'dur': int((s.end - s.start) * 1e6),
+                'pid': pid,
+                'tid': tids[s.thread],
+                'args': s.args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def start():
+    """Start recording spans, and return the Recorder."""
+    global _recorder
+    _recorder = Recorder()
+    return _recorder
+
+
+def stop():
+    """Stop recording spans, and return the Recorder (or None)."""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def is_recording():
+    """Return True if spans are being recorded."""
+    return _recorder is not None
+
+
+class _NullSpan(object):
+
+    """The span returned when not recording - does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    """A span being recorded - the time is taken on enter and exit."""
+
+    def __init__(self, recorder, name, category, args):
+        self.recorder = recorder
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.recorder.record(
+            self.name, self.category, self.start, time.time(), self.args
+        )
+
+    def set(self, **args):
+        """Add metadata to the span, e.g. the result of the call."""
+        self.args.update(args)
+
+
+def span(name, category='phase', **args):
+    """Return a context manager that records a span.
+
+    Args:
+        name: the name of the span, e.g. 'push', 'GET /apps/foo'.
+
+    Kwargs:
+        category: the type of span - 'phase' for workflow phases, or the
+            type of external call ('api', 'git', 'process', ...).
+        args: metadata recorded with the span - values must be JSON
+            serializable.
+
+    """
+    recorder = _recorder
+    if recorder is None:
+        return _NULL_SPAN
+    return _Span(recorder, name, category, args)
+
+
+def record(name, category, start, end, **args):
+    """Record a span that has already completed, e.g. a subprocess."""
+    recorder = _recorder
+    if recorder is not None:
+        recorder.record(name, category, start, end, args)
+
+
+def timed(name, category='phase'):
+    """Decorator that records each call to a function as a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            recorder = _recorder
+            if recorder is None:
+                return func(*args, **kwargs)
+            with _Span(recorder, name, category, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def print_summary(recorder):
+    """Print the summary table of the spans recorded."""
+    rows = recorder.summary()
+    width = max([len(row[0]) for row in rows] + [len("span")])
+    click.echo("")
+    click.echo(
+        "Timings (%.2fs):" % (time.time() - recorder.started_at)
+    )
+    click.echo("  %s  %-8s %5s %9s %9s" % ("span".ljust(width), "type", "calls", "total", "max"))  # noqa
+    for name, category, count, total, longest in rows:
+        click.echo("  %s  %-8s %5i %8.3fs %8.3fs" % (name.ljust(width), category, count, total, longest))  # noqa
+
+
+def write_trace(recorder, filename):
+    """Write the spans recorded to filename, in Chrome trace format."""
+    with open(filename, 'w') as f:
+        json.dump(recorder.chrome_trace(), f)
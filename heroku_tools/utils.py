@@ -1,10 +1,28 @@
 # -*- coding: utf-8 -*-
 """Shared utility functions."""
+import contextlib
+import Queue
 import random
 import sys
+import threading
+import time
 
 import click
 
+from . import timing
+
+# byte multipliers of the size units used by git (and format_size)
+SIZE_UNITS = {
+    'bytes': 1,
+    'KiB': 1024,
+    'MiB': 1024 ** 2,
+    'GiB': 1024 ** 3,
+}
+
+# per-thread output prefix used by echo(), see output_prefix()
+_output = threading.local()
+_echo_lock = threading.Lock()
+
 
 def prompt_for_pin(prompt, exit_on_failure=True):
     """Prompt user to input random number before continuing.
@@ -63,3 +81,153 @@ def split_print_lines(text, delimiter='\n', line_format='  * %s'):
     """Split a block of text and print out as lines."""
     for line in text.lstrip().rstrip().split(delimiter):
         click.echo(line_format % line)
+
+
+def run_concurrently(calls, processes=None):
+    """Run independent function calls in a thread pool, and gather results.
+
+    This is used to overlap calls that block on the network or on a
+    subprocess, so that the total time taken is that of the slowest
+    call, rather than the sum of all of them.
+
+    Args:
+        calls: a dict mapping a name to a (func, args) tuple.
+
+    Kwargs:
+        processes: the max number of threads to use, defaults to one
+            thread per call.
+
+    Returns a dict mapping each name to a 2-tuple of (result, elapsed),
+    where elapsed is the time in seconds that the call took. If any call
+    raises an exception, it is re-raised once all of the calls are done.
+
+    The calls are made with the output prefix of the calling thread.
+
+    """
+    prefix = get_output_prefix()
+    names = Queue.Queue()
+    for name in calls:
+        names.put(name)
+    results = {}
+    errors = []
+
+    def worker():
+        with output_prefix(prefix):
+            _worker()
+
+    def _worker():
+        while True:
+            try:
+                name = names.get_nowait()
+            except Queue.Empty:
+                return
+            func, args = calls[name]
+            start = time.time()
+            try:
+                with timing.span(u"%s" % name, 'call'):
+                    result = func(*args)
+                results[name] = result, time.time() - start
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [
+        threading.Thread(target=worker)
+        for _ in range(min(processes or len(calls), len(calls)))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def poll(check, timeout, interval=0.5, max_interval=5, backoff=2):
+    """Call check() until it returns a truthy value, or timeout expires.
+
+    The delay between calls starts at interval seconds, and is multiplied
+    by backoff after each call, up to max_interval.
+
+    Returns the first truthy value returned by check(), or None if the
+    timeout (in seconds) expires first.
+
+    """
+    deadline = time.time() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
+
+
+def format_size(size):
+    """Return a number of bytes in the units used by git, e.g. '1.20 MiB'."""
+    for unit in ('GiB', 'MiB', 'KiB'):
+        scale = SIZE_UNITS[unit]
+        if size >= scale:
+            return "%.2f %s" % (float(size) / scale, unit)
+    return "%i bytes" % size
+
+
+def print_timings(timings, title="Timings:"):
+    """Print out the elapsed times returned from run_concurrently."""
+    click.echo(title)
+    width = max(len(name) for name in timings) if timings else 0
+    for name, (_, elapsed) in sorted(timings.items()):
+        click.echo("  %s %6.2fs" % (name.ljust(width), elapsed))
+
+
+@contextlib.contextmanager
+def output_prefix(prefix):
+    """Prefix every line printed by echo() in the current thread.
+
+    This is used when running the same workflow for several applications
+    concurrently, so that their output can be told apart, e.g.:
+
+        with output_prefix('[live] '):
+            echo("Pushing to git remote")
+
+    Prefixes are nested if output_prefix is used within another.
+
+    """
+    previous = get_output_prefix()
+    _output.prefix = previous + prefix
+    try:
+        yield
+    finally:
+        _output.prefix = previous
+
+
+def get_output_prefix():
+    """Return the output prefix of the current thread.
+
+    New threads start with no prefix - this can be used to carry the
+    prefix of the thread that starts them over into the new thread.
+
+    """
+    return getattr(_output, 'prefix', '')
+
+
+def echo(message=''):
+    """Thread-safe click.echo that applies the current output_prefix.
+
+    Each line of the message is prefixed, and the whole message is
+    written in one go, so that output from concurrent threads is never
+    interleaved mid-line.
+
+    """
+    if isinstance(message, str):
+        message = message.decode('utf-8', 'replace')
+    elif not isinstance(message, unicode):
+        message = unicode(message)
+    prefix = get_output_prefix()
+    if prefix:
+        message = u"\n".join(prefix + l for l in message.split(u"\n"))
+    with _echo_lock:
+        click.echo(message)
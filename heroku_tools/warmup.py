@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Post-deployment warm-up of an application's dynos.
+
+The first requests served by newly started dynos are slow - caches are
+empty, modules are imported lazily, database connections are opened -
+so rather than leave that to the first users after a deployment, the
+`warmup` block of the application conf lists URLs that are requested
+as soon as the new release is live, and the maintenance page is down:
+
+    application:
+        name: live_app
+        warmup:
+            # relative URLs are resolved against this, which defaults
+            # to https://{name}.herokuapp.com
+            base_url: https://www.example.com
+            # the number of requests in flight at once
+            concurrency: 8
+            # the number of requests made to each URL
+            requests: 20
+            # per-request timeout, in seconds
+            timeout: 10
+            urls:
+                - /
+                - /accounts/login/
+
+The requests are shared out across a pool of threads, using a single
+pool of keep-alive connections, and the latency percentiles of each URL
+are printed once they are all done. Failed requests (errors, or a 4xx /
+5xx response) are counted and reported, but do not fail the deployment.
+
+"""
+import collections
+import math
+import Queue
+import sys
+import threading
+import time
+import urlparse
+
+import requests
+
+from . import timing, utils
+from .config import ConfigurationError
+
+# defaults for settings not given in the warmup block
+DEFAULT_CONCURRENCY = 4
+DEFAULT_REQUESTS = 10
+DEFAULT_TIMEOUT = 10
+# base of relative URLs if no base_url is given
+HEROKU_APP_URL = 'https://%s.herokuapp.com'
+
+# the outcome of warming up a single URL - latencies are in seconds, and
+# are None if no response was received.
+WarmupResult = collections.namedtuple(
+    'WarmupResult', ['url', 'requests', 'errors', 'p50', 'p90', 'p99', 'max']
+)
+
+
+def percentile(values, pct):
+    """Return the pct percentile of a sorted list, using nearest rank.
+
+    Returns None if the list is empty.
+
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class Warmup(object):
+
+    """A set of URLs to request after a deployment."""
+
+    def __init__(self, urls, concurrency=DEFAULT_CONCURRENCY, requests=DEFAULT_REQUESTS, timeout=DEFAULT_TIMEOUT):  # noqa
+        """Initialise warm-up.
+
+        Args:
+            urls: list of absolute URLs to request.
+
+        Kwargs:
+            concurrency: the max number of requests in flight at once.
+            requests: the number of requests made to each URL.
+            timeout: the timeout of each request, in seconds.
+
+        """
+        self.urls = urls
+        self.concurrency = concurrency
+        self.requests = requests
+        self.timeout = timeout
+
+    def __unicode__(self):
+        return (
+            u"%i URLs x %i requests (%i at a time)" %
+            (len(self.urls), self.requests, self.concurrency)
+        )
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def run(self):
+        """Make the requests, and return a list of WarmupResult objects.
+
+        The requests to each URL are interleaved, so that every URL is
+        warmed up from the start, rather than one after another. Results
+        are returned in the order of `urls`.
+
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)  # noqa
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        pending = Queue.Queue()
+        for _ in range(self.requests):
+            for url in self.urls:
+                pending.put(url)
+        latencies = dict((url, []) for url in self.urls)
+        errors = collections.Counter()
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    url = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                start = time.time()
+                try:
+                    resp = session.get(url, timeout=self.timeout, allow_redirects=False)  # noqa
+                except Exception:
+                    timing.record(u"GET %s" % url, 'http', start, time.time(), error=sys.exc_info()[0].__name__)  # noqa
+                    with lock:
+                        errors[url] += 1
+                    continue
+                elapsed = time.time() - start
+                timing.record(u"GET %s" % url, 'http', start, start + elapsed, status=resp.status_code)  # noqa
+                with lock:
+                    latencies[url].append(elapsed)
+                    if resp.status_code >= 400:
+                        errors[url] += 1
+
+        threads = [
+            threading.Thread(target=worker)
+            for _ in range(min(self.concurrency, pending.qsize()))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        session.close()
+
+        results = []
+        for url in self.urls:
+            values = sorted(latencies[url])
+            results.append(WarmupResult(
+                url,
+                self.requests,
+                errors[url],
+                percentile(values, 50),
+                percentile(values, 90),
+                percentile(values, 99),
+                values[-1] if values else None
+            ))
+        return results
+
+
+def parse_warmup(warmup, application):
+    """Return the Warmup from the warmup config, or None if there isn't one.
+
+    Args:
+        warmup: the `warmup` block of the application conf.
+        application: the Heroku application name, used for the default
+            base_url.
+
+    Raises ConfigurationError if the config is invalid - there are no
+    urls, or concurrency or requests is not a positive number.
+
+    """
+    if not warmup:
+        return None
+    if not isinstance(warmup, dict) or not warmup.get('urls'):
+        raise ConfigurationError(
+            u"Invalid warmup config, no urls specified: %s" % warmup
+        )
+    base_url = warmup.get('base_url') or HEROKU_APP_URL % application
+    settings = {}
+    for key, default in (
+        ('concurrency', DEFAULT_CONCURRENCY),
+        ('requests', DEFAULT_REQUESTS),
+    ):
+        value = warmup.get(key, default)
+        if not isinstance(value, int) or value < 1:
+            raise ConfigurationError(
+                u"Invalid warmup config, %s must be a positive number: %s" %
+                (key, value)
+            )
+        settings[key] = value
+    return Warmup(
+        urls=[urlparse.urljoin(base_url.rstrip('/') + '/', u) for u in warmup['urls']],  # noqa
+        timeout=warmup.get('timeout', DEFAULT_TIMEOUT),
+        **settings
+    )
+
+
+def _seconds(value):
+    """Format a latency for print_warmup."""
+    return "-" if value is None else "%.3fs" % value
+
+
+def print_warmup(results, elapsed):
+    """Print out the latency percentiles of each URL warmed up."""
+    utils.echo(
+        "Warm-up completed in %.2fs (%i requests, %i errors)" % (
+            elapsed,
+            sum(r.requests for r in results),
+            sum(r.errors for r in results)
+        )
+    )
+    width = max(len(r.url) for r in results)
+    for r in results:
+        utils.echo("  %s  %3i errors  p50 %7s  p90 %7s  p99 %7s  max %7s" % (
+            r.url.ljust(width),
+            r.errors,
+            _seconds(r.p50),
+            _seconds(r.p90),
+            _seconds(r.p99),
+            _seconds(r.max),
+        ))
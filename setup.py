@@ -22,7 +22,7 @@ setup(
         "Command line application for managing Heroku applications."
     ),
     long_description=README,
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     include_package_data=True,
     install_requires=REQUIREMENTS,
     entry_points={